@@ -0,0 +1,223 @@
+""" Benchmarks for InsightsWorkbook against a local fake portal
+
+Usage:
+
+    python benchmarks/bench_workbook.py --sizes 1 10 100 1000 \
+        --latency 0.005 --output results.json
+    python benchmarks/bench_workbook.py --compare old.json results.json
+
+Each operation is measured on workbooks with the given numbers of datasets
+and cards. For every (operation, size) the wall time, number of requests,
+bytes sent and received and peak traced memory are recorded, and the results
+are written as JSON so runs can be compared across commits. The encode_*
+operations serialize the workbook for upload with each available serializer
+backend, save_gzip uploads it gzip-compressed, save_merge saves over
+someone else's save, and the async_* operations go through
+AsyncInsightsWorkbook, with the layers added in about 8 concurrent execute
+calls. The fake portal runs in the same process, so peak memory includes
+its handling of the requests, which grows with the payload size just like
+the client's.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_portal import FakeGIS, FakeItem, FakeLayer, FakePortal  # noqa: E402
+import insightsworkbook  # noqa: E402
+from insightsworkbook import (  # noqa: E402
+    AsyncInsightsWorkbook, InsightsWorkbook, WorkbookSession)
+
+
+class Measurement(object):
+    """ Context manager recording the cost of one benchmarked operation """
+
+    def __init__(self, results, gis, operation, size):
+        self.results = results
+        self.con = gis._portal.con
+        self.operation = operation
+        self.size = size
+
+    def __enter__(self):
+        self.start_counters = self.con.counters()
+        tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        requests, sent, received = [
+            b - a for a, b in zip(self.start_counters, self.con.counters())]
+        self.results.append({
+            'operation': self.operation,
+            'size': self.size,
+            'wall_time': wall,
+            'requests': requests,
+            'bytes_sent': sent,
+            'bytes_received': received,
+            'peak_memory': peak})
+
+
+def run(sizes, latency):
+    """ Runs every benchmark for each size and returns the result rows """
+    results = []
+    portal = FakePortal(latency).start()
+    try:
+        for size in sizes:
+            gis = FakeGIS(portal)
+            layers = [FakeLayer(portal, i) for i in range(size)]
+            insightsworkbook.layer_metadata.invalidate()
+
+            def measure(operation):
+                return Measurement(results, gis, operation, size)
+
+            with measure('new'):
+                workbook = InsightsWorkbook.new(gis, 'Benchmark %d' % size)
+            with measure('add_feature_layer'):
+                names = [workbook.add_feature_layer(x) for x in layers]
+            batch = InsightsWorkbook.new(gis, 'Batch %d' % size)
+            with measure('add_feature_layers'):
+                batch.add_feature_layers(layers)
+            with measure('add_chart'):
+                for i in range(size):
+                    workbook.add_chart('column', names[i], 'Field%d' % i,
+                                       'esriFieldTypeString', 'count',
+                                       'ObjectId', 'esriFieldTypeInteger')
+            with measure('save'):
+                workbook.save()
+            default_serializer = insightsworkbook.default_serializer
+            try:
+                for serializer in serializers():
+                    insightsworkbook.default_serializer = serializer
+                    with measure('encode_' + serializer.name):
+                        workbook._save_text()
+            finally:
+                insightsworkbook.default_serializer = default_serializer
+            item = FakeItem(gis, workbook)
+            zipped = InsightsWorkbook.open(
+                item, session=WorkbookSession(gis, compress=True))
+            with measure('save_gzip'):
+                zipped.save(force=True)
+            item = FakeItem(gis, workbook)
+            with measure('open'):
+                opened = InsightsWorkbook.open(item)
+            with measure('update_dataset'):
+                opened.update_dataset(layers[0])
+            with measure('update_datasets'):
+                opened.update_datasets(layers)
+            with measure('save_refreshed'):
+                opened.save()
+            with measure('save_unchanged'):
+                opened.save()
+            item = FakeItem(gis, workbook)
+            with measure('open_lazy'):
+                lazy = InsightsWorkbook.open(item, lazy=True)
+            with measure('update_dataset_lazy'):
+                lazy.update_dataset(layers[0])
+            with measure('save_lazy'):
+                lazy.save()
+            # Someone else saved since these were opened, so saving them
+            # merges
+            mine = InsightsWorkbook.open(FakeItem(gis, workbook))
+            theirs = InsightsWorkbook.open(FakeItem(gis, workbook))
+            theirs.update_dataset(layers[-1])
+            theirs.save()
+            mine.add_map(names[0])
+            with measure('save_merge'):
+                mine.save()
+            async_workbook = asyncio.run(
+                AsyncInsightsWorkbook.new(gis, 'Async %d' % size))
+            with measure('async_add_layers'):
+                asyncio.run(async_workbook.add_feature_layers(
+                    layers, chunk_size=max(1, size // 8)))
+            with measure('async_save'):
+                asyncio.run(async_workbook.save())
+    finally:
+        portal.stop()
+    return results
+
+
+def serializers():
+    """ Instances of every serializer backend that can be used here """
+    backends = [insightsworkbook.JSONSerializer()]
+    if insightsworkbook.orjson is not None:
+        backends.append(insightsworkbook.OrjsonSerializer())
+    return backends
+
+
+def git_commit():
+    """ Current git commit of the repository, if available """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path):
+    """ Prints the change in each metric between two result files """
+    with open(old_path) as f:
+        old = {(x['operation'], x['size']): x for x in json.load(f)['results']}
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    metrics = ('wall_time', 'requests', 'bytes_sent', 'bytes_received',
+               'peak_memory')
+    print('%-20s %6s ' % ('operation', 'size') +
+          ' '.join('%14s' % x for x in metrics))
+    for row in new:
+        base = old.get((row['operation'], row['size']))
+        if base is None:
+            continue
+        ratios = ['%13.2fx' % (row[x] / base[x]) if base[x] else '%14s' % '-'
+                  for x in metrics]
+        print('%-20s %6d ' % (row['operation'], row['size']) +
+              ' '.join(ratios))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1, 10, 100, 1000],
+                        help='Numbers of datasets and cards to benchmark')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds of latency added to each request')
+    parser.add_argument('--output', help='Path of the JSON results file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two results files instead of running')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = run(args.sizes, args.latency)
+    report = {
+        'commit': git_commit(),
+        'version': insightsworkbook.__version__,
+        'python': platform.python_version(),
+        'latency': args.latency,
+        'results': results}
+    print('%-20s %6s %10s %8s %12s %12s %12s' % (
+        'operation', 'size', 'wall (s)', 'requests', 'sent', 'received',
+        'peak mem'))
+    for x in results:
+        print('%-20s %6d %10.4f %8d %12d %12d %12d' % (
+            x['operation'], x['size'], x['wall_time'], x['requests'],
+            x['bytes_sent'], x['bytes_received'], x['peak_memory']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+""" In-process stand-in for the ArcGIS REST endpoints used by InsightsWorkbook
+
+FakePortal serves createService, content/items/<id>, content/items/<id>/data,
+items/<id>/update and WorkspaceServer/execute from a local HTTP server, with
+an optional artificial latency per request. FakeGIS mimics the parts of
+arcgis.gis.GIS that InsightsWorkbook uses and talks to the server over real
+HTTP, counting requests and bytes sent and received. gzip-compressed request
+bodies are accepted, as sent by a WorkbookSession with compress=True.
+"""
+
+import gzip
+import itertools
+import json
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakePortal(object):
+    """
+    Local HTTP server standing in for ArcGIS Portal and WorkspaceServer.
+
+    ================    ========================================================
+    **Argument**        **Description**
+    ----------------    --------------------------------------------------------
+    latency             Optional float. Seconds to wait before answering each
+                        request.
+    ================    ========================================================
+
+    Set gzip_status to an HTTP status to turn compressed request bodies
+    away with it, like a server or proxy that doesn't accept them.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.gzip_status = None
+        self.gzip_rejected = 0
+        self.items = {}
+        self.modified = {}
+        self._last_modified = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        portal = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                portal._respond(self, 'GET', path,
+                                urllib.parse.parse_qs(query))
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    if portal.gzip_status:
+                        portal.gzip_rejected += 1
+                        self.send_error(portal.gzip_status)
+                        return
+                    body = gzip.decompress(body)
+                body = body.decode('utf-8')
+                portal._respond(self, 'POST', self.path,
+                                urllib.parse.parse_qs(body))
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+
+    @property
+    def url(self):
+        """ Base URL of the server """
+        return 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    def start(self):
+        """ Starts serving requests on a background thread """
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stops the server """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _respond(self, handler, method, path, params):
+        if self.latency:
+            time.sleep(self.latency)
+        params = {k: v[0] for k, v in params.items()}
+        if path.endswith('/createService'):
+            with self._lock:
+                item_id = 'item%d' % next(self._ids)
+                self.items[item_id] = '{}'
+                self.modified[item_id] = self._modified_time()
+            resp = {'success': True, 'itemId': item_id,
+                    'serviceItemId': item_id}
+        elif path.endswith('/update'):
+            item_id = path.rstrip('/').split('/')[-2]
+            with self._lock:
+                if 'text' in params:
+                    self.items[item_id] = params['text']
+                self.modified[item_id] = self._modified_time()
+            resp = {'success': True, 'id': item_id}
+        elif path.endswith('/data'):
+            item_id = path.rstrip('/').split('/')[-2]
+            body = self.items.get(item_id, '{}').encode('utf-8')
+            return self._send(handler, body)
+        elif '/content/items/' in path:
+            item_id = path.rstrip('/').split('/')[-1]
+            resp = {'id': item_id, 'modified': self.modified.get(item_id)}
+        elif path.endswith('/WorkspaceServer/execute'):
+            names = json.loads(params['outDatasets'])
+            with self._lock:
+                resp = {x: 'data%d' % next(self._ids) for x in names}
+        else:
+            resp = {'error': {'code': 404, 'message': 'Not found'}}
+        self._send(handler, json.dumps(resp).encode('utf-8'))
+
+    def _modified_time(self):
+        """
+        Item modified time in ms since the epoch, as ArcGIS reports it, but
+        always later than the last one handed out
+        """
+        self._last_modified = max(int(time.time() * 1000),
+                                  self._last_modified + 1)
+        return self._last_modified
+
+    @staticmethod
+    def _send(handler, body):
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+class FakeConnection(object):
+    """ Stand-in for GIS._portal.con that counts requests and bytes """
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._session = _FakeHTTPSession(self)
+
+    def post(self, url, data, **kwargs):
+        body = urllib.parse.urlencode(data).encode('utf-8')
+        return self._send(urllib.request.Request(url, body), len(body))
+
+    def get(self, url, params=None, try_json=True, **kwargs):
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        return self._send(urllib.request.Request(url), 0, try_json)
+
+    def _send(self, request, sent, try_json=True):
+        with urllib.request.urlopen(request) as resp:
+            body = resp.read()
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += sent
+            self.bytes_received += len(body)
+        if not try_json:
+            return body.decode('utf-8')
+        return json.loads(body.decode('utf-8'))
+
+    def counters(self):
+        """ Returns the request count and bytes sent and received so far """
+        with self._lock:
+            return self.requests, self.bytes_sent, self.bytes_received
+
+
+class _FakeResponse(object):
+    """ Stand-in for a requests.Response """
+
+    def __init__(self, body):
+        self._body = body
+        self.status_code = 200
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._body
+
+
+class _FakeHTTPSession(object):
+    """
+    Stand-in for the requests.Session behind a GIS connection, for raw
+    (e.g. compressed) request bodies
+    """
+
+    def __init__(self, con):
+        self.adapters = {}
+        self._con = con
+
+    def mount(self, prefix, adapter):
+        self.adapters[prefix] = adapter
+
+    def post(self, url, data=None, headers=None):
+        request = urllib.request.Request(url, data, headers or {})
+        return _FakeResponse(self._con._send(request, len(data)))
+
+
+class _FakeUser(object):
+    username = 'benchmark'
+
+
+class _FakeUsers(object):
+    me = _FakeUser()
+
+
+class _FakePortalConnection(object):
+    """ Stand-in for GIS._portal """
+
+    def __init__(self, url):
+        self.url = url
+        self.con = FakeConnection()
+        self._properties = {'id': 'benchmark'}
+
+    def update_item(self, item_id, item_props, text):
+        data = dict(item_props)
+        data['text'] = text
+        self.con.post(self.url + '/sharing/rest/content/users/benchmark/items/'
+                      + item_id + '/update', data)
+
+
+class FakeGIS(object):
+    """ Stand-in for arcgis.gis.GIS pointed at a FakePortal """
+
+    def __init__(self, portal):
+        self._url = portal.url
+        self._portal = _FakePortalConnection(portal.url)
+        self.users = _FakeUsers()
+
+
+class FakeItem(object):
+    """ Stand-in for an "Insights Workbook" arcgis.gis.Item """
+
+    def __init__(self, gis, workbook):
+        self._gis = gis
+        self.title = workbook._title
+        self.name = workbook._workbookID
+        self.id = workbook._workspaceID
+        self.modified = gis._portal.con.get(
+            gis._url + '/sharing/rest/content/items/' + self.id,
+            {'f': 'json'})['modified']
+
+    def get_data(self, try_json=True):
+        url = (self._gis._url + '/sharing/rest/content/items/' + self.id +
+               '/data')
+        return self._gis._portal.con.get(url, {'f': 'json'} if try_json
+                                         else None, try_json=try_json)
+
+
+class _FakeProperties(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+class _FakeSublayer(object):
+    def __init__(self, extent):
+        self.properties = _FakeProperties(extent=_FakeProperties(extent))
+
+
+class FakeLayer(object):
+    """ Stand-in for a hosted feature layer arcgis.gis.Item """
+
+    def __init__(self, portal, n):
+        self.title = 'Layer%d' % n
+        self.id = 'layer%d' % n
+        self.url = portal.url + '/services/Layer%d/FeatureServer' % n
+        self.layers = [_FakeSublayer({
+            'xmin': -125.0 + n % 50, 'ymin': 25.0 + n % 20,
+            'xmax': -120.0 + n % 50, 'ymax': 30.0 + n % 20,
+            'spatialReference': {'wkid': 4326}})]
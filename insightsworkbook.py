@@ -1,428 +1,3554 @@
 """ Class for interacting with ArcGIS Insights """
 
+import abc
+import asyncio
+import copy
+import csv
+import email.utils
+import functools
+import gzip
+import hashlib
 import json
+import math
+import os
 import random
-import sys
-from urllib.error import HTTPError
+import re
+import sqlite3
+import threading
+import time
+import warnings
+import weakref
+import zlib
+from collections import deque, namedtuple
+from collections.abc import MutableMapping, MutableSequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import quote_plus, urlsplit
 
 from arcgis.gis import GIS
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    HTTPAdapter = None
+
 __version__ = '0.1'
 
+# Maximum number of add-data tools sent to WorkspaceServer in a single
+# execute call
+EXECUTE_CHUNK_SIZE = 50
 
-class InsightsWorkbook(object):
-    """ An object representing an ArcGIS Insights workbook
+# Default number of workbooks refreshed concurrently by refresh_workbooks()
+REFRESH_MAX_WORKERS = 8
 
-    Users can use this class to create new Insights workbooks, connect to
-    existing workbooks, and modify them. Currently, it serves as a proof of
-    concept to demonstrate adding data, creating a map, and creating a chart,
-    but new functionality can easily be added in the future.
+# Default maximum number of concurrent requests to a single host made by an
+# AsyncTransport
+ASYNC_MAX_PER_HOST = 8
+
+# Host of the hosted services that store ArcGIS Online workbooks' data
+_INSIGHTS_SERVICES = 'https://insightsservices.arcgis.com/'
+
+# Statuses of a throttled request, and the statuses of a compressed upload
+# that's resent uncompressed without turning compression off: expired or
+# invalid tokens, which the GIS connection renews
+_THROTTLE_STATUSES = (429, 503)
+_AUTH_STATUSES = (401, 498, 499)
+
+# Starting rate (requests per second) of the shared RateLimiter for each
+# host - None means unpaced until the host throttles a request - and the
+# statuses that make a request be retried
+RATE_LIMIT = None
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Seconds that layer properties stay in the shared layer metadata cache
+LAYER_METADATA_TTL = 300
+
+# Well-known IDs of the spatial references extents can be converted between
+# (WGS 84 and Web Mercator), and the constants of the conversion
+_GEOGRAPHIC_WKIDS = (4326,)
+_MERCATOR_WKIDS = (3857, 102100, 102113, 900913)
+_EARTH_RADIUS = 6378137.0
+_MERCATOR_MAX_LAT = 85.0511287798
+
+# Number of CSV rows read at a time by LocalAggregator
+LOCAL_CHUNK_SIZE = 100000
+
+# Statistics supported by aggregate() and LocalAggregator
+STAT_TYPES = ('avg', 'sum', 'count', 'min', 'max')
+
+# Chart types supported by add_chart()
+CHART_TYPES = ('bar', 'column')
+
+# Version of the Insights workbook format this module reads and writes
+WORKBOOK_FORMAT = 9
+
+# Default maximum number of cards on a page. Once the current page has this
+# many, new cards are placed on a new page.
+PAGE_CARD_LIMIT = 30
+
+# Width of the grid cards are packed into by LayoutPacker, and the space kept
+# between neighbouring cards (four 20 by 20 cards fit across)
+LAYOUT_COLUMNS = 83
+LAYOUT_GAP = 1
+
+# Result of a LocalAggregator aggregation. columns is a dict of the group-by
+# and statistic field names to NumPy arrays of their values, one entry per
+# group, and fields is the metadata.fields schema aggregate() would record.
+LocalAggregateResult = namedtuple('LocalAggregateResult',
+                                  ['columns', 'fields'])
+
+# Default number of features sent in a single edit_features call by
+# ingest_csv_delta()
+EDIT_BATCH_SIZE = 500
+
+# Result of ingest_csv_delta(): the number of features added, updated and
+# deleted, and a list of the individual edit results that failed.
+DeltaResult = namedtuple('DeltaResult',
+                         ['adds', 'updates', 'deletes', 'failures'])
+
+# Record of a single REST call made to ArcGIS, passed to every request hook.
+# operation is one of createService, updateItem, getItem, getData, execute
+# and getLayer (fetching a feature layer's properties); request_bytes and
+# response_bytes are the sizes of the JSON payloads; latency is in seconds;
+# status is the HTTP status code of the response, or the code of an error
+# returned in a JSON body, or the status carried by the exception of a
+# failed call (None if it didn't carry one); workbook is the item ID, if
+# known.
+Span = namedtuple('Span', ['operation', 'url', 'host', 'request_bytes',
+                           'response_bytes', 'latency', 'status', 'workbook',
+                           'error'])
+
+# Outcome of refreshing a single workbook in refresh_workbooks(). datasets is
+# the list of refreshed dataset names (empty if the workbook doesn't use any
+# of the layers), and error is the exception raised, if any.
+RefreshResult = namedtuple('RefreshResult', ['item', 'datasets', 'error'])
+
+# Default number of workbooks provisioned concurrently by
+# WorkbookTemplate.provision()
+PROVISION_MAX_WORKERS = 8
+
+# Outcome of provisioning a single workbook from a WorkbookTemplate. workbook
+# is the new InsightsWorkbook (None if it couldn't be created, or an earlier
+# run already finished it), and error is the exception raised, if any.
+ProvisionResult = namedtuple('ProvisionResult',
+                             ['title', 'workbook', 'error'])
+
+# Default number of workbooks downloaded or created concurrently by
+# export_workbooks() and import_workbooks()
+ARCHIVE_MAX_WORKERS = 8
+
+# Version of the archive layout written by export_workbooks(), and the item
+# properties it keeps for each workbook
+ARCHIVE_VERSION = 1
+_ARCHIVE_FORMAT = 'insightsworkbook-archive'
+_ARCHIVE_ITEM_KEYS = ('id', 'title', 'name', 'owner', 'created', 'modified',
+                      'tags', 'snippet', 'description', 'typeKeywords',
+                      'access')
+
+# Outcome of exporting a single workbook in export_workbooks(). error is the
+# exception raised, if any, in which case the workbook isn't in the archive.
+ExportResult = namedtuple('ExportResult', ['item', 'error'])
+
+# Outcome of importing a single workbook in import_workbooks(). item_id is
+# its ID in the archive and workspace_id the ID of the new item (None if it
+# couldn't be created), and error is the exception raised, if any.
+ImportResult = namedtuple('ImportResult',
+                          ['title', 'item_id', 'workspace_id', 'error'])
+
+
+class InsightsWorkbookError(Exception):
+    """
+    Raised when a request to ArcGIS made by an InsightsWorkbook fails, or the
+    Workbook can't carry out an operation. The original exception, if any,
+    is chained as __cause__.
+    """
+
+
+class InsightsWorkbookValidationError(InsightsWorkbookError):
+    """
+    Raised before a save or execute call when the workbook, or the request,
+    breaks the rules of the Insights workbook format. problems is the list
+    of everything found, each starting with the path of the offending part.
+    """
+
+    def __init__(self, problems):
+        super().__init__('Invalid workbook: ' + '; '.join(problems[:10]) +
+                         ('' if len(problems) <= 10 else
+                          ' (and ' + str(len(problems) - 10) + ' more)'))
+        self.problems = problems
+
+
+class InsightsWorkbookConflict(InsightsWorkbookError):
+    """
+    Raised by save() when the workbook was changed in ArcGIS since it was
+    opened, and those changes overlap with the local ones so they can't be
+    merged. paths is the list of JSON pointers to the overlapping changes.
+    """
+
+    def __init__(self, paths):
+        super().__init__('Workbook was changed in ArcGIS, conflicting '
+                         'changes at: ' + ', '.join(paths))
+        self.paths = paths
+
+
+# Callbacks run with a Span after every REST call to ArcGIS
+_request_hooks = []
+
+
+def add_request_hook(hook):
+    """
+    Registers a callback that is called with a Span after every REST call
+    InsightsWorkbook and AsyncInsightsWorkbook make to ArcGIS. Measuring
+    response sizes means re-encoding the responses, so hooks add some
+    overhead to every call while registered.
+
+    ==================     =====================================================
+    **Argument**           **Description**
+    ------------------     -----------------------------------------------------
+    hook                   Required callable. Called with a single Span. A
+                           RequestStats object can be used directly.
+    ==================     =====================================================
+    """
+    _request_hooks.append(hook)
+
+
+def remove_request_hook(hook):
+    """ Unregisters a callback added with add_request_hook() """
+    if hook in _request_hooks:
+        _request_hooks.remove(hook)
+
+
+def _payload_size(payload):
+    """ Approximate size in bytes of a request or response payload """
+    if payload is None:
+        return 0
+    if isinstance(payload, (str, bytes)):
+        return len(payload)
+    if isinstance(payload, dict) and all(isinstance(x, (str, list))
+                                         for x in payload.values()):
+        # Form data - count the values that make up the bulk of it, some
+        # of which may be lists of strings sent joined
+        return sum(len(k) + (sum(map(len, v)) if isinstance(v, list)
+                             else len(v)) for k, v in payload.items())
+    return len(json.dumps(payload))
+
+
+def _error_status(exc):
+    """ HTTP status code carried by an exception from a portal call, if any """
+    for attr in ('code', 'status', 'status_code'):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(exc, 'response', None)
+    value = getattr(response, 'status_code', None)
+    if isinstance(value, int):
+        return value
+    # The ArcGIS API for Python raises plain exceptions for JSON errors, with
+    # the code in the message
+    match = re.search(r'Error Code: (\d{3})', str(exc))
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def _response_status(resp):
+    """
+    HTTP status of a successful portal call's response: that of a response
+    object, the code of an error returned in a JSON body, or else 200, since
+    the GIS connection raises for any other status
+    """
+    for attr in ('status_code', 'status'):
+        value = getattr(resp, attr, None)
+        if isinstance(value, int):
+            return value
+    error = resp.get('error') if isinstance(resp, dict) else None
+    if isinstance(error, dict) and isinstance(error.get('code'), int):
+        return error['code']
+    return 200
+
+
+def _emit_span(operation, url, payload, resp, start, workbook, error=None):
+    """ Reports a finished portal call to every request hook """
+    span = Span(operation, url, urlsplit(url).netloc.lower(),
+                _payload_size(payload),
+                _payload_size(resp) if error is None else 0,
+                time.perf_counter() - start,
+                _response_status(resp) if error is None
+                else _error_status(error),
+                workbook, error)
+    for hook in list(_request_hooks):
+        try:
+            hook(span)
+        except Exception as e:
+            warnings.warn('Request hook failed: ' + repr(e))
+
+
+def _traced(operation, url, payload, call, workbook=None):
+    """
+    Makes a blocking portal call, reporting it to the request hooks if any
+    are registered.
+    """
+    if not _request_hooks:
+        return call()
+    start = time.perf_counter()
+    try:
+        resp = call()
+    except Exception as e:
+        _emit_span(operation, url, payload, None, start, workbook, e)
+        raise
+    _emit_span(operation, url, payload, resp, start, workbook)
+    return resp
+
+
+def _retry_after(exc):
+    """
+    Seconds to wait given by the Retry-After header of a failed request, or
+    None if there isn't one.
+    """
+    headers = getattr(exc, 'headers', None)
+    if headers is None:
+        headers = getattr(getattr(exc, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(when.timestamp() - time.time(), 0.0)
+
+
+class _Bucket(object):
+    """ Token bucket state of a RateLimiter for one host """
+    __slots__ = ('rate', 'tokens', 'updated', 'paused_until', 'recent')
+
+    def __init__(self, rate, tokens, now):
+        self.rate = rate
+        self.tokens = tokens
+        self.updated = now
+        self.paused_until = 0.0
+        # Times of the requests sent within the window while unpaced
+        self.recent = deque()
 
 
+class RateLimiter(object):
+    """
+    Token buckets that pace requests to ArcGIS, one per host, shared between
+    workbooks and threads. The rate for a host adapts to it: it's halved
+    whenever a request is throttled (429 or 503) and creeps back up by
+    rate_increase with every success. If the host gives a Retry-After time,
+    requests to it pause for exactly that long instead, and the rate is
+    left as it is. Without a starting rate, requests to a host aren't paced
+    until it first throttles one; the rate then starts from the rate
+    observed over the last window seconds (halved, unless there was a
+    Retry-After time), but no lower than min_rate.
+
     ================    ========================================================
     **Argument**        **Description**
     ----------------    --------------------------------------------------------
-    gis                 GIS connection object from arcgis.gis (ArcGIS API for
-                        Python). Connection should be set up before working with
-                        this class.
+    rate                Optional float. Starting rate in requests per second.
     ----------------    --------------------------------------------------------
-    title               Optional string. Title for the Insights workbook
+    burst               Optional int. Number of requests that can be sent at
+                        once after an idle period. Defaults to the rate.
     ----------------    --------------------------------------------------------
-    workbook_id         Optional string. Random ID used for Hosted storage.
+    max_rate            Optional float. Highest rate to climb back up to.
     ----------------    --------------------------------------------------------
-    workspace_id        Optional string. Workbook Item ID in ArcGIS - generated
-                        by ArcGIS upon creation of a workbook.
+    min_rate            Optional float. Lowest rate to back off to.
     ----------------    --------------------------------------------------------
-    workspace_url       Optional string. URL where the Insights workbook
-                        internal hosted workspace resides. Structure differs
-                        between ArcGIS Online and ArcGIS Portal.
+    rate_increase       Optional float. Requests per second added to the rate
+                        after each successful request.
     ----------------    --------------------------------------------------------
-    props               Optional dict. Dictionary of workbook properties that
-                        represents the full JSON data object that is stored in
-                        ArcGIS.
+    window              Optional float. Seconds over which the rate of unpaced
+                        requests is measured.
     ================    ========================================================
+    """
 
+    def __init__(self, rate=RATE_LIMIT, burst=None, max_rate=None,
+                 min_rate=1.0, rate_increase=0.1, window=10.0):
+        self.rate = float(rate) if rate else None
+        self.burst = burst
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate_increase = rate_increase
+        self.window = window
+        self._lock = threading.Lock()
+        self._buckets = {}
 
+    def _burst(self, rate):
+        return self.burst or max(int(rate or 1), 1)
 
+    def _bucket(self, url, now):
+        """ Bucket for a URL's host, created at the starting rate """
+        host = urlsplit(url).netloc.lower() if url else ''
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            bucket = self._buckets[host] = _Bucket(
+                self.rate, float(self._burst(self.rate)), now)
+        return bucket
 
-    .. code-block:: python
+    def current_rate(self, url=None):
+        """
+        Rate in requests per second that requests to a URL's host are
+        paced at, or None if they aren't paced
+        """
+        with self._lock:
+            return self._bucket(url, time.monotonic()).rate
 
-        # Usage Example 1: Anonymous Login to ArcGIS Online
+    def reserve(self, url=None):
+        """
+        Takes a token for one request to a URL's host and returns the number
+        of seconds the caller has to wait before sending it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._bucket(url, now)
+            if bucket.rate is None:
+                bucket.recent.append(now)
+                while bucket.recent[0] < now - self.window:
+                    bucket.recent.popleft()
+                return max(0.0, bucket.paused_until - now)
+            bucket.tokens = min(self._burst(bucket.rate), bucket.tokens +
+                                (now - bucket.updated) * bucket.rate)
+            bucket.updated = now
+            bucket.tokens -= 1
+            wait = 0.0 if bucket.tokens >= 0 else -bucket.tokens / bucket.rate
+            return max(wait, bucket.paused_until - now)
+
+    def throttled(self, retry_after=None, url=None):
+        """ Backs off after a URL's host throttled a request """
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._bucket(url, now)
+            if bucket.rate is None:
+                # Requests sent over the window, or since the first of them
+                # if that's more recent
+                recent = bucket.recent
+                elapsed = max(now - recent[0], 1.0) if recent else 1.0
+                bucket.rate = len(recent) / elapsed
+                bucket.tokens = 0.0
+                bucket.updated = now
+            if retry_after:
+                # Allow a single request when the pause is over
+                bucket.rate = max(bucket.rate, self.min_rate)
+                bucket.paused_until = max(bucket.paused_until,
+                                          now + retry_after)
+                bucket.tokens = 1.0 - (bucket.paused_until - now) * bucket.rate
+                bucket.updated = now
+            else:
+                bucket.rate = max(bucket.rate / 2, self.min_rate)
+
+    def succeeded(self, url=None):
+        """ Speeds back up after a successful request to a URL's host """
+        with self._lock:
+            bucket = self._bucket(url, time.monotonic())
+            if bucket.rate is None:
+                return
+            bucket.rate += self.rate_increase
+            if self.max_rate:
+                bucket.rate = min(bucket.rate, self.max_rate)
+
+
+class RetryPolicy(object):
     """
+    When and how long to wait before retrying a failed request: the
+    Retry-After time if the server gives one, otherwise exponential backoff
+    with full jitter.
 
-    def __init__(self, gis, title=None, workbook_id=None, workspace_id=None,
-                 workspace_url=None, props=None):
+    ================    ========================================================
+    **Argument**        **Description**
+    ----------------    --------------------------------------------------------
+    max_attempts        Optional int. Total number of attempts per request.
+    ----------------    --------------------------------------------------------
+    backoff             Optional float. Base delay in seconds; the delay before
+                        attempt n is drawn from [0, backoff * 2**n].
+    ----------------    --------------------------------------------------------
+    max_backoff         Optional float. Cap on the delay in seconds.
+    ----------------    --------------------------------------------------------
+    statuses            Optional tuple of HTTP statuses that are retried.
+                        Connection errors without a status are retried too.
+    ================    ========================================================
+    """
+
+    def __init__(self, max_attempts=5, backoff=0.5, max_backoff=30.0,
+                 statuses=RETRY_STATUSES):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = statuses
+
+    def should_retry(self, exc, attempt, idempotent=True):
         """
-        Constructs the Workbook given the aforementioned parameters. Normally,
-        the Workbook object will be created with either the new() or open()
-        class methods below.
+        Whether a request that failed with exc on the given (0-based)
+        attempt should be retried. Requests that aren't idempotent are only
+        retried when the portal turned them away with 429.
         """
-        self._gis = gis
-        self._title = title
-        self._agol = False
-        # Check whether it's AGOL or Portal
-        if gis._url.find('arcgis.com') >= 0:
-            self._agol = True
-        self._workbookID = workbook_id
-        self._workspaceID = workspace_id
-        self._workspaceURL = workspace_url
-        self.props = props
+        if attempt + 1 >= self.max_attempts:
+            return False
+        status = _error_status(exc)
+        if not idempotent:
+            return status == 429
+        if status is None:
+            return isinstance(exc, (ConnectionError, TimeoutError, OSError))
+        return status in self.statuses
 
-    @classmethod
-    def new(cls, gis, title):
+    def delay(self, attempt, retry_after=None):
         """
-        Creates a new Insights Workbook in ArcGIS using the provided title.
+        Seconds to wait before the next attempt: the Retry-After time if the
+        server gave one, otherwise the backoff
+        """
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
 
-        ==================     =================================================
-        **Argument**           **Description**
-        ------------------     -------------------------------------------------
-        gis                    Required arcgis.gis.GIS. Connection should be set
-                               up before working with this class.
-        ------------------     -------------------------------------------------
-        title                  Optional string. Title to be assigned to the new
-                               Workbook.
-        ==================     =================================================
 
-        :return:
-           New InsightsWorkbook object with the provided title.
-        """
-        # Random 8-digit hex number for ID
-        workbook_id = '%08x' % random.randrange(16**8)
+# Rate limiter shared by every transport that isn't given its own
+default_limiter = RateLimiter()
 
-        # Hosted service URL differs between Portal and AGOL
-        insights_service_url = gis._url.lower() + \
-            '/arcgis/rest/services/Hosted/'
-        if gis._url.find('arcgis.com') >= 0:
-            insights_service_url = 'https://insightsservices.arcgis.com/' +\
-                                    gis._portal._properties['id'] + \
-                                    '/arcgis/rest/services/'
-        workspace_url = insights_service_url + workbook_id + "/WorkspaceServer"
-
-        # Path for REST API to create new Workspace Service (ArcGIS Insights
-        # internal data storage)
-        path = gis._portal.url + '/sharing/rest/content/users/' + \
-            gis.users.me.username + '/createService'
-        post_data = {'f': 'json',
-                     'createParameters': '{"name": "' + workbook_id + '"}',
-                     'targetType': 'workspaceService'}
-        # Catch any errors from POSTing
-        try:
-            # The first call creates the workspace, but the Workbook is not
-            # functional until after the second POST below
-            resp = gis._portal.con.post(path, post_data)
-            # Depending on whether it's on Portal or AGOL, it will use a
-            # different key for ID.
-            if gis._url.find('arcgis.com') < 0:
-                workspace_id = resp['itemId']
-            else:
-                workspace_id = resp['serviceItemId']
-
-            item_props = {
-                "f": "json",
-                "id": workspace_id,
-                "type": "Insights Workbook",
-                "title": title}
-            # For some reason this is not needed for Portal, but it is for AGOL
-            if gis._url.find('arcgis.com') >= 0:
-                item_props["url"] = workspace_url
-
-            # Full set of default JSON data properties for an ArcGIS Insights
-            # workbook item.
-            props = {
-                "format": 9,
-                "title": title,
-                "pages": [{
-                    "title": "Page 1",
-                    "model": {
-                        "items": []
-                    },
-                    "cards": [],
-                    "layout": [],
-                    "contents": []
-                }],
-                "activePage": 0,
-                "workspace": {
-                    "datasets": {}
-                },
-                "_ssl": True,
-                "created": 0,
-                "modified": 0,
-                "guid": None,
-                "type": "Insights Workbook",
-                "typeKeywords": ["Application", "ArcGIS",
-                                 "Insights Workbook", "Hosted Service"],
-                "description": None,
-                "tags": [],
-                "snippet": None,
-                "thumbnail": None,
-                "documentation": None,
-                "extent": [],
-                "categories": [],
-                "spatialReference": None,
-                "accessInformation": None,
-                "licenseInfo": None,
-                "culture": "english (united states)",
-                "properties": None,
-                "proxyFilter": None,
-                "access": "private",
-                "size": 0,
-                "appCategories": [],
-                "industries": [],
-                "languages": [],
-                "largeThumbnail": None,
-                "banner": None,
-                "screenshots": [],
-                "listed": False,
-                "ownerFolder": None,
-                "protected": False,
-                "commentsEnabled": True,
-                "numComments": 0,
-                "numRatings": 0,
-                "avgRating": 0,
-                "numViews": 3,
-                "itemControl": "admin",
-                "scoreCompleteness": 0,
-                "groupDesignations": None
-            }
-            # After the first call sets up the workspace, this second call sets
-            # up the actual Workbook with all the data props, title, etc.
-            gis._portal.update_item(workspace_id, item_props,
-                                           json.dumps(props))
-            # Now that it's created, store the relevant properties in this class
-            # for use in other functions (e.g. add data, create map, etc.)
-            return cls(gis, title, workbook_id,
-                       workspace_id, workspace_url, props)
-        except:
-            print("Error creating workbook: " + sys.exc_info()[0])
-            raise Exception()
 
-    @classmethod
-    def open(cls, existing_workbook):
-        """
-        Creates a new Insights Workbook in ArcGIS using the provided title.
+class Transport(object):
+    """
+    Sends InsightsWorkbook's blocking REST calls through a shared
+    RateLimiter, which paces each host separately, retrying failures
+    according to a RetryPolicy. Each retry resends exactly the same request
+    (same outDataset names, same item text), so a retried execute or item
+    update has the same effect as a single successful one.
 
-        ==================     =================================================
-        **Argument**           **Description**
-        ------------------     -------------------------------------------------
-        gis                    Required arcgis.gis.Item. Must pass a previously-
-                               created ArcGIS Insights Workbook. The ArcGIS API
-                               for Python Item object should be of the
-                               "Insights Workbook" type.
-        ==================     =================================================
+    ================    ========================================================
+    **Argument**        **Description**
+    ----------------    --------------------------------------------------------
+    limiter             Optional RateLimiter. Defaults to default_limiter,
+                        which is shared by the whole process.
+    ----------------    --------------------------------------------------------
+    retry               Optional RetryPolicy.
+    ================    ========================================================
+    """
 
-        :return:
-           InsightsWorkbook object that points to this existing Workbook
-        """
-        gis = existing_workbook._gis
-        title = existing_workbook.title
-        workbook_id = existing_workbook.name
-        # Hosted service URL differs between Portal and AGOL
-        insights_service_url = gis._url.lower() + \
-            '/arcgis/rest/services/Hosted/'
-        if gis._url.find('arcgis.com') >= 0:
-            insights_service_url = 'https://insightsservices.arcgis.com/' +\
-                                    gis._portal._properties['id'] + \
-                                    '/arcgis/rest/services/'
-        workspace_url = insights_service_url + workbook_id + "/WorkspaceServer"
-        workspace_id = existing_workbook.id
-        # Path to get the JSON data for this Workbook item
-        path = gis._url.lower() + '/sharing/rest/content/items/' + \
-            workspace_id + '/data'
-        try:
-            resp = gis._portal.con.get(path, {'f': 'json'})
-            props = resp
-            return cls(gis, title, workbook_id,
-                       workspace_id, workspace_url, props)
-        except:
-            print("Error retrieving workbook data: " + sys.exc_info()[0])
-            raise Exception()
+    def __init__(self, limiter=None, retry=None):
+        self.limiter = limiter or default_limiter
+        self.retry = retry or RetryPolicy()
 
-    def add_feature_layer(self, lyr, sublayer=0):
+    def call(self, operation, url, payload, call, workbook=None,
+             idempotent=True):
         """
-        Adds a feature layer as a dataset to this Workbook
+        Makes a blocking portal call, pacing and retrying it, and returns
+        its response.
+        """
+        attempt = 0
+        while True:
+            wait = self.limiter.reserve(url)
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                resp = _traced(operation, url, payload, call, workbook)
+            except Exception as e:
+                retry_after = self._failed(e, url)
+                if not self.retry.should_retry(e, attempt, idempotent):
+                    raise
+                time.sleep(self.retry.delay(attempt, retry_after))
+                attempt += 1
+                continue
+            self.limiter.succeeded(url)
+            return resp
 
-        ==================     =================================================
-        **Argument**           **Description**
-        ------------------     -------------------------------------------------
-        lyr                    Required arcgis.gis.Item. Must pass a feature
-                               layer from the ArcGIS API for Python.
-        ------------------     -------------------------------------------------
-        sublayer               Optional int. Index of the sublayer to add.
-        ==================     =================================================
-        :return:
-           String name of new internal Insights Workbook dataset
+    def _failed(self, exc, url):
         """
-        # Random 7-digit hex suffix for dataset name
-        dataset_name = lyr.title + '_%07x' % random.randrange(16**7)
-        post_data = {'f': 'json',
-                     'tools': '[{"name":"add-data","params":{"data":{' +
-                              '"type":"feature-layer",' +
-                              '"url":"' + lyr.url + '/' + str(sublayer) +
-                              '"}},"outDataset":"' + dataset_name + '"}]',
-                     'outDatasets': '["' + dataset_name + '"]'}
-        try:
-            # Execute the add-data operation within ArcGIS Insights. Note: data
-            # is not automatically saved in the Workbook. Must manually call
-            # save in order to make it permanent.
-            resp = self._gis._portal.con.post(self._workspaceURL + '/execute',
-                                              post_data)
-
-            # In addition to calling execute to create the dataset, it must also
-            # be placed in the Workbook Item properties in several places:
-            self.props['pages'][0]['model']['items'].append({
-                'operation': 'add-data',
-                'params': {
-                    'data': {
-                        'type': 'feature-layer',
-                        'url': lyr.url + '/' + str(sublayer)
-                    }
-                },
-                'outDataset': dataset_name
-            })
-            self.props['pages'][0]['contents'].append({
-                'dataset': dataset_name
-            })
-            my_extent = json.loads(lyr.layers[sublayer].properties.extent.__repr__())
-            self.props['workspace']['datasets'][dataset_name] = {
-                'data': resp[dataset_name],
-                'owner': lyr.id,
-                'fields': {
-                    'shape': {
-                        'alias': 'Location'
-                    }
-                },
-                'extent': my_extent,
-                'origin': True
-            }
-            return dataset_name
-        except:
-            print("Error adding feature layer: " + sys.exc_info()[0])
-            raise Exception()
+        Tells the limiter about throttling and returns the Retry-After time
+        """
+        retry_after = _retry_after(exc)
+        if _error_status(exc) in _THROTTLE_STATUSES:
+            self.limiter.throttled(retry_after, url)
+        return retry_after
 
-    def update_dataset(self, lyr, sublayer=0):
+
+class RequestStats(object):
+    """
+    Request hook that aggregates Spans into per-operation (or per-host, or
+    per-workbook) latency percentiles, request counts and bytes. Register it
+    with add_request_hook().
+
+    .. code-block:: python
+
+        stats = RequestStats()
+        add_request_hook(stats)
+        refresh_workbooks(lyr, workbook_items)
+        print(stats.summary(by='host'))
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans = []
+
+    def __call__(self, span):
+        with self._lock:
+            self._spans.append(span)
+
+    def reset(self):
+        """ Discards all recorded spans """
+        with self._lock:
+            self._spans = []
+
+    def summary(self, by='operation'):
         """
-        Updates all references to the provided feature layer within this
-        Workbook
+        Returns a dict of statistics for each value of a Span field.
 
         ==================     =================================================
         **Argument**           **Description**
         ------------------     -------------------------------------------------
-        lyr                    Required arcgis.gis.Item. Must pass a feature
-                               layer from the ArcGIS API for Python.
-        ------------------     -------------------------------------------------
-        sublayer               Optional int. Index of the sublayer to add.
+        by                     Optional string. Span field to group by, e.g.
+                               operation, host or workbook.
         ==================     =================================================
         :return:
-           String name of internal Insights Workbook dataset
+           Dict of group to a dict with count, errors, p50, p95 and p99
+           latency in seconds, request_bytes and response_bytes
         """
-        # Get the current Workbook model items
-        model_items = self.props['pages'][0]['model']['items']
-        # Find the specific model item related to adding this dataset
-        add_op = [x for x in model_items if ('outDataset' in x and
-            'params' in x and
-            'data' in x['params'] and
-            'url' in x['params']['data'] and
-            x['params']['data']['url'].find(lyr.url) >= 0)]
-        # Check to see if this layer actually exists in this workbook
-        if len(add_op) > 0:
-            # Get internal name of this dataset
-            dataset_name = add_op[0]['outDataset']
-            post_data = {'f': 'json',
-                         'tools': '[{"name":"add-data","params":{"data":{' +
-                                  '"type":"feature-layer",' +
-                                  '"url":"' + add_op[0]['params']['data']['url'] +
-                                  '"}},"outDataset":"' + dataset_name + '"}]',
-                         'outDatasets': '["' + dataset_name + '"]'}
-            try:
-                # Execute the add-data operation within ArcGIS Insights. This
-                # runs identically to the add data operation - it just
-                # generates a new data ID for us to work with.
-                resp = self._gis._portal.con.post(self._workspaceURL +
-                                                  '/execute', post_data)
-                old_data = self.props['workspace']['datasets'][dataset_name]['data']
-                # Update existing workspace entry in JSON with new data ID
-                my_extent = json.loads(lyr.layers[sublayer].properties.extent.__repr__())
-                self.props['workspace']['datasets'][dataset_name] = {
-                    'data': resp[dataset_name],
-                    'owner': lyr.id,
-                    'fields': {
-                        'shape': {
-                            'alias': 'Location'
-                        }
-                    },
-                    'extent': my_extent,
-                    'origin': True
-                }
-                # Find all references to old data ID and replace with new
-                for ds in self.props['workspace']['datasets'].keys():
-                    try:
-                        ds_tools = self.props['workspace']['datasets'][ds]['data']['tools']
-                        for i in range(len(ds_tools)):
-                            if self.props['workspace']['datasets'][ds]['data']['tools'][i]['params']['dataset'] == old_data:
-                                self.props['workspace']['datasets'][ds]['data']['tools'][i]['params']['dataset'] = resp[dataset_name]
-                    except (KeyError, TypeError):
-                        # If particular dataset doesn't have this key, move to
-                        # next.
-                        continue
-                # Send back the dataset name
-                return dataset_name
-            except HTTPError:
-                print("Error updating feature layer: " + sys.exc_info()[0])
-        else:
-            print("Layer does not exist within this Workbook")
-            raise Exception()
+        with self._lock:
+            spans = list(self._spans)
+        groups = {}
+        for span in spans:
+            groups.setdefault(getattr(span, by), []).append(span)
+        summary = {}
+        for key, group in groups.items():
+            latencies = sorted(x.latency for x in group)
+            summary[key] = {
+                'count': len(group),
+                'errors': sum(1 for x in group if x.error is not None),
+                'p50': _percentile(latencies, 50),
+                'p95': _percentile(latencies, 95),
+                'p99': _percentile(latencies, 99),
+                'request_bytes': sum(x.request_bytes for x in group),
+                'response_bytes': sum(x.response_bytes for x in group)}
+        return summary
 
-    def add_map(self, dataset):
-        """
-        Adds a map card for the specified feature layer dataset
 
-        ==================     =================================================
-        **Argument**           **Description**
-        ------------------     -------------------------------------------------
-        dataset                Required string. Internal dataset name for the
-                               feature layer to add to the map. Can get this
-                               value when feature layer is added to the
-                               Workbook. Alternatively, can look it up in the
-                               props.
-        ==================     =================================================
-        """
-        # Grab full dataset info from the props
-        layer_dataset = self.props['workspace']['datasets'][dataset]
-        if layer_dataset:
-            # Get current number of cards
-            card_ct = len(self.props['pages'][0]['cards'])
-            # Get extent of this layer
-            my_extent = self.props['workspace']['datasets'][dataset]['extent']
-            # Add map, with layer and extent
-            self.props['pages'][0]['cards'].append({
-                'type': 'map',
-                'title': 'Card ' + str(card_ct+1),
-                'content': {
-                    'layers': [{'datasetId': dataset}],
-                    'extent': my_extent
-                }
-            })
-            # Just place new map to the right of the last card
-            layout_x = card_ct * 20 + card_ct
-            self.props['pages'][0]['layout'].append({
-                "x": layout_x,
-                "y": 0,
-                "w": 20,
-                "h": 20
-            })
-        else:
-            print("Invalid dataset name")
-            raise Exception()
+def _percentile(values, percent):
+    """ Nearest-rank percentile of a sorted list """
+    if not values:
+        return None
+    rank = max(int(-(-percent * len(values) // 100)), 1)
+    return values[rank - 1]
 
-    def aggregate(self, in_dataset, groupby_field, groupby_field_type,
-                  stat_type, stat_field, stat_field_type, out_name=None):
-        """
-        Aggregates data based on the group-by layer using the specified
-        statistic over the specified field.
 
-        ==================     =================================================
-        **Argument**           **Description**
-        ------------------     -------------------------------------------------
+def _layer_and_sublayer(layer, sublayer):
+    """
+    Splits a layers list entry into its feature layer Item and sublayer index.
+    Entries can be either an Item or an (Item, sublayer) tuple.
+    """
+    if isinstance(layer, tuple):
+        return layer
+    return layer, sublayer
+
+
+def _layer_entries(layers):
+    """
+    Returns a layers argument as a list of entries. It can be a single entry
+    (an Item or an (Item, sublayer) tuple), or a list or tuple of entries.
+    """
+    if isinstance(layers, tuple) and len(layers) == 2 and \
+            isinstance(layers[1], int) and not isinstance(layers[1], bool):
+        return [layers]
+    if isinstance(layers, (list, tuple)):
+        return list(layers)
+    return [layers]
+
+
+def _add_data_tool(url, dataset_name):
+    """ Builds a WorkspaceServer add-data tool for a feature layer URL """
+    return {
+        'name': 'add-data',
+        'params': {
+            'data': {
+                'type': 'feature-layer',
+                'url': url
+            }
+        },
+        'outDataset': dataset_name
+    }
+
+
+def _execute_requests(sources, chunk_size):
+    """
+    Packs add-data tools for a list of (url, dataset name) pairs into the
+    POST data of execute calls, chunk_size tools per call.
+    """
+    tools = [_add_data_tool(url, dataset_name)
+             for url, dataset_name in sources]
+    # Don't send anything if part of the request would be rejected
+    workbook_validator.validate_tools(tools)
+    requests = []
+    for i in range(0, len(tools), chunk_size):
+        chunk = tools[i:i + chunk_size]
+        requests.append({
+            'f': 'json',
+            'tools': json.dumps(chunk),
+            'outDatasets': json.dumps([x['outDataset'] for x in chunk])})
+    return requests
+
+
+def _data_key(data):
+    """
+    Returns a hashable key for a dataset's data value. Data IDs returned by
+    execute are used as-is; derived data objects (dicts of tools) are keyed
+    by their canonical JSON encoding.
+    """
+    if isinstance(data, (dict, list)):
+        return json.dumps(data, sort_keys=True)
+    return data
+
+
+def _aggregate_key(item):
+    """
+    Returns the canonical (dataset, group-by fields, statistics) parameters
+    of an aggregate model item, or None if it isn't an aggregation.
+    """
+    try:
+        if item['operation'] != 'aggregate':
+            return None
+        params = item['params']
+        item['outDataset']
+        return (params['dataset'], tuple(params['groupBy']),
+                tuple((x['type'], x['field']) for x in params['statistics']))
+    except (KeyError, TypeError):
+        return None
+
+
+def _aggregate_out_field(stat_type, stat_field, stat_field_type):
+    """
+    Returns the name and type of the field an aggregation statistic is
+    stored in.
+    """
+    out_field = stat_field.lower() + '_' + stat_type
+    if stat_type == 'count':
+        out_type = 'esriFieldTypeInteger'
+    elif stat_type == 'avg':
+        out_type = 'esriFieldTypeDouble'
+    else:
+        out_type = stat_field_type
+    return out_field, out_type
+
+
+def _aggregate_metadata_fields(groupby_field, groupby_field_type, out_field,
+                               out_type):
+    """ Builds the metadata.fields schema recorded for an aggregation """
+    return [
+        {
+            'name': groupby_field,
+            'alias': groupby_field,
+            'type': groupby_field_type,
+            'entity': 'e0'
+        },
+        {
+            'name': out_field,
+            'alias': out_field,
+            'type': out_type
+        }
+    ]
+
+
+def _service_url(url):
+    """ Strips a trailing /<sublayer> index off of a feature layer URL """
+    base, _, last = url.rstrip('/').rpartition('/')
+    if base and last.isdigit():
+        return base
+    return url
+
+
+def _plain(value):
+    """
+    Converts layer properties (PropertyMap objects from the ArcGIS API for
+    Python) into plain dicts and lists, recursively.
+    """
+    if hasattr(value, 'keys'):
+        return {k: _plain(value[k]) for k in value.keys()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(x) for x in value]
+    return value
+
+
+class LayerMetadataCache(object):
+    """
+    Memoizes feature layer properties (extent, fields, etc.) as plain dicts,
+    so adding or refreshing the same layer in many workbooks only fetches
+    its properties once. Entries expire after ttl seconds, and can be
+    invalidated explicitly, e.g. after a layer is overwritten. The
+    module-level layer_metadata instance is shared by every InsightsWorkbook
+    in the process.
+
+    ================    ========================================================
+    **Argument**        **Description**
+    ----------------    --------------------------------------------------------
+    ttl                 Optional number. Seconds before cached properties are
+                        fetched again.
+    ================    ========================================================
+
+    Threads that need the same layer's properties while they're being
+    fetched wait for that fetch rather than making their own.
+    """
+
+    def __init__(self, ttl=LAYER_METADATA_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        # Key to the Future of the fetch in progress
+        self._pending = {}
+
+    def properties(self, lyr, sublayer=0, workbook=None):
+        """
+        Returns the properties of a feature layer's sublayer as a plain dict,
+        fetching them only if they aren't cached or have expired. Fetches are
+        reported to the request hooks as getLayer calls made for workbook,
+        the item ID of the workbook that needs them.
+        """
+        key = (lyr.url, sublayer)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                return entry[1]
+            pending = self._pending.get(key)
+            fetching = pending is None
+            if fetching:
+                pending = self._pending[key] = Future()
+        if not fetching:
+            return pending.result()
+        try:
+            properties = _traced(
+                'getLayer', lyr.url + '/' + str(sublayer), None,
+                lambda: _plain(lyr.layers[sublayer].properties), workbook)
+        except BaseException as e:
+            # Waiting threads get the same error
+            with self._lock:
+                if self._pending.get(key) is pending:
+                    del self._pending[key]
+            pending.set_exception(e)
+            raise
+        with self._lock:
+            # Unless invalidated while it was being fetched
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+                self._entries[key] = (time.monotonic(), properties)
+        pending.set_result(properties)
+        return properties
+
+    def extent(self, lyr, sublayer=0, workbook=None):
+        """
+        Returns a copy of the extent of a feature layer's sublayer as a plain
+        dict, safe to store in a workbook's props.
+        """
+        return copy.deepcopy(
+            self.properties(lyr, sublayer, workbook).get('extent'))
+
+    def invalidate(self, lyr=None):
+        """
+        Drops the cached properties of every sublayer of a feature layer, or
+        of all layers if none is given.
+        """
+        with self._lock:
+            if lyr is None:
+                self._entries.clear()
+                self._pending.clear()
+            else:
+                for key in [x for x in self._entries if x[0] == lyr.url]:
+                    del self._entries[key]
+                for key in [x for x in self._pending if x[0] == lyr.url]:
+                    del self._pending[key]
+
+
+# Layer metadata cache shared by all workbooks in this process
+layer_metadata = LayerMetadataCache()
+
+
+def _extent_family(extent):
+    """
+    Returns 'geographic' or 'mercator' for extents in WGS 84 or Web
+    Mercator, which can be converted between, or the extent's wkid otherwise.
+    """
+    sr = extent.get('spatialReference') or {}
+    wkid = sr.get('latestWkid') or sr.get('wkid')
+    if wkid in _GEOGRAPHIC_WKIDS:
+        return 'geographic'
+    if wkid in _MERCATOR_WKIDS:
+        return 'mercator'
+    return wkid
+
+
+def _project(x, y, source, target):
+    """
+    Converts coordinates from the source to the target spatial reference
+    family. Works on whole numpy arrays at once, or on floats if numpy isn't
+    installed.
+    """
+    if source == target:
+        return x, y
+    if {source, target} != {'geographic', 'mercator'}:
+        raise InsightsWorkbookError('Can\'t convert extents from spatial '
+                                    'reference ' + str(source) + ' to ' +
+                                    str(target))
+    m = np if np is not None else math
+    if target == 'mercator':
+        if np is not None:
+            y = np.clip(y, -_MERCATOR_MAX_LAT, _MERCATOR_MAX_LAT)
+        else:
+            y = max(-_MERCATOR_MAX_LAT, min(_MERCATOR_MAX_LAT, y))
+        return (m.radians(x) * _EARTH_RADIUS,
+                m.log(m.tan(math.pi / 4 + m.radians(y) / 2)) * _EARTH_RADIUS)
+    atan = np.arctan if np is not None else math.atan
+    return (m.degrees(x / _EARTH_RADIUS),
+            m.degrees(2 * atan(m.exp(y / _EARTH_RADIUS)) - math.pi / 2))
+
+
+def _finite_extent(extent):
+    """
+    Whether an extent is a dict with finite numbers for all of its bounds.
+    Layers without features report extents of NaN or null.
+    """
+    if not isinstance(extent, _JSON_OBJECT):
+        return False
+    for key in ('xmin', 'ymin', 'xmax', 'ymax'):
+        value = extent.get(key)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) \
+                or not math.isfinite(value):
+            return False
+    return True
+
+
+def _region_extent(region):
+    """
+    Returns a region given as an extent dict, or as an (xmin, ymin, xmax,
+    ymax) tuple in WGS 84, as an extent dict
+    """
+    if isinstance(region, _JSON_OBJECT):
+        return region
+    xmin, ymin, xmax, ymax = region
+    return {'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax,
+            'spatialReference': {'wkid': 4326}}
+
+
+def _extent_boxes(extents, target):
+    """
+    Returns the (xmin, ymin, xmax, ymax) boxes of a list of extents in the
+    target spatial reference family, as an n by 4 numpy array, or a list of
+    tuples if numpy isn't installed.
+    """
+    families = [_extent_family(x) for x in extents]
+    if np is None:
+        boxes = []
+        for extent, family in zip(extents, families):
+            xmin, ymin = _project(extent['xmin'], extent['ymin'], family,
+                                  target)
+            xmax, ymax = _project(extent['xmax'], extent['ymax'], family,
+                                  target)
+            boxes.append((xmin, ymin, xmax, ymax))
+        return boxes
+    boxes = np.array([[x['xmin'], x['ymin'], x['xmax'], x['ymax']]
+                      for x in extents], dtype=float).reshape(-1, 4)
+    families = np.array(families, dtype=object)
+    for family in set(families.tolist()):
+        if family == target:
+            continue
+        rows = families == family
+        boxes[rows, 0], boxes[rows, 1] = _project(
+            boxes[rows, 0], boxes[rows, 1], family, target)
+        boxes[rows, 2], boxes[rows, 3] = _project(
+            boxes[rows, 2], boxes[rows, 3], family, target)
+    return boxes
+
+
+def extent_union(extents, spatial_reference=None):
+    """
+    Returns the smallest extent containing all of the given extents (dicts
+    with xmin, ymin, xmax, ymax and spatialReference, as stored for workbook
+    datasets). Extents in WGS 84 and Web Mercator are converted to a common
+    spatial reference first; extents in any other spatial reference have to
+    all be in the same one. Extents that are None, or don't have finite
+    bounds (as reported for empty layers), are left out. The bounds are
+    computed over all the extents at once with numpy, if it's installed.
+
+    ==================     =================================================
+    **Argument**           **Description**
+    ------------------     -------------------------------------------------
+    extents                Required list of extent dicts.
+    ------------------     -------------------------------------------------
+    spatial_reference      Optional dict. Spatial reference of the result,
+                           e.g. {'wkid': 4326}. Defaults to that of the
+                           first extent.
+    ==================     =================================================
+    :return:
+       Extent dict, or None if there are no extents with finite bounds
+    """
+    extents = [x for x in extents if _finite_extent(x)]
+    if not extents:
+        return None
+    if spatial_reference is None:
+        spatial_reference = extents[0].get('spatialReference')
+    target = _extent_family({'spatialReference': spatial_reference})
+    boxes = _extent_boxes(extents, target)
+    if np is not None:
+        bounds = [float(boxes[:, 0].min()), float(boxes[:, 1].min()),
+                  float(boxes[:, 2].max()), float(boxes[:, 3].max())]
+    else:
+        bounds = [min(x[0] for x in boxes), min(x[1] for x in boxes),
+                  max(x[2] for x in boxes), max(x[3] for x in boxes)]
+    extent = dict(zip(('xmin', 'ymin', 'xmax', 'ymax'), bounds))
+    if spatial_reference is not None:
+        extent['spatialReference'] = copy.deepcopy(spatial_reference)
+    return extent
+
+
+class ExtentIndex(object):
+    """
+    In-memory R-tree over the extents of a workbook's datasets, for finding
+    the datasets that intersect a region. Extents are converted to WGS 84
+    and bulk loaded Sort-Tile-Recursive style: sorted into vertical strips
+    by their center x, then by center y within each strip, and packed
+    node_size to a leaf, with each higher level packing node_size nodes of
+    the level below. A query only descends into the nodes whose bounds
+    intersect the region.
+
+    ================    ========================================================
+    **Argument**        **Description**
+    ----------------    --------------------------------------------------------
+    extents             Required dict of dataset name to extent.
+    ----------------    --------------------------------------------------------
+    node_size           Optional int. Maximum number of entries in a node.
+    ================    ========================================================
+
+    Datasets whose extents are in a spatial reference that can't be
+    converted to WGS 84, or don't have finite bounds, aren't indexed, and
+    are listed in skipped.
+    """
+
+    def __init__(self, extents, node_size=16):
+        self.node_size = node_size
+        self.skipped = []
+        names = []
+        usable = []
+        for name, extent in extents.items():
+            if _finite_extent(extent) and \
+                    _extent_family(extent) in ('geographic', 'mercator'):
+                names.append(name)
+                usable.append(extent)
+            else:
+                self.skipped.append(name)
+        boxes = [tuple(float(v) for v in box)
+                 for box in _extent_boxes(usable, 'geographic')]
+        order = self._str_order(boxes)
+        self.names = [names[i] for i in order]
+        # Bounds of the entries (level 0) and of the nodes of each level
+        # above, where node i of a level holds entries i * node_size up to
+        # (i + 1) * node_size of the level below
+        self._levels = [[boxes[i] for i in order]]
+        while len(self._levels[-1]) > 1:
+            below = self._levels[-1]
+            self._levels.append([
+                self._bounds(below[i:i + node_size])
+                for i in range(0, len(below), node_size)])
+
+    def __len__(self):
+        return len(self.names)
+
+    def _str_order(self, boxes):
+        """ Sort-Tile-Recursive order of the entries """
+        order = sorted(range(len(boxes)),
+                       key=lambda i: boxes[i][0] + boxes[i][2])
+        leaves = -(-len(boxes) // self.node_size)
+        strips = max(1, int(math.ceil(math.sqrt(leaves))))
+        strip_size = strips * self.node_size
+        packed = []
+        for start in range(0, len(order), strip_size):
+            packed.extend(sorted(order[start:start + strip_size],
+                                 key=lambda i: boxes[i][1] + boxes[i][3]))
+        return packed
+
+    @staticmethod
+    def _bounds(boxes):
+        return (min(x[0] for x in boxes), min(x[1] for x in boxes),
+                max(x[2] for x in boxes), max(x[3] for x in boxes))
+
+    def intersecting(self, region):
+        """
+        Returns the names of the datasets whose extents intersect a region,
+        given as an extent dict or an (xmin, ymin, xmax, ymax) tuple in WGS
+        84.
+        """
+        if not self.names:
+            return []
+        xmin, ymin, xmax, ymax = (
+            float(v) for v in _extent_boxes([_region_extent(region)],
+                                            'geographic')[0])
+        candidates = [0]
+        for level in range(len(self._levels) - 1, -1, -1):
+            boxes = self._levels[level]
+            found = [i for i in candidates
+                     if boxes[i][0] <= xmax and boxes[i][2] >= xmin and
+                     boxes[i][1] <= ymax and boxes[i][3] >= ymin]
+            if level == 0:
+                return [self.names[i] for i in found]
+            size = len(self._levels[level - 1])
+            candidates = [child for i in found
+                          for child in range(i * self.node_size,
+                                             min((i + 1) * self.node_size,
+                                                 size))]
+
+
+class WorkbookSession(object):
+    """
+    Portal context shared by the workbooks opened or created through it. The
+    portal ID, signed in username, hosted service URL and whether the GIS is
+    ArcGIS Online or Portal are each looked up once, the first time they're
+    needed, rather than once per workbook or per request. Given a pool_size,
+    the session also keeps a pool of keep-alive HTTP connections per host
+    (the portal, and insightsservices.arcgis.com on ArcGIS Online) on the
+    GIS connection, sized for the number of workbooks worked on
+    concurrently. The session only holds a weak reference to the GIS.
+
+    ================    ========================================================
+    **Argument**        **Description**
+    ----------------    --------------------------------------------------------
+    gis                 Required arcgis.gis.GIS. Connection should be set up
+                        before working with this class.
+    ----------------    --------------------------------------------------------
+    transport           Optional Transport used for REST calls by the
+                        workbooks of this session.
+    ----------------    --------------------------------------------------------
+    pool_size           Optional int. Maximum number of connections kept open
+                        to each host. By default the GIS connection's own
+                        adapters are left as they are. Connection pooling
+                        needs the requests session behind the GIS connection,
+                        and is skipped if it isn't available. Hosts served
+                        by a custom adapter (e.g. for PKI or custom SSL) keep
+                        it.
+    ----------------    --------------------------------------------------------
+    compress            Optional bool. Send workbook uploads gzip-compressed,
+                        through the requests session behind the GIS
+                        connection, with its token. Only for servers that
+                        accept compressed request bodies; if a compressed
+                        upload is turned away, by the server or a proxy, it's
+                        resent uncompressed through the GIS connection, and
+                        if that goes through, compression is turned off for
+                        the session.
+    ================    ========================================================
+    """
+
+    def __init__(self, gis, transport=None, pool_size=None,
+                 compress=False):
+        # Shared sessions are kept by GIS, so the GIS mustn't be kept alive
+        # by its session
+        try:
+            self._gis = weakref.ref(gis)
+        except TypeError:
+            self._gis = lambda: gis
+        self.transport = transport or Transport()
+        self.pool_size = pool_size
+        self.compress = compress
+        self._lock = threading.Lock()
+        self._context = {}
+        self._hits = 0
+        self._misses = 0
+        # Mounted connection adapters by host
+        self._adapters = {}
+        self._mount_pools()
+
+    @property
+    def gis(self):
+        """ The arcgis.gis.GIS of this session """
+        return self._gis()
+
+    @classmethod
+    def of(cls, gis):
+        """
+        Returns the session shared by everything using this GIS that didn't
+        pass its own, creating it on first use.
+        """
+        with _sessions_lock:
+            try:
+                session = _sessions.get(gis)
+            except TypeError:
+                # Can't be weakly referenced, so can't be shared either
+                return cls(gis)
+            if session is None:
+                session = _sessions[gis] = cls(gis)
+            return session
+
+    def _lookup(self, name, resolve):
+        """ Returns a memoized context value, resolving it on first use """
+        with self._lock:
+            if name in self._context:
+                self._hits += 1
+                return self._context[name]
+            self._misses += 1
+        # Resolved outside the lock, since it may be a request; if two threads
+        # race, the first value stored wins
+        value = resolve()
+        with self._lock:
+            return self._context.setdefault(name, value)
+
+    @property
+    def agol(self):
+        """ True if the GIS is ArcGIS Online, False if it's Portal """
+        return self._lookup('agol',
+                            lambda: self.gis._url.find('arcgis.com') >= 0)
+
+    @property
+    def portal_id(self):
+        """ ID of the portal (the organization ID on ArcGIS Online) """
+        return self._lookup('portal_id',
+                            lambda: self.gis._portal._properties['id'])
+
+    @property
+    def username(self):
+        """ Username of the signed in user """
+        return self._lookup('username',
+                            lambda: self.gis.users.me.username)
+
+    @property
+    def sharing_url(self):
+        """ Base URL of the portal's sharing REST API """
+        return self._lookup('sharing_url', lambda: self.gis._url.lower() +
+                            '/sharing/rest/content/')
+
+    @property
+    def service_url(self):
+        """ Base URL of the hosted services that store workbooks' data """
+        return self._lookup('service_url', self._resolve_service_url)
+
+    def _resolve_service_url(self):
+        # Hosted service URL differs between Portal and AGOL
+        if self.agol:
+            return _INSIGHTS_SERVICES + self.portal_id + \
+                '/arcgis/rest/services/'
+        return self.gis._url.lower() + '/arcgis/rest/services/Hosted/'
+
+    def workspace_url(self, workbook_id):
+        """ URL of the WorkspaceServer behind a workbook's hosted storage """
+        return self.service_url + workbook_id + "/WorkspaceServer"
+
+    def create_service_request(self, workbook_id):
+        """
+        Returns the URL and POST data that create a new Workspace Service
+        (ArcGIS Insights internal data storage) for a workbook.
+        """
+        path = self.gis._portal.url + '/sharing/rest/content/users/' + \
+            self.username + '/createService'
+        post_data = {'f': 'json',
+                     'createParameters': '{"name": "' + workbook_id + '"}',
+                     'targetType': 'workspaceService'}
+        return path, post_data
+
+    def created_item_id(self, resp):
+        """ Returns the item ID from a createService response """
+        # Depending on whether it's on Portal or AGOL, it will use a different
+        # key for ID.
+        if not self.agol:
+            return resp['itemId']
+        return resp['serviceItemId']
+
+    def new_item_props(self, workspace_id, title, workspace_url):
+        """ Item properties set on a newly created workbook item """
+        item_props = {
+            "f": "json",
+            "id": workspace_id,
+            "type": "Insights Workbook",
+            "title": title}
+        # For some reason this is not needed for Portal, but it is for AGOL
+        if self.agol:
+            item_props["url"] = workspace_url
+        return item_props
+
+    def item_data_url(self, workspace_id):
+        """ Path to get the JSON data for a Workbook item """
+        return self.sharing_url + 'items/' + workspace_id + '/data'
+
+    def item_info_url(self, workspace_id):
+        """
+        Path to get the item properties (modified time, etc.) of a Workbook
+        """
+        return self.sharing_url + 'items/' + workspace_id
+
+    def item_update_url(self, workspace_id):
+        """ Path of the standard ArcGIS item update for a Workbook item """
+        return self.sharing_url + 'users/' + self.username + '/items/' + \
+            workspace_id + '/update'
+
+    def _requests_session(self):
+        """
+        Finds the requests.Session behind the GIS connection, or returns None
+        """
+        con = getattr(getattr(self.gis, '_portal', None), 'con', None)
+        candidates = [con]
+        for _ in range(2):
+            inner = candidates[-1]
+            candidates.append(getattr(inner, '_session', None) or
+                              getattr(inner, 'session', None))
+        for candidate in candidates:
+            if hasattr(candidate, 'mount') and hasattr(candidate, 'adapters'):
+                return candidate
+        return None
+
+    def post(self, url, data):
+        """
+        Posts a form through the GIS connection, gzip-compressed if the
+        session compresses uploads, and returns the parsed response. Form
+        values can be lists of strings that are sent joined; compressed,
+        they're compressed one at a time and never joined.
+        """
+        http = self._requests_session() if self.compress else None
+        rejected = False
+        if http is not None:
+            try:
+                return self._post_compressed(http, url, data)
+            except Exception as e:
+                status = _error_status(e)
+                # Connection errors and throttling are retried by the
+                # Transport as they are
+                if status is None or status in _THROTTLE_STATUSES:
+                    raise
+                rejected = status not in _AUTH_STATUSES
+        form = {k: ''.join(v) if isinstance(v, list) else v
+                for k, v in data.items()}
+        resp = self.gis._portal.con.post(url, form)
+        if rejected:
+            # Only the compressed upload was turned away
+            self.compress = False
+        return resp
+
+    def _post_compressed(self, http, url, data):
+        """
+        Posts a gzip-compressed form with the GIS connection's token and
+        returns the parsed response
+        """
+        con = self.gis._portal.con
+        headers = {'Content-Type': 'application/x-www-form-urlencoded',
+                   'Content-Encoding': 'gzip'}
+        # The connection adds its token to the form and, if the token is
+        # bound to one, the referer to the headers of the requests it sends
+        token = getattr(con, 'token', None)
+        if isinstance(token, str) and token:
+            data = dict(data, token=token)
+        referer = getattr(con, '_referer', None)
+        if isinstance(referer, str) and referer:
+            headers['Referer'] = referer
+        resp = http.post(url, data=_gzip_form(data), headers=headers)
+        resp.raise_for_status()
+        result = resp.json()
+        error = result.get('error') if isinstance(result, dict) else None
+        if error:
+            # Same form as the ArcGIS API for Python, so _error_status()
+            # finds the code
+            raise InsightsWorkbookError(
+                str(error.get('message')) + '\nError Code: ' +
+                str(error.get('code')))
+        return result
+
+    def _mount_pools(self):
+        """
+        Mounts a pooled connection adapter for each host used, unless pooling
+        is off or the host is served by a custom adapter
+        """
+        if HTTPAdapter is None or not self.pool_size:
+            return
+        http = self._requests_session()
+        if http is None:
+            return
+        roots = [self.gis._url, getattr(self.gis._portal, 'url', None)]
+        if self.agol:
+            roots.append(_INSIGHTS_SERVICES)
+        for root in roots:
+            if not root:
+                continue
+            parts = urlsplit(root)
+            host = parts.netloc.lower()
+            prefix = parts.scheme + '://' + host + '/'
+            if host in self._adapters:
+                continue
+            # The adapter requests would use for the host: the one with the
+            # longest matching prefix
+            matches = [x for x in http.adapters
+                       if prefix.startswith(x.lower())]
+            current = http.adapters[max(matches, key=len)] \
+                if matches else None
+            if current is not None and type(current) is not HTTPAdapter:
+                continue
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.pool_size,
+                max_retries=current.max_retries if current is not None
+                else 0)
+            http.mount(prefix, adapter)
+            self._adapters[host] = adapter
+
+    def stats(self):
+        """
+        Returns a dict of the number of context lookups answered from the
+        session ('hits') and resolved ('misses'), and under 'pools', the
+        number of connections opened and requests sent to each host whose
+        connections are pooled. Requests beyond the connections opened reused
+        a kept-alive connection.
+        """
+        pools = {}
+        for host, adapter in self._adapters.items():
+            connections = requests = 0
+            manager = adapter.poolmanager
+            for key in list(manager.pools.keys()):
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                connections += pool.num_connections
+                requests += pool.num_requests
+            pools[host] = {'connections': connections, 'requests': requests}
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses,
+                    'pools': pools}
+
+
+def _gzip_form(data, slice_size=65536):
+    """
+    URL-encodes and gzip-compresses a form, a slice of each value at a time,
+    so the uncompressed body is never held in memory as a whole. Values can
+    be lists of strings, which are compressed one after another as if they
+    were joined.
+    """
+    compressor = zlib.compressobj(wbits=31)
+    body = []
+    for i, (key, value) in enumerate(data.items()):
+        body.append(compressor.compress(
+            (('&' if i else '') + quote_plus(key) + '=').encode('ascii')))
+        for chunk in value if isinstance(value, list) else [str(value)]:
+            for start in range(0, len(chunk), slice_size):
+                body.append(compressor.compress(quote_plus(
+                    chunk[start:start + slice_size]).encode('ascii')))
+    body.append(compressor.flush())
+    return b''.join(body)
+
+
+# Sessions shared by workbooks that aren't given one, by GIS
+_sessions = weakref.WeakKeyDictionary()
+_sessions_lock = threading.Lock()
+
+
+# Full set of default JSON data properties for an ArcGIS Insights workbook
+# item, built once. _default_props() copies it for each new workbook.
+_DEFAULT_PROPS = {
+    "format": WORKBOOK_FORMAT,
+    "title": None,
+    "pages": [{
+        "title": "Page 1",
+        "model": {
+            "items": []
+        },
+        "cards": [],
+        "layout": [],
+        "contents": []
+    }],
+    "activePage": 0,
+    "workspace": {
+        "datasets": {}
+    },
+    "_ssl": True,
+    "created": 0,
+    "modified": 0,
+    "guid": None,
+    "type": "Insights Workbook",
+    "typeKeywords": ["Application", "ArcGIS",
+                     "Insights Workbook", "Hosted Service"],
+    "description": None,
+    "tags": [],
+    "snippet": None,
+    "thumbnail": None,
+    "documentation": None,
+    "extent": [],
+    "categories": [],
+    "spatialReference": None,
+    "accessInformation": None,
+    "licenseInfo": None,
+    "culture": "english (united states)",
+    "properties": None,
+    "proxyFilter": None,
+    "access": "private",
+    "size": 0,
+    "appCategories": [],
+    "industries": [],
+    "languages": [],
+    "largeThumbnail": None,
+    "banner": None,
+    "screenshots": [],
+    "listed": False,
+    "ownerFolder": None,
+    "protected": False,
+    "commentsEnabled": True,
+    "numComments": 0,
+    "numRatings": 0,
+    "avgRating": 0,
+    "numViews": 3,
+    "itemControl": "admin",
+    "scoreCompleteness": 0,
+    "groupDesignations": None
+}
+
+
+def _default_props(title):
+    """
+    Default JSON data properties for a new ArcGIS Insights workbook item.
+    Shares the scalar values of _DEFAULT_PROPS and only copies its
+    containers.
+    """
+    props = dict(_DEFAULT_PROPS)
+    for key, value in props.items():
+        if isinstance(value, (list, dict)):
+            props[key] = copy.deepcopy(value)
+    props["title"] = title
+    return props
+
+
+def _default_page(title):
+    """ Empty page, as found on a new workbook """
+    page = copy.deepcopy(_DEFAULT_PROPS["pages"][0])
+    page["title"] = title
+    return page
+
+
+class JSONSerializer(object):
+    """
+    Serializer backend used to encode workbook props, built on the standard
+    library json module. Props are encoded a piece at a time (see
+    _props_chunks), so a backend only has to encode single values with
+    dumps(). Subclass it to plug in a different encoder, and assign an
+    instance to default_serializer.
+    """
+    name = 'json'
+
+    def dumps(self, value):
+        """ Serializes a single value to a JSON string """
+        return json.dumps(value)
+
+
+class OrjsonSerializer(JSONSerializer):
+    """
+    Serializer backend using orjson, which encodes several times faster
+    than the standard library. Values orjson can't encode (e.g. integers
+    over 64 bits) fall back to the standard library, and so do values
+    holding NaN or Infinity, which orjson would write as null, so a workbook
+    is saved the same whichever backend is used. Only values whose orjson
+    output contains null are searched for those.
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError('OrjsonSerializer requires orjson')
+
+    def dumps(self, value):
+        try:
+            text = orjson.dumps(value)
+        except TypeError:
+            # orjson.JSONEncodeError is a TypeError
+            return json.dumps(value)
+        if b'null' in text and _has_non_finite(value):
+            return json.dumps(value)
+        return text.decode('utf-8')
+
+
+def _has_non_finite(value):
+    """ Whether a JSON value holds a NaN or infinite float anywhere """
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, float):
+            if not math.isfinite(value):
+                return True
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+    return False
+
+
+# Serializer backend shared by every workbook, using orjson if it's installed
+default_serializer = OrjsonSerializer() if orjson is not None \
+    else JSONSerializer()
+
+
+# Parts of the props that open(lazy=True) splits into lazy containers: the
+# pages and each page, and the workspace and its datasets. Every other value
+# is kept as a span of the source text until it's accessed.
+_LAZY_PATHS = {'pages': {'*': {}}, 'workspace': {'datasets': {}}}
+
+_JSON_SPACE = re.compile(r'\s*')
+_JSON_DECODER = json.JSONDecoder()
+# A string, with any escaped characters in it
+_JSON_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+# Everything up to the next bracket, or quote that doesn't start a string
+_JSON_FILLER = re.compile(r'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*',
+                          re.DOTALL)
+# A number, true, false, null, NaN or Infinity, up to the next delimiter
+_JSON_SCALAR = re.compile(r'[^\s,:\[\]{}"]+')
+
+
+class _Raw(object):
+    """ Span of a JSON value in the source text that hasn't been parsed """
+    __slots__ = ('start', 'end')
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+
+def _skip_json(text, pos):
+    """
+    Returns the offset just past the JSON value starting at text[pos]. Only
+    the strings and brackets in the value are matched to find its end, so
+    nothing in it is decoded; it's checked when it's parsed on access.
+    """
+    first = text[pos:pos + 1]
+    if first not in ('{', '['):
+        match = (_JSON_STRING if first == '"' else _JSON_SCALAR).match(
+            text, pos)
+        if match is None:
+            raise ValueError('Expected a JSON value at offset ' + str(pos))
+        return match.end()
+    start = pos
+    depth = 0
+    while True:
+        bracket = text[pos:pos + 1]
+        if bracket in ('{', '['):
+            depth += 1
+        elif bracket in ('}', ']'):
+            depth -= 1
+            if not depth:
+                return pos + 1
+        elif bracket == '"':
+            raise ValueError('Unterminated string at offset ' + str(pos))
+        else:
+            raise ValueError('Unterminated JSON value at offset ' +
+                             str(start))
+        pos = _JSON_FILLER.match(text, pos + 1).end()
+
+
+def _scan_json(text, start, lazy):
+    """
+    Splits the JSON object or array starting at text[start] into a list of
+    (key, value) pairs - key is None for array elements - and returns it
+    along with the offset just past the container. Values at the paths in
+    lazy (see _LAZY_PATHS) are split into lazy containers in turn, and every
+    other value is left as a _Raw span.
+    """
+    members = []
+    is_object = text[start] == '{'
+    pos = _JSON_SPACE.match(text, start + 1).end()
+    if text[pos:pos + 1] in ('}', ']'):
+        return members, pos + 1
+    while True:
+        key = None
+        if is_object:
+            key, pos = _JSON_DECODER.raw_decode(text, pos)
+            pos = _JSON_SPACE.match(text, pos).end()
+            if text[pos:pos + 1] != ':':
+                raise ValueError('Expected ":" at offset ' + str(pos))
+            pos = _JSON_SPACE.match(text, pos + 1).end()
+        child = lazy.get(key, lazy.get('*')) if is_object else lazy.get('*')
+        first = text[pos:pos + 1]
+        if child is not None and first in ('{', '['):
+            child_members, end = _scan_json(text, pos, child)
+            container = LazyObject if first == '{' else LazyArray
+            value = container._from_members(text, child_members)
+        else:
+            end = _skip_json(text, pos)
+            value = _Raw(pos, end)
+        members.append((key, value))
+        pos = _JSON_SPACE.match(text, end).end()
+        separator = text[pos:pos + 1]
+        if separator in ('}', ']'):
+            return members, pos + 1
+        if separator != ',':
+            raise ValueError('Expected "," at offset ' + str(pos))
+        pos = _JSON_SPACE.match(text, pos + 1).end()
+
+
+class LazyObject(MutableMapping):
+    """
+    JSON object from a workbook opened with open(lazy=True). Its keys are
+    known up front, but each value is only parsed when it's first accessed,
+    and values that are never accessed are written back to ArcGIS as the
+    exact text they were read from.
+
+    ================    ========================================================
+    **Argument**        **Description**
+    ----------------    --------------------------------------------------------
+    text                Required string. JSON document holding the object.
+    ----------------    --------------------------------------------------------
+    start               Optional int. Offset of the object in text.
+    ----------------    --------------------------------------------------------
+    lazy                Optional dict. Keys (or '*' for any key) whose values
+                        are split into lazy containers in turn, mapped to the
+                        paths below them. Defaults to _LAZY_PATHS.
+    ================    ========================================================
+    """
+    __slots__ = ('_text', '_values', '_on_load')
+
+    def __init__(self, text, start=0, lazy=None):
+        start = _JSON_SPACE.match(text, start).end()
+        if text[start:start + 1] != '{':
+            raise ValueError('Expected a JSON object at offset ' + str(start))
+        members, _ = _scan_json(
+            text, start, _LAZY_PATHS if lazy is None else lazy)
+        self._text = text
+        self._values = dict(members)
+        self._on_load = None
+
+    @classmethod
+    def _from_members(cls, text, members):
+        obj = cls.__new__(cls)
+        obj._text = text
+        obj._values = dict(members)
+        obj._on_load = None
+        return obj
+
+    def __getitem__(self, key):
+        value = self._values[key]
+        if isinstance(value, _Raw):
+            value = self._values[key] = _load(self._text, value)
+            if self._on_load is not None:
+                self._on_load(value)
+        return value
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        del self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def loaded(self):
+        """ Returns a list of the (key, value) pairs parsed so far """
+        return [(k, v) for k, v in self._values.items()
+                if not isinstance(v, _Raw)]
+
+    def unloaded(self, needle=None):
+        """
+        Returns the keys whose values haven't been parsed yet, optionally
+        only those whose source text contains needle.
+        """
+        return [k for k, v in self._values.items()
+                if isinstance(v, _Raw) and (
+                    needle is None or
+                    self._text.find(needle, v.start, v.end) >= 0)]
+
+    def _dump(self, parts):
+        parts.append('{')
+        for i, (key, value) in enumerate(self._values.items()):
+            if i:
+                parts.append(', ')
+            parts.append(json.dumps(key) + ': ')
+            _dump_json(self._text, value, parts)
+        parts.append('}')
+
+
+class LazyArray(MutableSequence):
+    """
+    JSON array from a workbook opened with open(lazy=True). Like LazyObject,
+    elements are parsed on first access and written back verbatim if they
+    never were. Takes the same arguments as LazyObject.
+    """
+    __slots__ = ('_text', '_items', '_on_load')
+
+    def __init__(self, text, start=0, lazy=None):
+        start = _JSON_SPACE.match(text, start).end()
+        if text[start:start + 1] != '[':
+            raise ValueError('Expected a JSON array at offset ' + str(start))
+        members, _ = _scan_json(text, start, lazy or {})
+        self._text = text
+        self._items = [value for _, value in members]
+        self._on_load = None
+
+    @classmethod
+    def _from_members(cls, text, members):
+        obj = cls.__new__(cls)
+        obj._text = text
+        obj._items = [value for _, value in members]
+        obj._on_load = None
+        return obj
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self._items)))]
+        value = self._items[index]
+        if isinstance(value, _Raw):
+            value = self._items[index] = _load(self._text, value)
+            if self._on_load is not None:
+                self._on_load(value)
+        return value
+
+    def __setitem__(self, index, value):
+        self._items[index] = value
+
+    def __delitem__(self, index):
+        del self._items[index]
+
+    def __len__(self):
+        return len(self._items)
+
+    def insert(self, index, value):
+        self._items.insert(index, value)
+
+    def loaded(self):
+        """ Returns a list of the (index, value) pairs parsed so far """
+        return [(i, v) for i, v in enumerate(self._items)
+                if not isinstance(v, _Raw)]
+
+    def _dump(self, parts):
+        parts.append('[')
+        for i, value in enumerate(self._items):
+            if i:
+                parts.append(', ')
+            _dump_json(self._text, value, parts)
+        parts.append(']')
+
+
+def _watch_loads(value, hook):
+    """
+    Sets the function a lazy container and the lazy containers nested in it
+    call with each value they parse, or clears it if hook is None.
+    """
+    if isinstance(value, LazyObject):
+        children = value._values.values()
+    elif isinstance(value, LazyArray):
+        children = value._items
+    else:
+        return
+    value._on_load = hook
+    for child in children:
+        _watch_loads(child, hook)
+
+
+def _load(text, value):
+    """ Parses a _Raw span, passing any other value through """
+    if isinstance(value, _Raw):
+        return json.loads(text[value.start:value.end])
+    return value
+
+
+def _dump_json(text, value, parts):
+    """ Appends the serialized value to a list of strings """
+    if isinstance(value, _Raw):
+        parts.append(text[value.start:value.end])
+    elif isinstance(value, (LazyObject, LazyArray)):
+        value._dump(parts)
+    else:
+        parts.append(default_serializer.dumps(value))
+
+
+def _dump_chunks(value, paths, parts):
+    """
+    Appends the serialized value to a list of strings, split along the same
+    paths as lazily opened props
+    """
+    if isinstance(value, (LazyObject, LazyArray)):
+        value._dump(parts)
+    elif paths is None or not isinstance(value, (dict, list)):
+        parts.append(default_serializer.dumps(value))
+    elif isinstance(value, dict):
+        parts.append('{')
+        for i, (key, member) in enumerate(value.items()):
+            if i:
+                parts.append(', ')
+            parts.append(json.dumps(key) + ': ')
+            _dump_chunks(member, paths.get(key, paths.get('*')), parts)
+        parts.append('}')
+    else:
+        parts.append('[')
+        for i, member in enumerate(value):
+            if i:
+                parts.append(', ')
+            _dump_chunks(member, paths.get('*'), parts)
+        parts.append(']')
+
+
+def _props_chunks(props):
+    """
+    Serializes workbook props to a list of strings that join into its JSON,
+    one per page member, dataset and top-level value, so the whole document
+    is never encoded in one piece. Parts of lazily opened props that were
+    never accessed are copied from the source text as they are. With
+    WorkbookSession(compress=True), uploads compress the strings one at a
+    time without ever joining them; otherwise the GIS connection is given
+    them joined.
+    """
+    parts = []
+    _dump_chunks(props, _LAZY_PATHS, parts)
+    return parts
+
+
+def _dumps_props(props):
+    """ Serializes workbook props to a JSON string """
+    return ''.join(_props_chunks(props))
+
+
+def _loaded_items(container):
+    """
+    Returns the (key, value) pairs of a dict or list, or of a lazy container
+    only those that have already been parsed.
+    """
+    if isinstance(container, (LazyObject, LazyArray)):
+        return container.loaded()
+    if isinstance(container, dict):
+        return list(container.items())
+    return list(enumerate(container))
+
+
+# Types that a JSON object or array in the props can have
+_JSON_OBJECT = (dict, LazyObject)
+_JSON_ARRAY = (list, LazyArray)
+
+
+def _plain_json(value):
+    """ Converts lazy containers into plain dicts and lists """
+    if isinstance(value, (LazyObject, LazyArray)):
+        return json.loads(_dumps_props(value))
+    return value
+
+
+def _pointer(path, key):
+    """ Appends a key to a JSON pointer, escaped as in RFC 6901 """
+    return path + '/' + str(key).replace('~', '~0').replace('/', '~1')
+
+
+def _json_diff(base, current, path=''):
+    """
+    Returns the JSON patch (RFC 6902) operations that turn base into
+    current. Objects are compared key by key. Arrays that only had elements
+    appended become '/-' appends, arrays of the same length are compared
+    element by element, and any other changed array is replaced whole.
+    Values of lazy containers that were never parsed can't have changed,
+    so they aren't compared at all.
+    """
+    if isinstance(base, _JSON_OBJECT) and isinstance(current, _JSON_OBJECT):
+        values = current._values if isinstance(current, LazyObject) \
+            else current
+        ops = []
+        for key, value in values.items():
+            if isinstance(value, _Raw):
+                continue
+            child = _pointer(path, key)
+            if key in base:
+                ops.extend(_json_diff(base[key], value, child))
+            else:
+                ops.append({'op': 'add', 'path': child,
+                            'value': _plain_json(value)})
+        for key in base:
+            if key not in values:
+                ops.append({'op': 'remove', 'path': _pointer(path, key)})
+        return ops
+    if isinstance(base, _JSON_ARRAY) and isinstance(current, _JSON_ARRAY):
+        items = current._items if isinstance(current, LazyArray) \
+            else current
+        if len(items) >= len(base):
+            ops = []
+            for i in range(len(base)):
+                if not isinstance(items[i], _Raw):
+                    ops.extend(_json_diff(base[i], items[i],
+                                          path + '/' + str(i)))
+            if len(items) == len(base) or not ops:
+                return ops + [{'op': 'add', 'path': path + '/-',
+                               'value': _plain_json(x)}
+                              for x in items[len(base):]]
+    elif type(base) is type(current) and base == current:
+        return []
+    return [{'op': 'replace', 'path': path, 'value': _plain_json(current)}]
+
+
+# Path of a JSON patch operation appending a cell to a page's layout
+_LAYOUT_APPEND = re.compile(r'^/pages/(\d+)/layout/-$')
+
+# Path of a JSON patch operation on a dataset's data, with the path within
+# the data, if any
+_DATASET_DATA = re.compile(r'^/workspace/datasets/([^/]+)/data(/.*)?$')
+
+
+def _pointer_key(part):
+    """ Unescapes a single part of a JSON pointer """
+    return part.replace('~1', '/').replace('~0', '~')
+
+
+def _data_changes(ops):
+    """
+    Returns a dict of dataset name to the JSON patch operations in ops that
+    change its data
+    """
+    changes = {}
+    for op in ops:
+        match = _DATASET_DATA.match(op['path'])
+        if match:
+            changes.setdefault(_pointer_key(match.group(1)), []).append(op)
+    return changes
+
+
+def _refreshed_data(ops):
+    """
+    Returns a dict of dataset name to the data ID that operations in ops
+    replace its data with, i.e. the datasets that ops refresh
+    """
+    return {name: x['value']
+            for name, changes in _data_changes(ops).items()
+            for x in changes
+            if x['path'].endswith('/data') and x['op'] == 'replace' and
+            isinstance(x['value'], str)}
+
+
+def _is_data_reference(op):
+    """
+    Whether a JSON patch operation rewrites the data a derived dataset's
+    tools are built on, as propagate() does
+    """
+    match = _DATASET_DATA.match(op['path'])
+    return match is not None and \
+        '/params/dataset/' in (match.group(2) or '') + '/'
+
+
+def _patch_conflicts(ops, other_ops):
+    """
+    Returns the paths of the operations in ops that overlap a different
+    operation in other_ops: the same path, or one inside the other. Appends
+    to the same array don't overlap.
+    """
+    conflicts = []
+    for op in ops:
+        path = op['path']
+        for other in other_ops:
+            if other == op or path == other['path'] and path.endswith('/-'):
+                continue
+            if path == other['path'] or \
+                    path.startswith(other['path'] + '/') or \
+                    other['path'].startswith(path + '/'):
+                conflicts.append(path)
+                break
+    return conflicts
+
+
+def _json_apply(doc, ops):
+    """ Applies JSON patch operations from _json_diff() to doc in place """
+    for op in ops:
+        parts = [_pointer_key(x) for x in op['path'].split('/')[1:]]
+        parent = doc
+        for part in parts[:-1]:
+            parent = parent[int(part) if isinstance(parent, _JSON_ARRAY)
+                            else part]
+        last = parts[-1]
+        if isinstance(parent, _JSON_ARRAY):
+            if last == '-':
+                parent.append(op['value'])
+            elif op['op'] == 'remove':
+                del parent[int(last)]
+            else:
+                parent[int(last)] = op['value']
+        elif op['op'] == 'remove':
+            parent.pop(last, None)
+        else:
+            parent[last] = op['value']
+
+
+def _malformed(path, problem):
+    """ Error for a workbook structure that doesn't match the format """
+    return InsightsWorkbookError('Malformed workbook: ' + path + ' ' + problem)
+
+
+def _require(raw, key, kind, path):
+    """
+    Returns raw[key], raising an InsightsWorkbookError if it's missing or
+    isn't of the expected type.
+    """
+    if not isinstance(raw, _JSON_OBJECT):
+        raise _malformed(path, 'is not an object')
+    if key not in raw:
+        raise _malformed(path, 'is missing "' + key + '"')
+    if not isinstance(raw[key], kind):
+        raise _malformed(path + '.' + key, 'has the wrong type')
+    return raw[key]
+
+
+def _check_item(raw, path):
+    """ Checks an operation in a page's model (add-data, aggregate, etc.) """
+    if not isinstance(raw, dict):
+        raise _malformed(path, 'is not an object')
+    if 'params' in raw and not isinstance(raw['params'], dict):
+        raise _malformed(path + '.params', 'has the wrong type')
+
+
+def _check_card(raw, path):
+    """ Checks a card (map, chart, etc.) on a page """
+    _require(raw, 'type', str, path)
+    content = raw.get('content', {})
+    if not isinstance(content, dict) or \
+            not isinstance(content.get('layers', []), list):
+        raise _malformed(path + '.content', 'has the wrong type')
+
+
+def _check_cell(raw, path):
+    """ Checks a card's position and size in a page's grid layout """
+    for key in ('x', 'y', 'w', 'h'):
+        _require(raw, key, (int, float), path)
+
+
+def _check_items(page, path):
+    """ Checks a page's model and the items in it """
+    model = _require(page, 'model', dict, path)
+    items = _require(model, 'items', list, path + '.model')
+    for i, item in enumerate(items):
+        _check_item(item, '%s.model.items[%d]' % (path, i))
+
+
+def _check_page(raw, path):
+    """ Checks a page with its model, cards and layout """
+    _check_items(raw, path)
+    cards = _require(raw, 'cards', list, path)
+    layout = _require(raw, 'layout', list, path)
+    _require(raw, 'contents', list, path)
+    if len(layout) != len(cards):
+        raise _malformed(path, 'has ' + str(len(cards)) + ' cards but ' +
+                         str(len(layout)) + ' layout cells')
+    for i, card in enumerate(cards):
+        _check_card(card, '%s.cards[%d]' % (path, i))
+    for i, cell in enumerate(layout):
+        _check_cell(cell, '%s.layout[%d]' % (path, i))
+
+
+def _check_dataset(raw, path):
+    """ Checks a dataset in the workbook's workspace """
+    _require(raw, 'data', (str, dict), path)
+    if isinstance(raw['data'], dict) and \
+            not isinstance(raw['data'].get('tools', []), list):
+        raise _malformed(path + '.data.tools', 'has the wrong type')
+
+
+def _part_elements(props, part):
+    """
+    Yields (path, element) pairs for the elements of one part of props (see
+    InsightsWorkbook.dirty) parsed so far: the model items, contents, cards
+    or layout cells of every page, or the workspace datasets.
+    """
+    if part == 'datasets':
+        datasets = props.get('workspace', {}).get('datasets', {})
+        for name, dataset in _loaded_items(datasets):
+            yield 'datasets[' + repr(name) + ']', dataset
+        return
+    key = 'model.items' if part == 'model' else part
+    for i, page in _loaded_items(props.get('pages', [])):
+        values = dict(_loaded_items(page)).get(part, {})
+        if part == 'model':
+            values = values.get('items', [])
+        for j, value in enumerate(values):
+            yield 'pages[%d].%s[%d]' % (i, key, j), value
+
+
+def _check_structure(props):
+    """
+    Checks the structure of props against the Insights workbook format,
+    raising an InsightsWorkbookError that points at the first malformed part.
+    Of lazily opened props, only the parts parsed so far are checked; pages
+    whose cards and layout haven't been parsed only have their model items
+    checked.
+    """
+    pages = _require(props, 'pages', _JSON_ARRAY, 'workbook')
+    workspace = _require(props, 'workspace', _JSON_OBJECT, 'workbook')
+    datasets = _require(workspace, 'datasets', _JSON_OBJECT, 'workspace')
+    for i, page in _loaded_items(pages):
+        path = 'pages[%d]' % i
+        parsed = dict(_loaded_items(page)) \
+            if isinstance(page, LazyObject) else page
+        if 'cards' in parsed or 'layout' in parsed or \
+                not isinstance(page, LazyObject):
+            _check_page(page, path)
+        elif 'model' in parsed:
+            _check_items(page, path)
+    for name, dataset in _loaded_items(datasets):
+        _check_dataset(dataset, 'datasets[' + repr(name) + ']')
+
+
+class WorkbookValidator(object):
+    """
+    Checks workbook props against the rules of the Insights workbook format
+    that its structure alone doesn't capture: known statistics and
+    references to datasets that exist. The checks for each part of the props
+    (see InsightsWorkbook.dirty) are compiled into a table once, when the
+    validator is created, so validating only the parts that changed since
+    the last save costs nothing for the rest. The module-level
+    workbook_validator instance is used by every InsightsWorkbook; replace
+    it with one that allows more statistics or chart types to create them
+    with aggregate() and add_chart(). Chart types are only checked there,
+    since cards made in Insights itself use many more.
+
+    ================    ========================================================
+    **Argument**        **Description**
+    ----------------    --------------------------------------------------------
+    stat_types          Optional sequence of the allowed statistic types.
+    ----------------    --------------------------------------------------------
+    chart_types         Optional sequence of the chart types add_chart()
+                        accepts.
+    ----------------    --------------------------------------------------------
+    workbook_format     Optional int. Required value of the format property.
+    ================    ========================================================
+    """
+
+    PARTS = ('model', 'contents', 'cards', 'layout', 'datasets')
+
+    def __init__(self, stat_types=STAT_TYPES, chart_types=CHART_TYPES,
+                 workbook_format=WORKBOOK_FORMAT):
+        self.stat_types = frozenset(stat_types)
+        self.chart_types = frozenset(chart_types)
+        self.workbook_format = workbook_format
+        # Part name to the checks run on each element of that part of a
+        # page, or on each dataset
+        self._checks = {
+            'model': [self._check_model_item],
+            'contents': [self._check_content],
+            'cards': [self._check_card],
+            'layout': [self._check_cell],
+            'datasets': [self._check_dataset],
+        }
+
+    def problems(self, props, parts=None, known=None):
+        """
+        Returns a list of the problems found in the given parts of props (all
+        of them by default). Parts of lazily opened props that haven't been
+        parsed are skipped, and so are the elements in known, a dict of id()
+        to element (see InsightsWorkbook.save()), along with the format check.
+        """
+        problems = []
+        if known is None and props.get('format') != self.workbook_format:
+            problems.append('format is ' + repr(props.get('format')) +
+                            ', expected ' + repr(self.workbook_format))
+        datasets = props.get('workspace', {}).get('datasets', {})
+        parts = self.PARTS if parts is None else parts
+        for part in self.PARTS:
+            if part not in parts:
+                continue
+            checks = self._checks[part]
+            for path, element in _part_elements(props, part):
+                if known is not None and known.get(id(element)) is element:
+                    continue
+                try:
+                    for check in checks:
+                        problems.extend(path + ' ' + x
+                                        for x in check(element, datasets))
+                except (AttributeError, TypeError):
+                    problems.append(path + ' is malformed')
+        return problems
+
+    def validate(self, props, parts=None, known=None):
+        """
+        Raises an InsightsWorkbookValidationError listing every problem found
+        in the given parts of props (all of them by default), skipping the
+        elements in known.
+        """
+        problems = self.problems(props, parts, known)
+        if problems:
+            raise InsightsWorkbookValidationError(problems)
+
+    def validate_tools(self, tools):
+        """
+        Raises an InsightsWorkbookValidationError if a list of add-data tools
+        about to be sent to execute is invalid.
+        """
+        problems = []
+        seen = set()
+        for i, tool in enumerate(tools):
+            path = 'tools[%d]' % i
+            url = tool.get('params', {}).get('data', {}).get('url')
+            if not isinstance(url, str) or \
+                    not url.startswith(('http://', 'https://')):
+                problems.append(path + ' has an invalid layer URL ' +
+                                repr(url))
+            out_dataset = tool.get('outDataset')
+            if not isinstance(out_dataset, str) or not out_dataset:
+                problems.append(path + ' has no output dataset name')
+            elif out_dataset in seen:
+                problems.append(path + ' repeats the dataset name ' +
+                                repr(out_dataset))
+            seen.add(out_dataset)
+        if problems:
+            raise InsightsWorkbookValidationError(problems)
+
+    def _check_model_item(self, item, datasets):
+        out_dataset = item.get('outDataset')
+        if out_dataset is not None and out_dataset not in datasets:
+            yield 'outputs the unknown dataset ' + repr(out_dataset)
+        if item.get('operation') != 'aggregate':
+            return
+        params = item.get('params', {})
+        if params.get('dataset') not in datasets:
+            yield 'aggregates the unknown dataset ' + \
+                repr(params.get('dataset'))
+        for problem in self._check_statistics(params):
+            yield problem
+
+    def _check_statistics(self, params):
+        for stat in params.get('statistics', []):
+            if stat.get('type') not in self.stat_types:
+                yield 'has the unknown statistic ' + repr(stat.get('type'))
+
+    def _check_content(self, content, datasets):
+        if content.get('dataset') not in datasets:
+            yield 'lists the unknown dataset ' + repr(content.get('dataset'))
+
+    def _check_card(self, card, datasets):
+        for layer in card.get('content', {}).get('layers', []):
+            if layer.get('datasetId') not in datasets:
+                yield 'shows the unknown dataset ' + \
+                    repr(layer.get('datasetId'))
+
+    def _check_cell(self, cell, datasets):
+        for key in ('x', 'y', 'w', 'h'):
+            if not isinstance(cell.get(key), (int, float)):
+                yield 'has an invalid ' + key
+            elif key in ('w', 'h') and cell[key] <= 0:
+                yield 'has a ' + key + ' that isn\'t positive'
+
+    def _check_dataset(self, dataset, datasets):
+        data = dataset.get('data') if isinstance(dataset, dict) else None
+        if not isinstance(data, (str, dict)):
+            yield 'has no data'
+            return
+        for tool in WorkbookIndex._tools(data):
+            for problem in self._check_statistics(tool['params']):
+                yield problem
+
+
+# Shared by every InsightsWorkbook to check props before they're uploaded
+workbook_validator = WorkbookValidator()
+
+
+class WorkbookIndex(object):
+    """
+    Reverse index over the props of an Insights workbook, so lookups don't
+    have to walk the nested pages and workspace dictionaries.
+
+    ================    ========================================================
+    **Attribute**       **Description**
+    ----------------    --------------------------------------------------------
+    layers              Dict of feature layer service URL to a list of
+                        (sublayer URL, dataset name) tuples, in the order they
+                        were added to the workbook.
+    ----------------    --------------------------------------------------------
+    sources             Dict of dataset name to the feature layer URL it was
+                        added from.
+    ----------------    --------------------------------------------------------
+    datasets            Dict of dataset name to its workspace dataset entry.
+    ----------------    --------------------------------------------------------
+    data                Dict of data ID to the name of the dataset that owns
+                        it. Only datasets backed by a data ID returned from
+                        execute (i.e. added layers) are included.
+    ----------------    --------------------------------------------------------
+    refs                Dict of data key (see _data_key) to the set of
+                        dataset names whose tools reference that data.
+    ----------------    --------------------------------------------------------
+    inputs              Dict of dataset name to the set of dataset names that
+                        model items derive it from.
+    ----------------    --------------------------------------------------------
+    derived             Dict of dataset name to the set of dataset names that
+                        model items derive from it (the reverse of inputs).
+    ----------------    --------------------------------------------------------
+    aggregates          Dict of canonical aggregation parameters (see
+                        _aggregate_key) to the name of the first dataset
+                        produced by that aggregation.
+    ----------------    --------------------------------------------------------
+    producers           Dict of dataset name to the first model item that
+                        produces it.
+    ----------------    --------------------------------------------------------
+    pages               Dict of dataset name to the set of indexes of the pages
+                        whose model produces it.
+    ================    ========================================================
+
+    For lazily opened props, datasets that haven't been parsed yet aren't in
+    datasets, data or refs. dataset() and propagate() parse and index them
+    as they're needed.
+    """
+
+    def __init__(self, props=None):
+        self.layers = {}
+        self.sources = {}
+        self.datasets = {}
+        self.data = {}
+        self.refs = {}
+        self._ref_keys = {}
+        self.inputs = {}
+        self.derived = {}
+        self.aggregates = {}
+        self.producers = {}
+        self.pages = {}
+        self._lazy = None
+        if props:
+            self.rebuild(props)
+
+    def rebuild(self, props):
+        """ Rebuilds the whole index from a workbook props dictionary """
+        self.layers = {}
+        self.sources = {}
+        self.datasets = {}
+        self.data = {}
+        self.refs = {}
+        self._ref_keys = {}
+        self.inputs = {}
+        self.derived = {}
+        self.aggregates = {}
+        self.producers = {}
+        self.pages = {}
+        for i, page in enumerate(props.get('pages', [])):
+            for item in page.get('model', {}).get('items', []):
+                self.add_model_item(item, i)
+        datasets = props.get('workspace', {}).get('datasets', {})
+        self._lazy = datasets if isinstance(datasets, LazyObject) else None
+        for name, dataset in _loaded_items(datasets):
+            self.add_dataset(name, dataset)
+
+    def dataset(self, name):
+        """
+        Returns the workspace dataset entry with the given name, or None if
+        there isn't one.
+        """
+        dataset = self.datasets.get(name)
+        if dataset is None and self._lazy is not None and name in self._lazy:
+            dataset = self._lazy[name]
+            self.add_dataset(name, dataset)
+        return dataset
+
+    def add_model_item(self, item, page=None):
+        """
+        Indexes an add-data model item by its feature layer URL, or an
+        aggregate model item by its canonical parameters, along with the
+        index of the page it's on.
+        """
+        out_dataset = item.get('outDataset') \
+            if isinstance(item, _JSON_OBJECT) else None
+        if out_dataset is not None:
+            self.producers.setdefault(out_dataset, item)
+            if page is not None:
+                self.pages.setdefault(out_dataset, set()).add(page)
+        aggregate_key = _aggregate_key(item)
+        if aggregate_key is not None:
+            self.aggregates.setdefault(aggregate_key, out_dataset)
+            self.inputs.setdefault(out_dataset, set()).add(aggregate_key[0])
+            self.derived.setdefault(aggregate_key[0], set()).add(out_dataset)
+            return
+        try:
+            url = item['params']['data']['url']
+        except (KeyError, TypeError):
+            return
+        if out_dataset is None or out_dataset in self.sources:
+            # Already indexed from another page
+            return
+        self.layers.setdefault(_service_url(url), []).append(
+            (url, out_dataset))
+        self.sources[out_dataset] = url
+
+    def supporting_items(self, name):
+        """
+        Returns the model items that produce a dataset, preceded by the ones
+        producing the datasets it's derived from, inputs first.
+        """
+        items = []
+        seen = set()
+        stack = [(name, False)]
+        while stack:
+            name, expanded = stack.pop()
+            item = self.producers.get(name)
+            if item is None:
+                continue
+            if expanded:
+                items.append(item)
+                continue
+            if name in seen:
+                continue
+            seen.add(name)
+            stack.append((name, True))
+            for parent in sorted(self.inputs.get(name, ()), reverse=True):
+                stack.append((parent, False))
+        return items
+
+    def add_dataset(self, name, dataset):
+        """
+        Indexes a workspace dataset entry, replacing any previous entry with
+        the same name.
+        """
+        if name in self.datasets:
+            self.remove_dataset(name)
+        self.datasets[name] = dataset
+        try:
+            data = dataset['data']
+        except (KeyError, TypeError):
+            return
+        if not isinstance(data, (dict, list)):
+            self.data[data] = name
+        # Keys are kept per dataset since tools get rewritten in place
+        keys = {_data_key(tool['params']['dataset'])
+                for tool in self._tools(data)}
+        for key in keys:
+            self.refs.setdefault(key, set()).add(name)
+        if keys:
+            self._ref_keys[name] = keys
+
+    def remove_dataset(self, name):
+        """ Removes a workspace dataset entry from the index """
+        dataset = self.datasets.pop(name, None)
+        for key in self._ref_keys.pop(name, ()):
+            self.refs[key].discard(name)
+            if not self.refs[key]:
+                del self.refs[key]
+        try:
+            data = dataset['data']
+        except (KeyError, TypeError):
+            return
+        if not isinstance(data, (dict, list)) and self.data.get(data) == name:
+            del self.data[data]
+
+    def find_layer(self, url, sublayer=None):
+        """
+        Returns the name of the dataset added from a sublayer of the given
+        feature layer URL, or without a sublayer, from the first of its
+        sublayers that was added. Returns None if there isn't one in the
+        workbook.
+        """
+        url = url.rstrip('/')
+        entries = self.layers.get(_service_url(url))
+        if not entries:
+            return None
+        if sublayer is None:
+            return entries[0][1]
+        sublayer_url = url + '/' + str(sublayer)
+        for entry_url, dataset_name in entries:
+            if entry_url == sublayer_url:
+                return dataset_name
+        return None
+
+    def propagate(self, old_data, targets=None):
+        """
+        Rewrites every dataset derived from the given datasets, directly or
+        through other derived datasets, so the tools of each one embed the
+        current data of its inputs. Dependents are found through the refs and
+        derived indexes, so only the affected part of the dependency graph is
+        visited, and rewritten in topological order, so a chain of
+        aggregations is brought up to date no matter how many of its base
+        datasets changed.
+
+        ==================     =================================================
+        **Argument**           **Description**
+        ------------------     -------------------------------------------------
+        old_data               Required dict. Dataset name to the data it held
+                               before it was changed.
+        ------------------     -------------------------------------------------
+        targets                Optional dict. Dataset name to the name of the
+                               dataset whose data should replace references
+                               to it, for datasets that are merged into
+                               another one. Defaults to the dataset itself.
+        ==================     =================================================
+        :return:
+           List of the names of the rewritten datasets, in the order they
+           were rewritten
+        """
+        targets = targets or {}
+        if self._lazy is not None:
+            self._load_dependents(old_data.values())
+        # Data key of each visited dataset as it was before the change. Keys
+        # are taken before anything is rewritten since derived datasets can
+        # share data objects in memory
+        keys = {name: _data_key(data) for name, data in old_data.items()}
+        owners = {key: targets.get(name, name) for name, key in keys.items()}
+        children = {}
+        stack = list(keys)
+        while stack:
+            name = stack.pop()
+            dependents = set(self.refs.get(keys[name], ()))
+            dependents.update(self.derived.get(name, ()))
+            dependents.discard(name)
+            for child in dependents:
+                if child not in keys:
+                    dataset = self.dataset(child)
+                    if dataset is None:
+                        continue
+                    keys[child] = _data_key(dataset.get('data'))
+                    owners.setdefault(keys[child], child)
+                    stack.append(child)
+                children.setdefault(name, set()).add(child)
+        order = self._topological_order(children, list(old_data))
+        for name in order:
+            dataset = self.datasets[name]
+            for tool in self._tools(dataset.get('data')):
+                source = owners.get(_data_key(tool['params']['dataset']))
+                if source is not None and source in self.datasets:
+                    tool['params']['dataset'] = self.datasets[source]['data']
+            # Reindex the references of the rewritten tools
+            self.add_dataset(name, dataset)
+        return order
+
+    def _load_dependents(self, old_data):
+        """
+        Parses and indexes the datasets of lazily opened props that can
+        depend on old_data. Derived data embeds the data IDs of everything
+        it's built on, so only datasets whose text contains one of the IDs
+        need to be parsed.
+        """
+        needles = [json.dumps(x, ensure_ascii=False) for x in old_data
+                   if isinstance(x, str)]
+        if len(needles) != len(old_data):
+            needles = [None]
+        for needle in needles:
+            for name in self._lazy.unloaded(needle):
+                self.add_dataset(name, self._lazy[name])
+        # Datasets parsed through props directly haven't been indexed
+        for name, dataset in self._lazy.loaded():
+            if name not in self.datasets:
+                self.add_dataset(name, dataset)
+
+    @staticmethod
+    def _topological_order(children, roots):
+        """
+        Returns the datasets reachable from roots (excluding the roots), with
+        every dataset after all of its reachable inputs.
+        """
+        reachable = set()
+        stack = list(roots)
+        roots = set(roots)
+        while stack:
+            for child in children.get(stack.pop(), ()):
+                if child not in reachable and child not in roots:
+                    reachable.add(child)
+                    stack.append(child)
+        pending = {x: 0 for x in reachable}
+        for name in reachable:
+            for child in children.get(name, ()):
+                pending[child] += 1
+        ready = sorted(x for x, count in pending.items() if count == 0)
+        order = []
+        while ready:
+            name = ready.pop()
+            order.append(name)
+            for child in sorted(children.get(name, ())):
+                if child in pending:
+                    pending[child] -= 1
+                    if pending[child] == 0:
+                        ready.append(child)
+        # A cycle can't come from Insights itself, but don't lose datasets
+        # caught in one
+        order.extend(sorted(reachable.difference(order)))
+        return order
+
+    @staticmethod
+    def _tools(data):
+        """ Yields the tools of a data object that reference a dataset """
+        if not isinstance(data, dict):
+            return
+        for tool in data.get('tools', []):
+            try:
+                tool['params']['dataset']
+            except (KeyError, TypeError):
+                continue
+            yield tool
+
+
+class LayoutPacker(object):
+    """
+    Places cards in a page's grid layout, left to right and top to bottom,
+    using a skyline bottom-left packing: the top edge of the cards placed so
+    far is kept as a list of horizontal segments, and each new card goes at
+    the lowest (then leftmost) position where it fits on top of them. Placing
+    a card only looks at the segments, so filling a page costs far less than
+    checking every card already on it.
+
+    ================    ========================================================
+    **Argument**        **Description**
+    ----------------    --------------------------------------------------------
+    columns             Optional int. Width of the grid.
+    ----------------    --------------------------------------------------------
+    gap                 Optional int. Space kept between neighbouring cards.
+    ----------------    --------------------------------------------------------
+    cells               Optional list of layout cells (dicts with x, y, w and
+                        h) already on the page. New cards are placed below or
+                        beside them, never over them.
+    ================    ========================================================
+    """
+
+    def __init__(self, columns=LAYOUT_COLUMNS, gap=LAYOUT_GAP, cells=()):
+        self.columns = columns
+        self.gap = gap
+        # [x, y, width] segments covering the grid from left to right, each
+        # including the gap after it
+        self._skyline = [[0, 0, columns + gap]]
+        for cell in cells:
+            self._raise(cell['x'], cell['y'] + cell['h'] + gap,
+                        cell['w'] + gap)
+
+    def place(self, w, h):
+        """
+        Finds a position for a w by h card and marks it as taken. Returns
+        the (x, y) of its top left corner.
+        """
+        width = w + self.gap
+        best = None
+        for i, (x, _, _) in enumerate(self._skyline):
+            if x + w > self.columns and best is not None:
+                break
+            y = self._fit(i, width)
+            if best is None or y < best[1]:
+                best = (x, y)
+        x, y = best
+        self._raise(x, y + h + self.gap, width)
+        return x, y
+
+    def _fit(self, i, width):
+        """
+        Returns the y a card of the given width would sit at if its left
+        edge was at segment i
+        """
+        y = 0
+        for x, top, seg_width in self._skyline[i:]:
+            y = max(y, top)
+            width -= seg_width
+            if width <= 0:
+                break
+        return y
+
+    def _raise(self, x, top, width):
+        """ Raises the skyline over [x, x + width) to at least top """
+        # Anything beyond the right edge of the grid can't affect placement
+        end = min(x + width, self.columns + self.gap)
+        if x >= end:
+            return
+        skyline = []
+        for seg_x, seg_top, seg_width in self._skyline:
+            seg_end = seg_x + seg_width
+            if seg_end <= x or seg_x >= end:
+                skyline.append([seg_x, seg_top, seg_width])
+                continue
+            if seg_x < x:
+                skyline.append([seg_x, seg_top, x - seg_x])
+            skyline.append([max(seg_x, x), max(seg_top, top),
+                            min(seg_end, end) - max(seg_x, x)])
+            if seg_end > end:
+                skyline.append([end, seg_top, seg_end - end])
+        # Merge neighbouring segments at the same height
+        merged = [skyline[0]]
+        for segment in skyline[1:]:
+            if segment[1] == merged[-1][1]:
+                merged[-1][2] += segment[2]
+            else:
+                merged.append(segment)
+        self._skyline = merged
+
+
+class InsightsWorkbook(object):
+    """ An object representing an ArcGIS Insights workbook
+
+    Users can use this class to create new Insights workbooks, connect to
+    existing workbooks, and modify them. Currently, it serves as a proof of
+    concept to demonstrate adding data, creating a map, and creating a chart,
+    but new functionality can easily be added in the future.
+
+
+    ================    ========================================================
+    **Argument**        **Description**
+    ----------------    --------------------------------------------------------
+    gis                 GIS connection object from arcgis.gis (ArcGIS API for
+                        Python). Connection should be set up before working with
+                        this class.
+    ----------------    --------------------------------------------------------
+    title               Optional string. Title for the Insights workbook
+    ----------------    --------------------------------------------------------
+    workbook_id         Optional string. Random ID used for Hosted storage.
+    ----------------    --------------------------------------------------------
+    workspace_id        Optional string. Workbook Item ID in ArcGIS - generated
+                        by ArcGIS upon creation of a workbook.
+    ----------------    --------------------------------------------------------
+    workspace_url       Optional string. URL where the Insights workbook
+                        internal hosted workspace resides. Structure differs
+                        between ArcGIS Online and ArcGIS Portal.
+    ----------------    --------------------------------------------------------
+    props               Optional dict. Dictionary of workbook properties that
+                        represents the full JSON data object that is stored in
+                        ArcGIS.
+    ----------------    --------------------------------------------------------
+    transport           Optional Transport used for REST calls, which paces
+                        and retries them. Defaults to the session's.
+    ----------------    --------------------------------------------------------
+    session             Optional WorkbookSession. Defaults to the one shared by
+                        all workbooks of the gis that aren't given one.
+    ================    ========================================================
+
+
+
+
+    .. code-block:: python
+
+        # Usage Example 1: Anonymous Login to ArcGIS Online
+    """
+
+    def __init__(self, gis, title=None, workbook_id=None, workspace_id=None,
+                 workspace_url=None, props=None, transport=None,
+                 session=None):
+        """
+        Constructs the Workbook given the aforementioned parameters. Normally,
+        the Workbook object will be created with either the new() or open()
+        class methods below.
+        """
+        self._gis = gis
+        self._session = session or WorkbookSession.of(gis)
+        self._transport = transport or self._session.transport
+        self._title = title
+        self._workbookID = workbook_id
+        self._workspaceID = workspace_id
+        self._workspaceURL = workspace_url
+        self.props = props
+        # Reverse index over props, kept up to date by the methods below
+        self._index = WorkbookIndex(props)
+        # Parts of props changed since the last save, and the content hash of
+        # what was last saved (or opened), used to skip redundant uploads
+        self._dirty = set()
+        self._saved_hash = None
+        # What's stored in ArcGIS as of the last open or save (as the strings
+        # its JSON is serialized to), and the item's modified time then, used
+        # to detect and merge concurrent changes
+        self._base = None
+        self._modified = None
+        # Dataset name to when (in ms since the epoch, like modified times)
+        # its layer was last refreshed, to settle refreshes made on both
+        # sides of a merge
+        self._refreshed = {}
+        # id() to element of the elements of props as of the last open or
+        # save, which save() doesn't need to validate again
+        self._known = {}
+        # Cards a page can hold before new cards go on a new page, and the
+        # LayoutPacker of each page cards were placed on, with the layout
+        # list and length it was built for
+        self.page_card_limit = PAGE_CARD_LIMIT
+        self._packers = {}
+        # ExtentIndex over the datasets, built when first needed
+        self._extents = None
+
+    @property
+    def dirty(self):
+        """
+        Set of the parts of this Workbook changed since it was last saved or
+        opened. Parts are 'model', 'contents', 'cards', 'layout' and
+        'datasets'. Changes made directly to props aren't tracked here, but
+        are still detected by save().
+        """
+        return frozenset(self._dirty)
+
+    def _mark_dirty(self, *parts):
+        """ Records the parts of props changed by a mutating method """
+        self._dirty.update(parts)
+        if 'datasets' in parts:
+            self._extents = None
+
+    def _save_text(self):
+        """
+        Sets the properties that have to be set at save time and returns the
+        serialized props to upload, as a list of strings that join into its
+        JSON (see _props_chunks()), along with its content hash.
+        """
+        # A few properties have to be manually set at save (doesn't work to
+        # just set them on initial Workbook creation).
+        self.props["id"] = self._workspaceID
+        self.props["owner"] = self._session.username
+        self.props["name"] = self._workbookID
+        self.props["url"] = self._workspaceURL
+        # Hash the serialized pieces as they are, rather than a copy of the
+        # whole text with the title in front
+        parts = _props_chunks(self.props)
+        content_hash = hashlib.sha1((str(self._title) + '\n').encode('utf-8'))
+        for part in parts:
+            content_hash.update(part.encode('utf-8'))
+        return parts, content_hash.hexdigest()
+
+    def validate(self, parts=None):
+        """
+        Checks props against the Insights workbook format with
+        workbook_validator, raising an InsightsWorkbookValidationError that
+        lists every problem found. save() does this for the elements added
+        or replaced since the last open or save, in the parts changed.
+
+        ==================     =================================================
+        **Argument**           **Description**
+        ------------------     -------------------------------------------------
+        parts                  Optional set of the parts to check (see dirty).
+                               Defaults to all of them.
+        ==================     =================================================
+        """
+        if isinstance(self.props, LazyObject) or parts is None:
+            # Changes made directly to props can break the structure, too
+            _check_structure(self.props)
+        workbook_validator.validate(self.props, parts)
+
+    def _opened(self, modified):
+        """ Records what's stored in ArcGIS when this Workbook was opened """
+        # Remember it so unchanged saves are skipped, and changes made in
+        # ArcGIS in the meantime can be merged at save
+        self._base, self._saved_hash = self._save_text()
+        self._modified = modified
+        self._baseline()
+
+    def _baseline(self):
+        """
+        Records the elements props holds now, so that save() only validates
+        elements added or replaced after this. Elements of lazily opened
+        props are recorded as they're parsed.
+        """
+        self._known = {}
+        for part in WorkbookValidator.PARTS:
+            for _, element in _part_elements(self.props, part):
+                self._known[id(element)] = element
+        if isinstance(self.props, LazyObject):
+            _watch_loads(self.props, self._parsed)
+
+    def _parsed(self, value):
+        """ Records every object in a value parsed from lazily opened props """
+        stack = [value]
+        while stack:
+            value = stack.pop()
+            if isinstance(value, dict):
+                stack.extend(value.values())
+            elif isinstance(value, list):
+                stack.extend(value)
+            else:
+                continue
+            self._known[id(value)] = value
+
+    def reindex(self):
+        """
+        Rebuilds the reverse index over props. Only needs to be called after
+        modifying props directly rather than through this class.
+        """
+        self._packers = {}
+        self._extents = None
+        self._index.rebuild(self.props)
+
+    @classmethod
+    def new(cls, gis, title, transport=None, session=None):
+        """
+        Creates a new Insights Workbook in ArcGIS using the provided title.
+
+        ==================     =================================================
+        **Argument**           **Description**
+        ------------------     -------------------------------------------------
+        gis                    Required arcgis.gis.GIS. Connection should be set
+                               up before working with this class.
+        ------------------     -------------------------------------------------
+        title                  Optional string. Title to be assigned to the new
+                               Workbook.
+        ------------------     -------------------------------------------------
+        transport              Optional Transport used for REST calls.
+        ------------------     -------------------------------------------------
+        session                Optional WorkbookSession for the gis.
+        ==================     =================================================
+
+        :return:
+           New InsightsWorkbook object with the provided title.
+        """
+        session = session or WorkbookSession.of(gis)
+        transport = transport or session.transport
+        # Random 8-digit hex number for ID
+        workbook_id = '%08x' % random.randrange(16**8)
+        workspace_url = session.workspace_url(workbook_id)
+        path, post_data = session.create_service_request(workbook_id)
+        # Catch any errors from POSTing
+        try:
+            # The first call creates the workspace, but the Workbook is not
+            # functional until after the second POST below
+            # Creating the service isn't idempotent, so it's only retried if
+            # the portal turned the request away
+            resp = transport.call('createService', path, post_data,
+                                  lambda: gis._portal.con.post(path, post_data),
+                                  idempotent=False)
+            workspace_id = session.created_item_id(resp)
+            item_props = session.new_item_props(workspace_id, title,
+                                                workspace_url)
+            props = _default_props(title)
+            # After the first call sets up the workspace, this second call sets
+            # up the actual Workbook with all the data props, title, etc.
+            text = _dumps_props(props)
+            transport.call(
+                'updateItem', session.item_update_url(workspace_id), text,
+                lambda: gis._portal.update_item(workspace_id, item_props, text),
+                workspace_id)
+            # Now that it's created, store the relevant properties in this class
+            # for use in other functions (e.g. add data, create map, etc.)
+            return cls(gis, title, workbook_id, workspace_id, workspace_url,
+                       props, transport, session)
+        except Exception as e:
+            raise InsightsWorkbookError('Error creating workbook: ' +
+                                        str(e)) from e
+
+    @classmethod
+    def open(cls, existing_workbook, cache=None, transport=None, lazy=False,
+             session=None):
+        """
+        Creates a new Insights Workbook in ArcGIS using the provided title.
+
+        ==================     =================================================
+        **Argument**           **Description**
+        ------------------     -------------------------------------------------
+        gis                    Required arcgis.gis.Item. Must pass a previously-
+                               created ArcGIS Insights Workbook. The ArcGIS API
+                               for Python Item object should be of the
+                               "Insights Workbook" type.
+        ------------------     -------------------------------------------------
+        cache                  Optional WorkbookCache. If the cache holds this
+                               item's data for its current modified time, it
+                               is loaded from disk instead of downloaded.
+        ------------------     -------------------------------------------------
+        transport              Optional Transport used for REST calls.
+        ------------------     -------------------------------------------------
+        lazy                   Optional bool. If True, props are parsed only as
+                               far as the pages and datasets, and the rest of
+                               the JSON is parsed as it's accessed. Parts that
+                               are never accessed are saved back unchanged,
+                               which makes opening, refreshing and saving a
+                               large workbook much cheaper. props is then a
+                               LazyObject rather than a dict.
+        ------------------     -------------------------------------------------
+        session                Optional WorkbookSession for the item's GIS.
+        ==================     =================================================
+
+        :return:
+           InsightsWorkbook object that points to this existing Workbook
+        """
+        gis = existing_workbook._gis
+        session = session or WorkbookSession.of(gis)
+        transport = transport or session.transport
+        title = existing_workbook.title
+        workbook_id = existing_workbook.name
+        workspace_url = session.workspace_url(workbook_id)
+        workspace_id = existing_workbook.id
+        path = session.item_data_url(workspace_id)
+        modified = getattr(existing_workbook, 'modified', None)
+        try:
+            props = None
+            if cache is not None:
+                props = cache.get(workspace_id, modified, raw=lazy)
+            if props is None and lazy:
+                # Keep the JSON text as it was downloaded
+                props = transport.call(
+                    'getData', path, None,
+                    lambda: existing_workbook.get_data(try_json=False),
+                    workspace_id)
+                if isinstance(props, bytes):
+                    props = props.decode('utf-8')
+                if cache is not None:
+                    cache.put(workspace_id, modified, props)
+            elif props is None:
+                resp = transport.call(
+                    'getData', path, None,
+                    lambda: gis._portal.con.get(path, {'f': 'json'}),
+                    workspace_id)
+                props = resp
+                if cache is not None:
+                    cache.put(workspace_id, modified, props)
+            if lazy:
+                props = LazyObject(props)
+            workbook = cls(gis, title, workbook_id, workspace_id,
+                           workspace_url, props, transport, session)
+            # Check the structure once up front, rather than failing halfway
+            # through a later operation
+            _check_structure(props)
+            workbook._opened(modified)
+            return workbook
+        except Exception as e:
+            raise InsightsWorkbookError('Error retrieving workbook data: ' +
+                                        str(e)) from e
+
+    def add_feature_layer(self, lyr, sublayer=0, page=None):
+        """
+        Adds a feature layer as a dataset to this Workbook
+
+        ==================     =================================================
+        **Argument**           **Description**
+        ------------------     -------------------------------------------------
+        lyr                    Required arcgis.gis.Item. Must pass a feature
+                               layer from the ArcGIS API for Python.
+        ------------------     -------------------------------------------------
+        sublayer               Optional int. Index of the sublayer to add.
+        ------------------     -------------------------------------------------
+        page                   Optional int. Index of the page whose data pane
+                               the dataset is added to. Defaults to the last
+                               page.
+        ==================     =================================================
+        :return:
+           String name of new internal Insights Workbook dataset
+        """
+        return self.add_feature_layers([(lyr, sublayer)], page=page)[0]
+
+    def add_feature_layers(self, layers, sublayer=0,
+                           chunk_size=EXECUTE_CHUNK_SIZE, page=None):
+        """
+        Adds many feature layers as datasets to this Workbook, packing the
+        add-data operations into as few execute calls as possible.
+
+        ==================     =================================================
+        **Argument**           **Description**
+        ------------------     -------------------------------------------------
+        layers                 Required list. Each entry is either an
+                               arcgis.gis.Item feature layer or a tuple of
+                               (Item, sublayer index).
+        ------------------     -------------------------------------------------
+        sublayer               Optional int. Index of the sublayer to add for
+                               entries that don't specify their own.
+        ------------------     -------------------------------------------------
+        chunk_size             Optional int. Maximum number of add-data tools
+                               sent in a single execute call.
+        ------------------     -------------------------------------------------
+        page                   Optional int. Index of the page whose data pane
+                               the datasets are added to. Defaults to the last
+                               page.
+        ==================     =================================================
+        :return:
+           List of string names of the new internal Insights Workbook
+           datasets, in the same order as the layers
+        """
+        self._check_page(page)
+        entries = self._new_layer_entries(layers, sublayer)
+        try:
+            # Execute the add-data operations within ArcGIS Insights. Note:
+            # data is not automatically saved in the Workbook. Must manually
+            # call save in order to make it permanent.
+            resp = self._execute_add_data(
+                [(lyr.url + '/' + str(lyr_sublayer), dataset_name)
+                 for lyr, lyr_sublayer, dataset_name in entries],
+                chunk_size)
+            return self._add_layer_entries(entries, resp, page)
+        except InsightsWorkbookValidationError:
+            raise
+        except Exception as e:
+            raise InsightsWorkbookError('Error adding feature layers: ' +
+                                        str(e)) from e
+
+    @staticmethod
+    def _new_layer_entries(layers, sublayer):
+        """
+        Returns (Item, sublayer, new dataset name) entries for layers about
+        to be added.
+        """
+        entries = []
+        for layer in layers:
+            lyr, lyr_sublayer = _layer_and_sublayer(layer, sublayer)
+            # Random 7-digit hex suffix for dataset name
+            dataset_name = lyr.title + '_%07x' % random.randrange(16**7)
+            entries.append((lyr, lyr_sublayer, dataset_name))
+        return entries
+
+    def _add_layer_entries(self, entries, resp, page=None):
+        """
+        Records newly added layers in props, given the data IDs returned by
+        execute, and returns their dataset names.
+        """
+        # In addition to calling execute to create the datasets, each one
+        # must also be placed in the Workbook Item properties in several
+        # places:
+        index = self._page(page)
+        page = self.props['pages'][index]
+        datasets = self.props['workspace']['datasets']
+        for lyr, lyr_sublayer, dataset_name in entries:
+            model_item = {
+                'operation': 'add-data',
+                'params': {
+                    'data': {
+                        'type': 'feature-layer',
+                        'url': lyr.url + '/' + str(lyr_sublayer)
+                    }
+                },
+                'outDataset': dataset_name
+            }
+            page['model']['items'].append(model_item)
+            page['contents'].append({
+                'dataset': dataset_name
+            })
+            datasets[dataset_name] = self._origin_dataset(
+                lyr, lyr_sublayer, resp[dataset_name])
+            self._index.add_model_item(model_item, index)
+            self._index.add_dataset(dataset_name, datasets[dataset_name])
+        self._mark_dirty('model', 'contents', 'datasets')
+        return [dataset_name for _, _, dataset_name in entries]
+
+    def update_dataset(self, lyr, sublayer=0):
+        """
+        Updates all references to the provided feature layer within this
+        Workbook
+
+        ==================     =================================================
+        **Argument**           **Description**
+        ------------------     -------------------------------------------------
+        lyr                    Required arcgis.gis.Item. Must pass a feature
+                               layer from the ArcGIS API for Python.
+        ------------------     -------------------------------------------------
+        sublayer               Optional int. Index of the sublayer to add.
+        ==================     =================================================
+        :return:
+           String name of internal Insights Workbook dataset
+        """
+        dataset_name = self.update_datasets([(lyr, sublayer)])[0]
+        if dataset_name is None:
+            raise InsightsWorkbookError(
+                'Layer does not exist within this Workbook')
+        # Send back the dataset name
+        return dataset_name
+
+    def update_datasets(self, layers, sublayer=0,
+                        chunk_size=EXECUTE_CHUNK_SIZE):
+        """
+        Updates all references to many feature layers within this Workbook,
+        generating the new data IDs with as few execute calls as possible.
+
+        ==================     =================================================
+        **Argument**           **Description**
+        ------------------     -------------------------------------------------
+        layers                 Required list. Each entry is either an
+                               arcgis.gis.Item feature layer or a tuple of
+                               (Item, sublayer index).
+        ------------------     -------------------------------------------------
+        sublayer               Optional int. Index of the sublayer to use for
+                               entries that don't specify their own.
+        ------------------     -------------------------------------------------
+        chunk_size             Optional int. Maximum number of add-data tools
+                               sent in a single execute call.
+        ==================     =================================================
+        :return:
+           List of string names of internal Insights Workbook datasets, in the
+           same order as the layers. Layers that don't exist within this
+           Workbook are returned as None.
+        """
+        entries = self._existing_layer_entries(layers, sublayer)
+        found = [x for x in entries if x[2] is not None]
+        if found:
+            try:
+                # Execute the add-data operations within ArcGIS Insights. This
+                # runs identically to the add data operation - it just
+                # generates new data IDs for us to work with.
+                resp = self._execute_add_data(
+                    [(self._index.sources[dataset_name], dataset_name)
+                     for _, _, dataset_name in found],
+                    chunk_size)
+            except InsightsWorkbookValidationError:
+                raise
+            except Exception as e:
+                raise InsightsWorkbookError('Error updating feature layers: ' +
+                                            str(e)) from e
+            self._refresh_layer_entries(found, resp)
+        return [dataset_name for _, _, dataset_name in entries]
+
+    def _existing_layer_entries(self, layers, sublayer):
+        """
+        Returns (Item, sublayer, dataset name) entries for layers about to be
+        refreshed, with None as the name of layers not in this Workbook.
+        """
+        entries = []
+        for layer in layers:
+            lyr, lyr_sublayer = _layer_and_sublayer(layer, sublayer)
+            # Look up the dataset added from this layer (if any) in the index
+            dataset_name = self._index.find_layer(lyr.url, lyr_sublayer)
+            entries.append((lyr, lyr_sublayer, dataset_name))
+        return entries
+
+    def _refresh_layer_entries(self, entries, resp):
+        """
+        Points refreshed layers' datasets, and everything that references
+        them, at the new data IDs returned by execute.
+        """
+        datasets = self.props['workspace']['datasets']
+        old_data = {}
+        refreshed = time.time() * 1000
+        for lyr, lyr_sublayer, dataset_name in entries:
+            old_data[dataset_name] = datasets[dataset_name]['data']
+            self._refreshed[dataset_name] = refreshed
+            # Update existing workspace entry in JSON with new data ID
+            datasets[dataset_name] = self._origin_dataset(
+                lyr, lyr_sublayer, resp[dataset_name])
+            self._index.add_dataset(dataset_name, datasets[dataset_name])
+        # Rewrite everything derived from the refreshed datasets in one pass
+        self._index.propagate(old_data)
+        self._mark_dirty('datasets')
+
+    def _execute_add_data(self, sources, chunk_size=EXECUTE_CHUNK_SIZE):
+        """
+        Runs add-data tools for a list of (url, dataset name) pairs through
+        the WorkspaceServer execute endpoint, chunk_size tools per call, and
+        returns the merged mapping of dataset name to data ID.
+        """
+        results = {}
+        execute_url = self._workspaceURL + '/execute'
+        for post_data in _execute_requests(sources, chunk_size):
+            results.update(self._transport.call(
+                'execute', execute_url, post_data,
+                lambda: self._gis._portal.con.post(execute_url, post_data),
+                self._workspaceID))
+        return results
+
+    def _origin_dataset(self, lyr, sublayer, data):
+        """
+        Builds the workspace dataset entry for a feature layer added by
+        add-data, using the data ID returned by execute.
+        """
+        my_extent = layer_metadata.extent(lyr, sublayer, self._workspaceID)
+        return {
+            'data': data,
+            'owner': lyr.id,
+            'fields': {
+                'shape': {
+                    'alias': 'Location'
+                }
+            },
+            'extent': my_extent,
+            'origin': True
+        }
+
+    def add_page(self, title=None):
+        """
+        Adds an empty page to the end of this Workbook
+
+        ==================     =================================================
+        **Argument**           **Description**
+        ------------------     -------------------------------------------------
+        title                  Optional string. Title of the page. Defaults to
+                               "Page" and its number.
+        ==================     =================================================
+        :return:
+           Index of the new page
+        """
+        pages = self.props['pages']
+        pages.append(_default_page(title or 'Page ' + str(len(pages) + 1)))
+        self._mark_dirty('model', 'contents', 'cards', 'layout')
+        return len(pages) - 1
+
+    def _check_page(self, page):
+        """
+        Raises InsightsWorkbookError if page isn't None, an existing page or
+        the index of a new page, before anything is sent to ArcGIS
+        """
+        if page is not None and page != len(self.props['pages']):
+            self._page(page)
+
+    def _page(self, page=None, cards=0):
+        """
+        Returns the index of the page a mutating method works on. page None
+        means the last page, or a new page if it can't take the given number
+        of new cards. page equal to the number of pages adds a new page.
+        """
+        pages = self.props['pages']
+        if page is None:
+            page = len(pages) - 1
+            if cards and \
+                    len(pages[page]['cards']) + cards > self.page_card_limit:
+                page = self.add_page()
+        elif page == len(pages):
+            page = self.add_page()
+        elif not isinstance(page, int) or not 0 <= page < len(pages):
+            raise InsightsWorkbookError('Invalid page: ' + str(page))
+        return page
+
+    def _attach(self, page, dataset):
+        """
+        Puts the model items (and data pane contents) a dataset depends on
+        onto a page, if they aren't there already. Insights only loads the
+        datasets of the page being viewed, so a card's datasets have to be
+        produced by its own page.
+        """
+        target = self.props['pages'][page]
+        missing = [copy.deepcopy(x)
+                   for x in self._index.supporting_items(dataset)
+                   if page not in self._index.pages.get(x['outDataset'], ())]
+        if not missing:
+            return
+        names = {x['outDataset'] for x in missing}
+        items = target['model']['items']
+        # Items already on the page that use them have to come after them
+        at = len(items)
+        for i, item in enumerate(items):
+            params = item.get('params')
+            if isinstance(params, dict) and params.get('dataset') in names:
+                at = i
+                break
+        items[at:at] = missing
+        listed = {x.get('dataset') for x in target['contents']}
+        for item in missing:
+            self._index.add_model_item(item, page)
+            name = item['outDataset']
+            if item.get('operation') == 'add-data' and name not in listed:
+                target['contents'].append({'dataset': name})
+        self._mark_dirty('model', 'contents')
+
+    def _packer(self, page):
+        """ LayoutPacker for a page, kept up to date with its layout """
+        layout = self.props['pages'][page]['layout']
+        entry = self._packers.get(page)
+        if entry is None or entry[0] is not layout or \
+                entry[1] != len(layout):
+            entry = [layout, len(layout), LayoutPacker(cells=layout)]
+            self._packers[page] = entry
+        return entry
+
+    def _add_card(self, page, card, w=20, h=20):
+        """ Adds a card to a page, packed into the page's layout """
+        entry = self._packer(page)
+        x, y = entry[2].place(w, h)
+        target = self.props['pages'][page]
+        target['cards'].append(card)
+        target['layout'].append({
+            "x": x,
+            "y": y,
+            "w": w,
+            "h": h
+        })
+        entry[1] += 1
+        self._mark_dirty('cards', 'layout')
+
+    def pack_layout(self, page=None):
+        """
+        Repacks the cards of a page (or every page) into a grid, keeping
+        their order and sizes. Useful for workbooks whose cards were laid out
+        in a single wide row.
+
+        ==================     =================================================
+        **Argument**           **Description**
+        ------------------     -------------------------------------------------
+        page                   Optional int. Index of the page to repack.
+                               Defaults to all of them.
+        ==================     =================================================
+        """
+        pages = self.props['pages']
+        if page is None:
+            indexes = range(len(pages))
+        else:
+            indexes = [self._page(page)]
+        for i in indexes:
+            packer = LayoutPacker()
+            # Top to bottom, then left to right, as they appear on screen
+            cells = sorted(pages[i]['layout'],
+                           key=lambda cell: (cell['y'], cell['x']))
+            for cell in cells:
+                cell['x'], cell['y'] = packer.place(cell['w'], cell['h'])
+            self._packers.pop(i, None)
+        self._mark_dirty('layout')
+
+    def extent_index(self):
+        """
+        Returns an ExtentIndex over the extents of this Workbook's datasets.
+        It's built on first use and kept until the datasets change.
+        """
+        if self._extents is None:
+            datasets = self.props['workspace']['datasets']
+            extents = {}
+            for name in list(datasets):
+                dataset = self._index.dataset(name)
+                extent = dataset.get('extent') \
+                    if isinstance(dataset, _JSON_OBJECT) else None
+                if isinstance(extent, _JSON_OBJECT):
+                    extents[name] = extent
+            self._extents = ExtentIndex(extents)
+        return self._extents
+
+    def datasets_in(self, region):
+        """
+        Returns the names of the datasets whose extents intersect a region
+
+        ==================     =================================================
+        **Argument**           **Description**
+        ------------------     -------------------------------------------------
+        region                 Required extent dict (with a spatialReference),
+                               or (xmin, ymin, xmax, ymax) tuple in WGS 84.
+        ==================     =================================================
+        """
+        return self.extent_index().intersecting(region)
+
+    def add_map(self, dataset=None, page=None, region=None):
+        """
+        Adds a map card for the specified feature layer dataset(s)
+
+        ==================     =================================================
+        **Argument**           **Description**
+        ------------------     -------------------------------------------------
+        dataset                Optional string or list of strings. Internal
+                               dataset name(s) for the feature layer(s) to add
+                               to the map. Can get this value when feature
+                               layer is added to the Workbook. Alternatively,
+                               can look it up in the props. Defaults to every
+                               dataset that intersects region.
+        ------------------     -------------------------------------------------
+        page                   Optional int. Index of the page to add the card
+                               to. Defaults to the last page, or a new page
+                               once the last one has page_card_limit cards.
+        ------------------     -------------------------------------------------
+        region                 Optional extent dict, or (xmin, ymin, xmax,
+                               ymax) tuple in WGS 84, to show on the map.
+                               Defaults to the union of the datasets' extents.
+        ==================     =================================================
+        """
+        if dataset is None:
+            if region is None:
+                raise InsightsWorkbookError('No dataset or region given')
+            datasets = self.datasets_in(region)
+            if not datasets:
+                raise InsightsWorkbookError('No datasets intersect region: ' +
+                                            str(region))
+        elif isinstance(dataset, str):
+            datasets = [dataset]
+        else:
+            datasets = list(dataset)
+        # Grab full dataset info from the index
+        layer_datasets = []
+        for name in datasets:
+            layer_dataset = self._index.dataset(name)
+            if not layer_dataset:
+                raise InsightsWorkbookError('Invalid dataset name: ' +
+                                            str(name))
+            layer_datasets.append(layer_dataset)
+        if region is not None:
+            my_extent = copy.deepcopy(_region_extent(region))
+        elif len(layer_datasets) == 1:
+            # Get extent of this layer
+            my_extent = layer_datasets[0]['extent']
+        else:
+            my_extent = extent_union(x.get('extent') for x in layer_datasets)
+        page = self._page(page, 1)
+        for name in datasets:
+            self._attach(page, name)
+        # Get current number of cards
+        card_ct = len(self.props['pages'][page]['cards'])
+        # Add map, with layers and extent
+        self._add_card(page, {
+            'type': 'map',
+            'title': 'Card ' + str(card_ct+1),
+            'content': {
+                'layers': [{'datasetId': x} for x in datasets],
+                'extent': my_extent
+            }
+        })
+
+    def aggregate(self, in_dataset, groupby_field, groupby_field_type,
+                  stat_type, stat_field, stat_field_type, out_name=None,
+                  reuse=True, page=None):
+        """
+        Aggregates data based on the group-by layer using the specified
+        statistic over the specified field.
+
+        ==================     =================================================
+        **Argument**           **Description**
+        ------------------     -------------------------------------------------
         in_dataset             Required str. Internal name of dataset to use for
                                aggregating.
         ------------------     -------------------------------------------------
@@ -444,26 +3570,43 @@ class InsightsWorkbook(object):
                                esriFieldTypeDouble, esriFieldTypeInteger, etc.
         ------------------     -------------------------------------------------
         out_name               Optional str. Name of dataset to show to user.
+        ------------------     -------------------------------------------------
+        reuse                  Optional bool. If the same aggregation already
+                               exists in this Workbook, return its dataset
+                               rather than creating a duplicate.
+        ------------------     -------------------------------------------------
+        page                   Optional int. Index of the page to add the
+                               aggregation to. Defaults to the last page.
         ==================     =================================================
         :return:
-           String name of new internal Insights Workbook dataset for this
+           String name of the internal Insights Workbook dataset for this
            aggregation
         """
+        if stat_type not in workbook_validator.stat_types:
+            raise InsightsWorkbookError('Invalid statistic type: ' +
+                                        str(stat_type))
+        if self._index.dataset(in_dataset) is None:
+            raise InsightsWorkbookError('Invalid dataset name: ' +
+                                        str(in_dataset))
+        page = self._page(page)
+        # Reuse an identical aggregation if there already is one
+        aggregate_key = (in_dataset, (groupby_field,),
+                         ((stat_type, stat_field),))
+        existing = self._index.aggregates.get(aggregate_key)
+        if reuse and existing is not None and self._index.dataset(existing):
+            self._attach(page, existing)
+            return existing
+        self._attach(page, in_dataset)
         # Get base name of dataset so we can generate a new suffix for new
         # aggregate dataset
         in_dataset_base = in_dataset[:in_dataset.find('_')]
         # Generate new dataset name with 7 random hex digits as suffix
         out_dataset = in_dataset_base + '_%07x' % random.randrange(16**7)
         # New field for storing aggregation
-        out_field = stat_field.lower() + '_' + stat_type
-        if stat_type == 'count':
-            out_type = 'esriFieldTypeInteger'
-        elif stat_type == 'avg':
-            out_type = 'esriFieldTypeDouble'
-        else:
-            out_type = stat_field_type
+        out_field, out_type = _aggregate_out_field(stat_type, stat_field,
+                                                   stat_field_type)
         # Perform aggregate operation
-        self.props['pages'][0]['model']['items'].append({
+        model_item = {
             'operation': 'aggregate',
             'params': {
                 'dataset': in_dataset,
@@ -476,8 +3619,10 @@ class InsightsWorkbook(object):
                 'totals': False
             },
             'outDataset': out_dataset
-        })
-        in_data_id = self.props['workspace']['datasets'][in_dataset]['data']
+        }
+        self.props['pages'][page]['model']['items'].append(model_item)
+        self._index.add_model_item(model_item, page)
+        in_data_id = self._index.dataset(in_dataset)['data']
         # If no name specified for this dataset just use internal ID
         if not out_name:
             out_name = out_dataset
@@ -485,19 +3630,9 @@ class InsightsWorkbook(object):
         self.props['workspace']['datasets'][out_dataset] = {
             'data': {
                 'metadata': {
-                    'fields': [
-                        {
-                            'name': groupby_field,
-                            'alias': groupby_field,
-                            'type': groupby_field_type,
-                            'entity': 'e0'
-                        },
-                        {
-                            'name': out_field,
-                            'alias': out_field,
-                            'type': out_type
-                        }
-                    ],
+                    'fields': _aggregate_metadata_fields(
+                        groupby_field, groupby_field_type, out_field,
+                        out_type),
                     'entities': [{
                         'fields': [
                             groupby_field,
@@ -530,94 +3665,1783 @@ class InsightsWorkbook(object):
                 groupby_field: {}
             }
         }
+        self._index.add_dataset(
+            out_dataset, self.props['workspace']['datasets'][out_dataset])
+        self._mark_dirty('model', 'datasets')
         return out_dataset
 
-    def add_chart(self, chart_type, in_dataset, groupby_field,
-                  groupby_field_type, stat_type, stat_field, stat_field_type):
+    def add_chart(self, chart_type, in_dataset, groupby_field,
+                  groupby_field_type, stat_type, stat_field, stat_field_type,
+                  page=None):
+        """
+        Aggregates data based on the group-by layer using the specified
+        statistic over the specified field.
+
+        ==================     =================================================
+        **Argument**           **Description**
+        ------------------     -------------------------------------------------
+        chart_type             Required str. Type of chart to create. Acceptable
+                               values are bar and column.
+        ------------------     -------------------------------------------------
+        in_dataset             Required str. Internal name of dataset to use for
+                               aggregating.
+        ------------------     -------------------------------------------------
+        groupby_field          Required str. Name of the field to group by.
+        ------------------     -------------------------------------------------
+        groupby_field_type     Required str. Type of field. Acceptable values
+                               include esriFieldTypeString, esriFieldTypeDouble,
+                               esriFieldTypeInteger, etc.
+        ------------------     -------------------------------------------------
+        stat_type              Required str. Type of aggregation statistic.
+                               Acceptable values include avg, sum, count, min
+                               and max.
+        ------------------     -------------------------------------------------
+        stat_field             Required str. Name of the field to use in
+                               calculation.
+        ------------------     -------------------------------------------------
+        stat_field_type        Required str. Type of field for output.
+                               Acceptable values include esriFieldTypeString,
+                               esriFieldTypeDouble, esriFieldTypeInteger, etc.
+        ------------------     -------------------------------------------------
+        page                   Optional int. Index of the page to add the card
+                               and its aggregation to. Defaults to the last
+                               page, or a new page once the last one has
+                               page_card_limit cards.
+        ==================     =================================================
+        """
+        if chart_type not in workbook_validator.chart_types:
+            raise InsightsWorkbookError('Invalid chart type: ' +
+                                        str(chart_type))
+        # Check what aggregate() would before a new page is added for the card
+        if stat_type not in workbook_validator.stat_types:
+            raise InsightsWorkbookError('Invalid statistic type: ' +
+                                        str(stat_type))
+        if self._index.dataset(in_dataset) is None:
+            raise InsightsWorkbookError('Invalid dataset name: ' +
+                                        str(in_dataset))
+        page = self._page(page, 1)
+        # Get count of cards
+        card_ct = len(self.props['pages'][page]['cards'])
+        # Set chart title
+        chart_title = chart_type.title() + " Chart " + str(card_ct+1)
+        # Create aggregation dataset for this chart
+        out_dataset = self.aggregate(in_dataset, groupby_field,
+                                     groupby_field_type, stat_type, stat_field,
+                                     stat_field_type, chart_title, page=page)
+        # Create the chart card
+        self._add_card(page, {
+            'title': 'Card ' + str(card_ct+1),
+            'type': 'chart',
+            'content': {
+                'layers': [{
+                    'datasetId': out_dataset,
+                    'chartLines': {
+                        'mean': True
+                    },
+                    'colors': {}
+                }],
+                'type': chart_type
+            }
+        })
+
+    def compact(self):
+        """
+        Merges duplicate aggregations (same input dataset, group-by fields
+        and statistics) into the first one, pointing every card, page content
+        and dependent dataset at it, and removes the duplicates. Useful for
+        workbooks built up before aggregate() reused existing datasets.
+
+        :return:
+           Dict of removed dataset name to the dataset name it was merged into
+        """
+        merged = {}
+        datasets = self.props['workspace']['datasets']
+        # Merging can make aggregations built on top of the duplicates
+        # identical too, so keep going until nothing else merges
+        while True:
+            first = {}
+            duplicates = {}
+            for page in self.props['pages']:
+                for item in page['model']['items']:
+                    aggregate_key = _aggregate_key(item)
+                    if aggregate_key is None:
+                        continue
+                    if aggregate_key not in first:
+                        first[aggregate_key] = item['outDataset']
+                    elif first[aggregate_key] != item['outDataset']:
+                        # Not the same item copied onto another page
+                        duplicates[item['outDataset']] = first[aggregate_key]
+            if not duplicates:
+                break
+            # Survivors now used on pages that may not produce them
+            used = set()
+            for i, page in enumerate(self.props['pages']):
+                page['model']['items'] = [
+                    x for x in page['model']['items']
+                    if x.get('outDataset') not in duplicates]
+                for item in page['model']['items']:
+                    params = item.get('params', {})
+                    if params.get('dataset') in duplicates:
+                        params['dataset'] = duplicates[params['dataset']]
+                        used.add((i, params['dataset']))
+                page['contents'] = [
+                    x for x in page['contents']
+                    if x.get('dataset') not in duplicates]
+                for card in page['cards']:
+                    for layer in card.get('content', {}).get('layers', []):
+                        if layer.get('datasetId') in duplicates:
+                            layer['datasetId'] = \
+                                duplicates[layer['datasetId']]
+                            used.add((i, layer['datasetId']))
+            # Derived datasets embed the data of their input dataset
+            removed = {x: y for x, y in duplicates.items()
+                       if x in datasets and y in datasets}
+            self._index.propagate(
+                {x: datasets[x]['data'] for x in removed}, removed)
+            for name in removed:
+                self._index.remove_dataset(name)
+                del datasets[name]
+            merged.update(duplicates)
+            self.reindex()
+            for i, name in sorted(used):
+                self._attach(i, name)
+        # Collapse chains of merges so every entry points at the survivor
+        for name in merged:
+            while merged[name] in merged:
+                merged[name] = merged[merged[name]]
+        if merged:
+            self._mark_dirty('model', 'contents', 'cards', 'datasets')
+        return merged
+
+    def save(self, force=False, merge=True):
+        """
+        Saves the Insights Workbook to ArcGIS with all the current properties.
+        If nothing changed since the Workbook was last saved or opened, the
+        upload is skipped.
+
+        For a Workbook that was opened, the item's modified time is checked
+        first. If someone else saved it in the meantime, their version is
+        downloaded and the local changes are merged into it, so neither set
+        of changes is lost. ArcGIS has no conditional update, so this narrows
+        the window for lost updates rather than closing it. The modified time
+        isn't read back after an upload, since it can't be told apart from a
+        save made right after it, so the save after that downloads and merges
+        the workbook once more, even if nothing else changed. Cards added on
+        both sides are placed again so they don't overlap, layers refreshed on
+        both sides keep the newer refresh, and datasets derived on one side
+        from a layer refreshed on the other are brought up to date.
+
+        ==================     =================================================
+        **Argument**           **Description**
+        ------------------     -------------------------------------------------
+        force                  Optional bool. Upload even if the content is
+                               unchanged.
+        ------------------     -------------------------------------------------
+        merge                  Optional bool. Check for and merge changes made
+                               in ArcGIS since the Workbook was opened. If
+                               False, they're overwritten.
+        ==================     =================================================
+        :return:
+           True if the Workbook was uploaded, False if it was unchanged
+
+        Raises InsightsWorkbookConflict if changes made in ArcGIS overlap the
+        local ones.
+        """
+        request = self._save_request(force)
+        if request is None:
+            return False
+        con = self._gis._portal.con
+        info_url = self._session.item_info_url(self._workspaceID)
+        try:
+            if merge and self._modified is not None:
+                info = self._transport.call(
+                    'getItem', info_url, None,
+                    lambda: con.get(info_url, {'f': 'json'}),
+                    self._workspaceID)
+                if info.get('modified') != self._modified:
+                    data_url = self._session.item_data_url(
+                        self._workspaceID)
+                    remote = self._transport.call(
+                        'getData', data_url, None,
+                        lambda: con.get(data_url, {'f': 'json'}),
+                        self._workspaceID)
+                    self._merge(remote, info.get('modified'))
+                    request = self._save_request(True)
+            update_url, post_data, content_hash = request
+            self._transport.call(
+                'updateItem', update_url, post_data,
+                lambda: self._session.post(update_url, post_data),
+                self._workspaceID)
+        except InsightsWorkbookConflict:
+            raise
+        except Exception as e:
+            raise InsightsWorkbookError('Error saving workspace: ' +
+                                        str(e)) from e
+        # _modified stays as it was. A modified time read now could already
+        # include someone else's save, which would then be overwritten
+        # unmerged, so the next save merges with whatever is there instead
+        self._saved(content_hash, post_data['text'])
+        return True
+
+    def _save_request(self, force=False):
+        """
+        Returns the URL, POST data and content hash for saving this Workbook,
+        or None if it's unchanged and doesn't need to be uploaded. The text
+        in the POST data is a list of strings, which WorkbookSession.post()
+        sends joined.
+        """
+        text, content_hash = self._save_text()
+        if not force and content_hash == self._saved_hash:
+            self._dirty.clear()
+            return None
+        # Check what's about to be uploaded. Only the parts changed through
+        # this class need checking, unless props were changed directly, and
+        # only the elements added or replaced since the last open or save
+        if isinstance(self.props, LazyObject) or not self._dirty:
+            # Changes made directly to props can break the structure, too
+            _check_structure(self.props)
+        workbook_validator.validate(self.props, self._dirty or None,
+                                    self._known)
+        post_data = {
+            'f': 'json',
+            'title': self._title,
+            'text': text}
+        # Basically just a standard ArcGIS item update with the updated JSON
+        # properties
+        update_url = self._session.item_update_url(self._workspaceID)
+        return update_url, post_data, content_hash
+
+    def _saved(self, content_hash, text):
+        """ Records that the content with this hash was uploaded """
+        self._saved_hash = content_hash
+        self._base = text
+        self._dirty.clear()
+        self._refreshed = {}
+        self._baseline()
+
+    def _merge(self, remote, modified):
+        """
+        Three-way merges the changes made to props since they were last
+        opened or saved into remote, the props now stored in ArcGIS, which
+        become this Workbook's props. Raises InsightsWorkbookConflict if both
+        sides changed the same part.
+
+        Datasets refreshed on both sides keep the newer refresh: the local
+        one if it was made after the item's modified time in ArcGIS (so this
+        relies on the local clock roughly agreeing with the portal's), or
+        else the one in ArcGIS. Afterwards, everything derived from a dataset
+        whose data changed, on either side, is pointed at its current data.
+        """
+        if isinstance(self.props, LazyObject):
+            base = LazyObject(''.join(self._base))
+        else:
+            base = json.loads(''.join(self._base))
+        local_ops = _json_diff(base, self.props)
+        remote_ops = _json_diff(base, remote)
+        local_ops, checked_ops, losing = self._resolve_refreshes(
+            local_ops, remote_ops, modified)
+        conflicts = _patch_conflicts(local_ops, checked_ops)
+        if conflicts:
+            raise InsightsWorkbookConflict(conflicts)
+        # Data the local changes replace, which datasets derived on the
+        # remote side may still be built on
+        base_datasets = base['workspace']['datasets']
+        old_data = {name: base_datasets[name]['data']
+                    for name in _data_changes(local_ops)
+                    if name in base_datasets}
+        self._base = _props_chunks(remote)
+        self._modified = modified
+        self.props = remote
+        # What's in ArcGIS was validated when it was saved, the local changes
+        # applied to it still have to be
+        self._baseline()
+        _json_apply(remote, local_ops)
+        self._replace_cells(local_ops, remote_ops)
+        self.reindex()
+        for replaced in (old_data, losing):
+            if replaced:
+                self._index.propagate(replaced)
+
+    def _resolve_refreshes(self, local_ops, remote_ops, modified):
+        """
+        Settles datasets refreshed on both sides of a merge in favour of the
+        newer refresh (see _merge()). Returns the local operations to apply,
+        the remote operations to check them against for conflicts, and a
+        dict of dataset name to the data ID of the losing refresh, for
+        propagate() to replace.
+        """
+        local = _refreshed_data(local_ops)
+        remote = _refreshed_data(remote_ops)
+        both = [x for x in local if x in remote and local[x] != remote[x]]
+        if not both:
+            return local_ops, remote_ops, {}
+        modified = modified if isinstance(modified, (int, float)) else 0
+        losing = {}
+        local_wins = []
+        remote_wins = []
+        for name in both:
+            prefix = _pointer('/workspace/datasets', name)
+            if self._refreshed.get(name, 0) > modified:
+                losing[name] = remote[name]
+                local_wins.append(prefix)
+            else:
+                losing[name] = local[name]
+                remote_wins.append(prefix)
+
+        def under(op, prefixes):
+            return any(op['path'] == x or op['path'].startswith(x + '/')
+                       for x in prefixes)
+
+        checked_ops = [x for x in remote_ops if not under(x, local_wins)]
+        # Both sides also pointed what's derived from those datasets at their
+        # own refresh. Keep the remote side's, for propagate() to redo.
+        local_ops = [x for x in local_ops if not under(x, remote_wins) and not
+                     (_is_data_reference(x) and
+                      _patch_conflicts([x], checked_ops))]
+        return local_ops, checked_ops, losing
+
+    def _replace_cells(self, local_ops, remote_ops):
+        """
+        Places the layout cells appended by local_ops again, around the
+        cells on their page after a merge. Cards added on both sides were
+        placed against the same layout, so they'd overlap otherwise. Pages
+        whose layout remote_ops didn't touch are left as they are.
+        """
+        appended = {}
+        for op in local_ops:
+            match = _LAYOUT_APPEND.match(op['path'])
+            if match:
+                appended.setdefault(int(match.group(1)), []).append(
+                    op['value'])
+        for page, cells in appended.items():
+            prefix = '/pages/%d/layout' % page
+            if not any(x['path'] == prefix or
+                       x['path'].startswith(prefix + '/')
+                       for x in remote_ops):
+                continue
+            local = {id(x) for x in cells}
+            packer = LayoutPacker(cells=[
+                x for x in self.props['pages'][page]['layout']
+                if id(x) not in local])
+            for cell in cells:
+                cell['x'], cell['y'] = packer.place(cell['w'], cell['h'])
+
+
+class WorkbookCache(object):
+    """
+    Persistent local cache of Insights workbook data, stored compressed in a
+    SQLite database and keyed by item ID and the item's modified time. When
+    the cache grows past max_bytes, the least recently used workbooks are
+    evicted. A single cache can be shared between threads.
+
+    ================    ========================================================
+    **Argument**        **Description**
+    ----------------    --------------------------------------------------------
+    path                Required string. Path of the SQLite database file. It
+                        is created if it doesn't exist.
+    ----------------    --------------------------------------------------------
+    max_bytes           Optional int. Maximum total size of the compressed
+                        workbook data held in the cache.
+    ================    ========================================================
+    """
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS workbooks ('
+                         'item_id TEXT PRIMARY KEY, modified INTEGER, '
+                         'data BLOB, size INTEGER, accessed REAL)')
+        self._db.commit()
+
+    def get(self, item_id, modified, raw=False):
+        """
+        Returns the cached props for an item if they were stored for the same
+        modified time, otherwise None. If raw is True, the props are returned
+        as JSON text rather than parsed.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT data FROM workbooks WHERE item_id = ? AND '
+                'modified IS ?', (item_id, modified)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE workbooks SET accessed = ? '
+                             'WHERE item_id = ?', (time.time(), item_id))
+            self._db.commit()
+            text = zlib.decompress(row[0])
+            self.hits += 1
+            self.bytes_saved += len(text)
+        if raw:
+            return text.decode('utf-8')
+        return json.loads(text.decode('utf-8'))
+
+    def put(self, item_id, modified, props):
+        """
+        Stores the props (a dict, or JSON text) for an item at the given
+        modified time, replacing any older version, then evicts workbooks
+        until the cache fits.
+        """
+        if not isinstance(props, str):
+            props = _dumps_props(props)
+        data = zlib.compress(props.encode('utf-8'))
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO workbooks VALUES (?, ?, ?, ?, ?)',
+                (item_id, modified, data, len(data), time.time()))
+            total = self._db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM workbooks').fetchone()[0]
+            if total > self.max_bytes:
+                rows = self._db.execute(
+                    'SELECT item_id, size FROM workbooks '
+                    'ORDER BY accessed').fetchall()
+                for old_id, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    self._db.execute('DELETE FROM workbooks '
+                                     'WHERE item_id = ?', (old_id,))
+                    total -= size
+            self._db.commit()
+
+    def invalidate(self, item_id=None):
+        """ Removes one item from the cache, or every item if none is given """
+        with self._lock:
+            if item_id is None:
+                self._db.execute('DELETE FROM workbooks')
+            else:
+                self._db.execute('DELETE FROM workbooks WHERE item_id = ?',
+                                 (item_id,))
+            self._db.commit()
+
+    def stats(self):
+        """
+        Returns a dict of cache statistics: hits, misses, bytes_saved (size
+        of the workbook data that didn't have to be downloaded), entries and
+        size (compressed bytes currently stored).
+        """
+        with self._lock:
+            entries, size = self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) '
+                'FROM workbooks').fetchone()
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'bytes_saved': self.bytes_saved,
+                'entries': entries,
+                'size': size}
+
+    def close(self):
+        """ Closes the underlying database """
+        self._db.close()
+
+
+def refresh_workbooks(layers, workbook_items, sublayer=0,
+                      max_workers=REFRESH_MAX_WORKERS,
+                      chunk_size=EXECUTE_CHUNK_SIZE, cache=None, lazy=True,
+                      session=None):
+    """
+    Refreshes every workbook that uses any of the provided feature layers,
+    e.g. after the layers were overwritten. Each workbook is opened, updated
+    and saved on a pool of worker threads, and a failure in one workbook
+    doesn't stop the others from being refreshed.
+
+    ==================     =====================================================
+    **Argument**           **Description**
+    ------------------     -----------------------------------------------------
+    layers                 Required arcgis.gis.Item, tuple or list. A feature
+                           layer, an (Item, sublayer index) tuple, or a list or
+                           tuple of entries that are either feature layer Items
+                           or (Item, sublayer index) tuples.
+    ------------------     -----------------------------------------------------
+    workbook_items         Required list of arcgis.gis.Item. The "Insights
+                           Workbook" items to check and refresh.
+    ------------------     -----------------------------------------------------
+    sublayer               Optional int. Index of the sublayer to use for
+                           entries that don't specify their own.
+    ------------------     -----------------------------------------------------
+    max_workers            Optional int. Maximum number of workbooks refreshed
+                           at the same time.
+    ------------------     -----------------------------------------------------
+    chunk_size             Optional int. Maximum number of add-data tools sent
+                           in a single execute call.
+    ------------------     -----------------------------------------------------
+    cache                  Optional WorkbookCache used when opening workbooks.
+    ------------------     -----------------------------------------------------
+    lazy                   Optional bool. Open the workbooks lazily (see
+                           InsightsWorkbook.open()), so only the datasets that
+                           are refreshed get parsed and re-encoded.
+    ------------------     -----------------------------------------------------
+    session                Optional WorkbookSession used for all the workbooks.
+                           Defaults to the one shared by each item's GIS.
+    ==================     =====================================================
+    :return:
+       List of RefreshResult tuples, in the same order as workbook_items
+    """
+    layers = _layer_entries(layers)
+    # The layers were presumably just overwritten, so drop their cached
+    # properties. The first workbook to need them fetches them again, and
+    # the others wait for that fetch rather than making their own.
+    for layer in layers:
+        layer_metadata.invalidate(_layer_and_sublayer(layer, sublayer)[0])
+
+    def refresh(item):
+        try:
+            workbook = InsightsWorkbook.open(item, cache, lazy=lazy,
+                                             session=session)
+            names = workbook.update_datasets(layers, sublayer, chunk_size)
+            names = [x for x in names if x is not None]
+            # Don't upload workbooks that don't use any of these layers
+            if names:
+                workbook.save()
+            return RefreshResult(item, names, None)
+        except Exception as e:
+            return RefreshResult(item, [], e)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(refresh, workbook_items))
+
+
+# Placeholder for a per-workbook value in a compiled WorkbookTemplate
+_TEMPLATE_SLOT = re.compile(r'"\{\{iw:(\w+):(\d+)\}\}"')
+
+
+class WorkbookTemplate(object):
+    """
+    Pages, cards, aggregations and layout of an existing workbook, captured
+    so that many copies of it can be provisioned with different feature
+    layers, e.g. the same dashboard for every region. The workbook is
+    compiled once into JSON text with slots for the data IDs, layer URLs,
+    owners and extents of its layers, and for the extent of each map card,
+    so each copy only costs filling in those slots. A map card's extent is
+    the union of the extents of the copy's layers it shows, region cards
+    included.
+
+    ================    ========================================================
+    **Argument**        **Description**
+    ----------------    --------------------------------------------------------
+    workbook            Required InsightsWorkbook to capture. Every dataset it
+                        added from a feature layer becomes a source, to be
+                        substituted in each copy.
+    ================    ========================================================
+
+    ================    ========================================================
+    **Attribute**       **Description**
+    ----------------    --------------------------------------------------------
+    sources             List of (dataset name, layer URL) tuples for the
+                        template's feature layers. Each copy is given one layer
+                        per source, in this order.
+    ================    ========================================================
+    """
+
+    def __init__(self, workbook):
+        # Work on a copy so the workbook itself isn't touched
+        props = json.loads(_dumps_props(workbook.props))
+        _check_structure(props)
+        datasets = props['workspace']['datasets']
+        self.sources = []
+        slots = {}
+        data_slots = {}
+        for page in props['pages']:
+            for item in page['model']['items']:
+                name = item.get('outDataset')
+                if item.get('operation') != 'add-data' or \
+                        name not in datasets:
+                    continue
+                if name not in slots:
+                    # First of the copies of the item on different pages
+                    slot = slots[name] = len(self.sources)
+                    self.sources.append((name, item['params']['data']['url']))
+                    dataset = datasets[name]
+                    data_slots[_data_key(dataset['data'])] = slot
+                    # Keep the dataset's name, field aliases etc.
+                    dataset['owner'] = '{{iw:owner:%d}}' % slot
+                    dataset['extent'] = '{{iw:extent:%d}}' % slot
+                item['params']['data']['url'] = \
+                    '{{iw:url:%d}}' % slots[name]
+        # Source slots of the layers on each map card, whose extent is
+        # worked out from the copy's layers
+        self._maps = []
+        for page in props['pages']:
+            for card in page['cards']:
+                content = card.get('content')
+                if not isinstance(content, dict) or 'extent' not in content:
+                    continue
+                shown = sorted({slots[x.get('datasetId')]
+                                for x in content.get('layers', [])
+                                if x.get('datasetId') in slots})
+                if shown:
+                    content['extent'] = '{{iw:map:%d}}' % len(self._maps)
+                    self._maps.append(shown)
+        # Derived datasets embed the data IDs of the layers they're built on,
+        # and source datasets hold their own
+        for name, dataset in datasets.items():
+            if isinstance(dataset, dict):
+                self._slot_data(dataset, data_slots)
+        props['title'] = '{{iw:title:0}}'
+        for key in ('id', 'owner', 'name', 'url'):
+            props.pop(key, None)
+        # Alternating literal text and (kind, slot) pairs
+        parts = _TEMPLATE_SLOT.split(json.dumps(props))
+        self._parts = [(parts[i], parts[i + 1], int(parts[i + 2]))
+                       for i in range(0, len(parts) - 1, 3)]
+        self._tail = parts[-1]
+
+    @classmethod
+    def _slot_data(cls, value, data_slots):
+        """ Replaces data IDs of the sources with slots, recursively """
+        items = value.items() if isinstance(value, dict) else \
+            enumerate(value)
+        for key, child in items:
+            if isinstance(child, (dict, list)):
+                cls._slot_data(child, data_slots)
+            elif isinstance(child, str) and child in data_slots:
+                value[key] = '{{iw:data:%d}}' % data_slots[child]
+
+    def render(self, title, layers, data):
         """
-        Aggregates data based on the group-by layer using the specified
-        statistic over the specified field.
+        Returns the JSON props of a copy of the template.
 
         ==================     =================================================
         **Argument**           **Description**
         ------------------     -------------------------------------------------
-        chart_type             Required str. Type of chart to create. Acceptable
-                               values are bar and column.
+        title                  Required string. Title of the copy.
         ------------------     -------------------------------------------------
-        in_dataset             Required str. Internal name of dataset to use for
-                               aggregating.
+        layers                 Required list of (Item, sublayer) tuples, one per
+                               source.
+        ------------------     -------------------------------------------------
+        data                   Required dict. Dataset name to the data ID that
+                               execute returned for it in the copy.
+        ==================     =================================================
+        """
+        values = {'title': [json.dumps(title)], 'url': [], 'data': [],
+                  'owner': [], 'extent': [], 'map': []}
+        extents = []
+        for (name, _), (lyr, sublayer) in zip(self.sources, layers):
+            values['url'].append(json.dumps(lyr.url + '/' + str(sublayer)))
+            values['data'].append(json.dumps(data[name]))
+            values['owner'].append(json.dumps(lyr.id))
+            extents.append(layer_metadata.extent(lyr, sublayer))
+            values['extent'].append(json.dumps(extents[-1]))
+        # A map shows the union of the extents of its layers, as add_map()
+        # would have given it
+        for shown in self._maps:
+            found = [extents[i] for i in shown
+                     if isinstance(extents[i], _JSON_OBJECT)]
+            values['map'].append(json.dumps(
+                found[0] if len(found) == 1 else extent_union(found)))
+        out = []
+        for text, kind, slot in self._parts:
+            out.append(text)
+            out.append(values[kind][slot])
+        out.append(self._tail)
+        return ''.join(out)
+
+    def provision(self, gis, jobs, sublayer=0,
+                  max_workers=PROVISION_MAX_WORKERS,
+                  chunk_size=EXECUTE_CHUNK_SIZE, transport=None,
+                  progress=None, session=None):
+        """
+        Creates a copy of the template for every job. Each copy is created,
+        has all of its layers added in batched execute calls, and is saved
+        with the rendered props, with up to max_workers copies in flight at
+        once. A failure in one copy doesn't stop the others.
+
+        ==================     =================================================
+        **Argument**           **Description**
+        ------------------     -------------------------------------------------
+        gis                    Required arcgis.gis.GIS to create the workbooks
+                               in.
+        ------------------     -------------------------------------------------
+        jobs                   Required list of (title, layers) tuples. layers
+                               has one entry per source, each either a feature
+                               layer Item or an (Item, sublayer) tuple. Titles
+                               must be unique.
+        ------------------     -------------------------------------------------
+        sublayer               Optional int. Sublayer used for layers that
+                               don't specify their own.
+        ------------------     -------------------------------------------------
+        max_workers            Optional int. Maximum number of workbooks
+                               provisioned at the same time.
+        ------------------     -------------------------------------------------
+        chunk_size             Optional int. Maximum number of add-data tools
+                               sent in a single execute call.
+        ------------------     -------------------------------------------------
+        transport              Optional Transport used for REST calls.
+        ------------------     -------------------------------------------------
+        progress               Optional dict, updated in place with the state
+                               of each job by title. It only holds strings, so
+                               it can be stored as JSON. Passing the progress
+                               of an interrupted run skips the steps that
+                               already succeeded, so the failed jobs can be
+                               retried without creating duplicate workbooks.
+        ------------------     -------------------------------------------------
+        session                Optional WorkbookSession for the gis. If it
+                               pools connections, its pool_size should be at
+                               least max_workers.
+        ==================     =================================================
+        :return:
+           List of ProvisionResult tuples, in the same order as jobs
+        """
+        session = session or WorkbookSession.of(gis)
+        transport = transport or session.transport
+        if progress is None:
+            progress = {}
+        lock = threading.Lock()
+
+        def record(title, **state):
+            with lock:
+                progress.setdefault(title, {}).update(state)
+
+        def provision(job):
+            title, layers = job
+            workbook = None
+            try:
+                layers = [_layer_and_sublayer(x, sublayer) for x in layers]
+                if len(layers) != len(self.sources):
+                    raise InsightsWorkbookError(
+                        'Expected ' + str(len(self.sources)) + ' layers, got '
+                        + str(len(layers)))
+                with lock:
+                    state = dict(progress.get(title, {}))
+                if state.get('saved'):
+                    return ProvisionResult(title, None, None)
+                if 'workspace_id' in state:
+                    workbook_id = state['workbook_id']
+                    workbook = InsightsWorkbook(
+                        gis, title, workbook_id, state['workspace_id'],
+                        session.workspace_url(workbook_id), None, transport,
+                        session)
+                else:
+                    workbook = InsightsWorkbook.new(gis, title, transport,
+                                                    session)
+                    record(title, workbook_id=workbook._workbookID,
+                           workspace_id=workbook._workspaceID)
+                data = state.get('data')
+                if data is None:
+                    data = workbook._execute_add_data(
+                        [(lyr.url + '/' + str(lyr_sublayer), name)
+                         for (name, _), (lyr, lyr_sublayer)
+                         in zip(self.sources, layers)], chunk_size)
+                    record(title, data=data)
+                workbook.props = LazyObject(self.render(title, layers, data))
+                workbook.reindex()
+                workbook.save(force=True)
+                record(title, saved=True)
+                return ProvisionResult(title, workbook, None)
+            except Exception as e:
+                return ProvisionResult(title, workbook, e)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(provision, jobs))
+
+
+def _bounded_map(fn, iterable, max_workers):
+    """
+    Like ThreadPoolExecutor.map(), but only takes from iterable as results
+    are consumed, so no more than twice max_workers inputs and results are
+    held in memory at once. Yields the results in order.
+    """
+    window = max(1, max_workers) * 2
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for value in iterable:
+            pending.append(executor.submit(fn, value))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _item_metadata(item):
+    """ Properties of a workbook item kept in an archive """
+    return {key: _plain(getattr(item, key, None))
+            for key in _ARCHIVE_ITEM_KEYS}
+
+
+def _restored_item_props(meta):
+    """
+    Item update that restores the archived description of a workbook item,
+    or None if there's nothing to restore
+    """
+    item_props = {}
+    for key in ('tags', 'snippet', 'description'):
+        value = meta.get(key)
+        if isinstance(value, list):
+            value = ','.join(value)
+        if value:
+            item_props[key] = value
+    if item_props:
+        item_props['f'] = 'json'
+        return item_props
+    return None
+
+
+def _lineage(props):
+    """
+    Returns the lineage of every dataset in a workbook's props: the feature
+    layer URL and item ID it was added from, the data ID execute returned for
+    it, and the datasets it's derived from.
+    """
+    index = WorkbookIndex(props)
+    lineage = {}
+    for name in list(props.get('workspace', {}).get('datasets', {})):
+        dataset = index.dataset(name)
+        if not isinstance(dataset, _JSON_OBJECT):
+            continue
+        data = dataset.get('data')
+        origin = name in index.sources
+        lineage[name] = {
+            'url': index.sources.get(name),
+            'owner': dataset.get('owner') if origin else None,
+            'data': data if isinstance(data, str) else None,
+            'inputs': sorted(index.inputs.get(name, ()))}
+    return lineage
+
+
+def _replace_strings(text, replacements):
+    """
+    Replaces JSON string values in text that exactly match a key of
+    replacements with the corresponding value, in a single pass.
+    """
+    replacements = {json.dumps(old): json.dumps(new)
+                    for old, new in replacements.items() if old != new}
+    if not replacements:
+        return text
+    pattern = re.compile('|'.join(
+        re.escape(x) for x in sorted(replacements, key=len, reverse=True)))
+    return pattern.sub(lambda match: replacements[match.group()], text)
+
+
+def _remap_layer(url, layer_map):
+    """
+    Returns the (sublayer URL, item ID) a layer is moved to by layer_map, or
+    (url, None) if it isn't moved. Sublayer URLs in layer_map take
+    precedence over service URLs, which keep the sublayer index.
+    """
+    target = layer_map.get(url)
+    suffix = ''
+    if target is None:
+        service = _service_url(url)
+        target = layer_map.get(service)
+        suffix = url[len(service):]
+    if target is None:
+        return url, None
+    if isinstance(target, str):
+        return target.rstrip('/') + suffix, None
+    return target.url.rstrip('/') + suffix, target.id
+
+
+def export_workbooks(workbook_items, path, max_workers=ARCHIVE_MAX_WORKERS,
+                     transport=None):
+    """
+    Writes a backup of many workbooks to a single gzip-compressed archive.
+    Each workbook's JSON data is downloaded on a pool of worker threads and
+    written to the archive exactly as it's stored in ArcGIS, along with its
+    item properties and the lineage of its datasets (feature layer, data ID
+    and input datasets of each). Workbooks are written in order as they're
+    downloaded, so only a few are held in memory at once, however many are
+    exported. A failure in one workbook doesn't stop the others.
+
+    ==================     =====================================================
+    **Argument**           **Description**
+    ------------------     -----------------------------------------------------
+    workbook_items         Required iterable of arcgis.gis.Item. The "Insights
+                           Workbook" items to export.
+    ------------------     -----------------------------------------------------
+    path                   Required string. Path of the archive to write.
+    ------------------     -----------------------------------------------------
+    max_workers            Optional int. Maximum number of workbooks downloaded
+                           at the same time.
+    ------------------     -----------------------------------------------------
+    transport              Optional Transport used for REST calls. Defaults to
+                           the session of each item's GIS.
+    ==================     =====================================================
+    :return:
+       List of ExportResult tuples, in the same order as workbook_items
+    """
+    def fetch(item):
+        try:
+            session = WorkbookSession.of(item._gis)
+            text = (transport or session.transport).call(
+                'getData', session.item_data_url(item.id), None,
+                lambda: item.get_data(try_json=False), item.id)
+            if isinstance(text, bytes):
+                text = text.decode('utf-8')
+            record = {'item': _item_metadata(item),
+                      'lineage': _lineage(LazyObject(text))}
+            return item, record, text.encode('utf-8'), None
+        except Exception as e:
+            return item, None, None, e
+
+    results = []
+    with gzip.open(path, 'wb') as archive:
+        archive.write(json.dumps({'archive': _ARCHIVE_FORMAT,
+                                  'version': ARCHIVE_VERSION,
+                                  'format': WORKBOOK_FORMAT}).encode('utf-8')
+                      + b'\n')
+        for item, record, data, error in _bounded_map(fetch, workbook_items,
+                                                      max_workers):
+            if error is None:
+                # The props follow their record as a block of the given size,
+                # so they're stored verbatim rather than escaped
+                record['size'] = len(data)
+                archive.write(json.dumps(record).encode('utf-8') + b'\n')
+                archive.write(data + b'\n')
+            results.append(ExportResult(item, error))
+    return results
+
+
+def read_archive(path):
+    """
+    Yields the (record, props text) of each workbook in an archive written
+    by export_workbooks(), one at a time. record is a dict holding the item
+    properties under 'item' and the dataset lineage under 'lineage'.
+    """
+    with gzip.open(path, 'rb') as archive:
+        header = json.loads(archive.readline().decode('utf-8') or 'null')
+        if not isinstance(header, dict) or \
+                header.get('archive') != _ARCHIVE_FORMAT:
+            raise InsightsWorkbookError('Not a workbook archive: ' +
+                                        str(path))
+        if header.get('version', 0) > ARCHIVE_VERSION:
+            raise InsightsWorkbookError('Unsupported archive version: ' +
+                                        str(header.get('version')))
+        while True:
+            line = archive.readline()
+            if not line.strip():
+                return
+            record = json.loads(line.decode('utf-8'))
+            data = archive.read(record['size'] + 1)
+            if len(data) != record['size'] + 1:
+                raise InsightsWorkbookError('Truncated archive: ' + str(path))
+            yield record, data[:-1].decode('utf-8')
+
+
+def import_workbooks(gis, path, layer_map=None,
+                     max_workers=ARCHIVE_MAX_WORKERS,
+                     chunk_size=EXECUTE_CHUNK_SIZE, transport=None,
+                     session=None, progress=None):
+    """
+    Recreates the workbooks in an archive written by export_workbooks() in
+    a (possibly different) portal. Each workbook is created, has its feature
+    layers added again in batched execute calls, and is saved with the
+    archived props, with the layer URLs moved according to layer_map and
+    the old data IDs replaced by the new ones everywhere they're used,
+    including inside derived datasets. Workbooks are read from the archive
+    as workers become free, so only a few are held in memory at once. A
+    failure in one workbook doesn't stop the others.
+
+    ==================     =====================================================
+    **Argument**           **Description**
+    ------------------     -----------------------------------------------------
+    gis                    Required arcgis.gis.GIS to create the workbooks in.
+    ------------------     -----------------------------------------------------
+    path                   Required string. Path of the archive to read.
+    ------------------     -----------------------------------------------------
+    layer_map              Optional dict. Feature layer URL in the archived
+                           workbooks (service or sublayer URL) to the URL or
+                           arcgis.gis.Item of the layer to use instead. Layers
+                           not in it are added from their original URL.
+    ------------------     -----------------------------------------------------
+    max_workers            Optional int. Maximum number of workbooks imported
+                           at the same time.
+    ------------------     -----------------------------------------------------
+    chunk_size             Optional int. Maximum number of add-data tools sent
+                           in a single execute call.
+    ------------------     -----------------------------------------------------
+    transport              Optional Transport used for REST calls.
+    ------------------     -----------------------------------------------------
+    session                Optional WorkbookSession for the gis.
+    ------------------     -----------------------------------------------------
+    progress               Optional dict, updated in place with the state of
+                           each workbook by its archived item ID, the same way
+                           as by WorkbookTemplate.provision(). Passing the
+                           progress of an interrupted import skips the
+                           workbooks and steps that already succeeded.
+    ==================     =====================================================
+    :return:
+       List of ImportResult tuples, in archive order
+    """
+    layer_map = layer_map or {}
+    session = session or WorkbookSession.of(gis)
+    transport = transport or session.transport
+    if progress is None:
+        progress = {}
+    lock = threading.Lock()
+
+    def record(item_id, **state):
+        with lock:
+            progress.setdefault(item_id, {}).update(state)
+
+    def restore(entry):
+        archived, text = entry
+        meta = archived['item']
+        item_id, title = meta.get('id'), meta.get('title')
+        workbook = None
+        try:
+            with lock:
+                state = dict(progress.get(item_id, {}))
+            if state.get('saved'):
+                return ImportResult(title, item_id, state['workspace_id'],
+                                    None)
+            if 'workspace_id' in state:
+                workbook_id = state['workbook_id']
+                workbook = InsightsWorkbook(
+                    gis, title, workbook_id, state['workspace_id'],
+                    session.workspace_url(workbook_id), None, transport,
+                    session)
+            else:
+                workbook = InsightsWorkbook.new(gis, title, transport,
+                                                session)
+                record(item_id, workbook_id=workbook._workbookID,
+                       workspace_id=workbook._workspaceID)
+            replacements = {}
+            sources = []
+            for name, lineage in sorted(archived['lineage'].items()):
+                if lineage['url'] is None or lineage['data'] is None:
+                    continue
+                url, owner = _remap_layer(lineage['url'], layer_map)
+                replacements[lineage['url']] = url
+                if owner is not None and lineage['owner'] is not None:
+                    replacements[lineage['owner']] = owner
+                sources.append((url, name))
+            data = state.get('data')
+            if data is None:
+                data = workbook._execute_add_data(sources, chunk_size)
+                record(item_id, data=data)
+            for name, lineage in archived['lineage'].items():
+                if name in data:
+                    replacements[lineage['data']] = data[name]
+            workbook.props = LazyObject(_replace_strings(text, replacements))
+            workbook.reindex()
+            workbook.save(force=True)
+            # save() only sets the title, so restore the rest of the item's
+            # description separately
+            item_props = _restored_item_props(meta)
+            if item_props:
+                url = session.item_update_url(workbook._workspaceID)
+                transport.call('updateItem', url, item_props,
+                               lambda: gis._portal.con.post(url, item_props),
+                               workbook._workspaceID)
+            record(item_id, saved=True)
+            return ImportResult(title, item_id, workbook._workspaceID, None)
+        except Exception as e:
+            return ImportResult(title, item_id,
+                                workbook and workbook._workspaceID, e)
+
+    return list(_bounded_map(restore, read_archive(path), max_workers))
+
+
+class LocalAggregator(object):
+    """
+    Runs the same aggregations as InsightsWorkbook.aggregate() against a
+    local CSV table (e.g. "Air Quality Monitors.csv") with NumPy, so results,
+    output types and group cardinality can be checked before a chart ever
+    reaches the portal. Files are read in chunks, and the grouping of a file
+    by a field is cached and reused by later aggregations until the file
+    changes. Requires NumPy.
+
+    ================    ========================================================
+    **Argument**        **Description**
+    ----------------    --------------------------------------------------------
+    chunk_size          Optional int. Number of CSV rows read at a time.
+    ----------------    --------------------------------------------------------
+    max_groups          Optional int. If set, aggregations that produce more
+                        groups than this raise a ValueError.
+    ----------------    --------------------------------------------------------
+    encoding            Optional string. Text encoding of the CSV files.
+    ================    ========================================================
+    """
+
+    def __init__(self, chunk_size=LOCAL_CHUNK_SIZE, max_groups=None,
+                 encoding='utf-8-sig'):
+        if np is None:
+            raise ImportError('LocalAggregator requires numpy')
+        self.chunk_size = chunk_size
+        self.max_groups = max_groups
+        self.encoding = encoding
+        # (path, mtime, size, field) -> (group keys, group code per row)
+        self._groups = {}
+        # (path, mtime, size, field) -> (float values per row, NaN if empty
+        # or not numeric, and whether each row has a value)
+        self._values = {}
+
+    def aggregate(self, path, groupby_field, groupby_field_type, stat_type,
+                  stat_field, stat_field_type):
+        """
+        Aggregates a local CSV table based on the group-by field using the
+        specified statistic over the specified field. Arguments match
+        InsightsWorkbook.aggregate().
+
+        ==================     =================================================
+        **Argument**           **Description**
+        ------------------     -------------------------------------------------
+        path                   Required str. Path to the CSV file.
         ------------------     -------------------------------------------------
         groupby_field          Required str. Name of the field to group by.
         ------------------     -------------------------------------------------
-        groupby_field_type     Required str. Type of field. Acceptable values
-                               include esriFieldTypeString, esriFieldTypeDouble,
-                               esriFieldTypeInteger, etc.
+        groupby_field_type     Required str. Type of field, e.g.
+                               esriFieldTypeString or esriFieldTypeInteger.
         ------------------     -------------------------------------------------
-        stat_type              Required str. Type of aggregation statistic.
-                               Acceptable values include avg, sum, count, min
-                               and max.
+        stat_type              Required str. One of avg, sum, count, min and
+                               max.
         ------------------     -------------------------------------------------
         stat_field             Required str. Name of the field to use in
-                               calculation.
+                               calculation. For count, a field that isn't in
+                               the file (e.g. ObjectId) counts rows.
         ------------------     -------------------------------------------------
         stat_field_type        Required str. Type of field for output.
-                               Acceptable values include esriFieldTypeString,
-                               esriFieldTypeDouble, esriFieldTypeInteger, etc.
         ==================     =================================================
+        :return:
+           LocalAggregateResult with the aggregated columns and the
+           metadata.fields schema the Workbook would record
         """
-        # Get count of cards
-        card_ct = len(self.props['pages'][0]['cards'])
-        # Set chart title
-        chart_title = chart_type.title() + " Chart " + str(card_ct+1)
-        # Create aggregation dataset for this chart
-        out_dataset = self.aggregate(in_dataset, groupby_field,
-                                     groupby_field_type, stat_type, stat_field,
-                                     stat_field_type, chart_title)
-        # Create the chart card
-        self.props['pages'][0]['cards'].append({
-            'title': 'Card ' + str(card_ct+1),
-            'type': 'chart',
-            'content': {
-                'layers': [{
-                    'datasetId': out_dataset,
-                    'chartLines': {
-                        'mean': True
-                    },
-                    'colors': {}
-                }],
-                'type': chart_type
-            }
-        })
-        # Place it to the right of any existing cards
-        layout_x = card_ct * 20 + card_ct
-        self.props['pages'][0]['layout'].append({
-            "x": layout_x,
-            "y": 0,
-            "w": 20,
-            "h": 20
-        })
+        if stat_type not in STAT_TYPES:
+            raise ValueError('Unknown stat_type: ' + str(stat_type))
+        key = self._file_key(path)
+        header = self._header(path)
+        if groupby_field not in header:
+            raise ValueError('Field not found: ' + groupby_field)
+        if stat_field not in header and stat_type != 'count':
+            raise ValueError('Field not found: ' + stat_field)
+        group_field = groupby_field \
+            if (key + (groupby_field,)) not in self._groups else None
+        value_fields = [stat_field] if stat_field in header and \
+            (key + (stat_field,)) not in self._values else []
+        if group_field or value_fields:
+            self._read(path, key, header, group_field, value_fields)
+        keys, codes = self._groups[key + (groupby_field,)]
+        if self.max_groups is not None and len(keys) > self.max_groups:
+            raise ValueError('Group-by on ' + groupby_field + ' produces ' +
+                             str(len(keys)) + ' groups, more than the ' +
+                             'maximum of ' + str(self.max_groups))
+
+        out_field, out_type = _aggregate_out_field(stat_type, stat_field,
+                                                   stat_field_type)
+        if stat_field in header:
+            values, present = self._values[key + (stat_field,)]
+            valid = ~np.isnan(values)
+            counts = np.bincount(codes[present if stat_type == 'count'
+                                       else valid], minlength=len(keys))
+        else:
+            counts = np.bincount(codes, minlength=len(keys))
+        if stat_type == 'count':
+            result = counts
+        elif stat_type in ('sum', 'avg'):
+            result = np.bincount(codes[valid], weights=values[valid],
+                                 minlength=len(keys))
+            if stat_type == 'avg':
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    result = result / counts
+            else:
+                # Like the server, groups with no values have no sum
+                result[counts == 0] = np.nan
+        else:
+            # Sort the valid values by group, then reduce each group's run
+            order = np.argsort(codes[valid], kind='stable')
+            sorted_codes = codes[valid][order]
+            sorted_values = values[valid][order]
+            result = np.full(len(keys), np.nan)
+            if len(sorted_codes):
+                starts = np.flatnonzero(np.r_[True, np.diff(sorted_codes) != 0])
+                reduce = np.minimum if stat_type == 'min' else np.maximum
+                result[sorted_codes[starts]] = reduce.reduceat(sorted_values,
+                                                               starts)
+        if out_type in ('esriFieldTypeInteger', 'esriFieldTypeSmallInteger') \
+                and not np.isnan(result).any():
+            result = result.astype(np.int64)
+
+        fields = _aggregate_metadata_fields(groupby_field, groupby_field_type,
+                                            out_field, out_type)
+        return LocalAggregateResult({groupby_field: keys, out_field: result},
+                                    fields)
 
-    def save(self):
+    def clear(self):
+        """ Drops all cached groupings and field values """
+        self._groups.clear()
+        self._values.clear()
+
+    @staticmethod
+    def _file_key(path):
+        """ Cache key for a file that changes whenever the file does """
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_mtime, stat.st_size)
+
+    def _header(self, path):
+        """ Returns the list of field names in a CSV file """
+        with open(path, newline='', encoding=self.encoding) as f:
+            return next(csv.reader(f), [])
+
+    def _read(self, path, key, header, group_field, value_fields):
         """
-        Saves the Insights Workbook to ArcGIS with all the current properties.
+        Reads fields from a CSV file in chunks, caching the grouping of the
+        group-by field (if given) and the float values of the value fields.
         """
-        # A few properties have to be manually set at save (doesn't work to
-        # just set them on initial Workbook creation).
-        self.props["id"] = self._workspaceID
-        self.props["owner"] = self._gis.users.me.username
-        self.props["name"] = self._workbookID
-        self.props["url"] = self._workspaceURL
-        post_data = {
-            'f': 'json',
-            'title': self._title,
-            'text': json.dumps(self.props)}
-        # Basically just a standard ArcGIS item update with the updated JSON
-        # properties
-        update_url = self._gis._url.lower() + '/sharing/rest/content/users/' + \
-            self._gis.users.me.username + '/items/' + \
-            self._workspaceID + '/update'
+        group_column = header.index(group_field) if group_field else None
+        value_columns = [header.index(x) for x in value_fields]
+        group_codes = {}
+        code_chunks = []
+        value_chunks = [[] for _ in value_fields]
+        with open(path, newline='', encoding=self.encoding) as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            while True:
+                rows = [row for _, row in zip(range(self.chunk_size), reader)]
+                if not rows:
+                    break
+                if group_field:
+                    raw = _csv_column(rows, group_column)
+                    # Map this chunk's distinct keys onto codes shared by all
+                    # chunks, then translate the whole chunk at once
+                    uniq, inverse = np.unique(raw, return_inverse=True)
+                    uniq_codes = np.array(
+                        [group_codes.setdefault(x, len(group_codes))
+                         for x in uniq], dtype=np.int64)
+                    code_chunks.append(uniq_codes[inverse])
+                for chunks, column in zip(value_chunks, value_columns):
+                    raw = _csv_column(rows, column)
+                    chunks.append((_to_float(raw), raw != ''))
+        if group_field:
+            keys = np.array(list(group_codes), dtype=object)
+            codes = np.concatenate(code_chunks) if code_chunks \
+                else np.zeros(0, np.int64)
+            self._groups[key + (group_field,)] = (keys, codes)
+        for field, chunks in zip(value_fields, value_chunks):
+            if chunks:
+                self._values[key + (field,)] = (
+                    np.concatenate([x[0] for x in chunks]),
+                    np.concatenate([x[1] for x in chunks]))
+            else:
+                self._values[key + (field,)] = (np.zeros(0),
+                                                np.zeros(0, dtype=bool))
+
+
+def _csv_column(rows, column):
+    """ Returns one column of a chunk of CSV rows as an object array """
+    return np.array([row[column] if column < len(row) else ''
+                     for row in rows], dtype=object)
+
+
+def _to_float(raw):
+    """
+    Converts an object array of CSV strings to floats, with NaN for empty or
+    non-numeric values.
+    """
+    values = np.full(len(raw), np.nan)
+    present = raw != ''
+    try:
+        values[present] = raw[present].astype(float)
+    except ValueError:
+        for i in np.flatnonzero(present):
+            try:
+                values[i] = float(raw[i])
+            except ValueError:
+                pass
+    return values
+
+
+def ingest_csv_delta(layer, csv_path, previous_csv_path, key_field='AQSID',
+                     batch_size=EDIT_BATCH_SIZE, x_field='Longitude',
+                     y_field='Latitude', encoding='utf-8-sig'):
+    """
+    Applies only the differences between a new CSV and the previous snapshot
+    of it to a hosted feature layer, as batched feature edits, instead of
+    overwriting and republishing the whole layer. Because the layer isn't
+    republished, workbooks that use it keep their dataset references and
+    don't need update_dataset(). Once this succeeds, the new CSV should be
+    kept as the previous snapshot for the next run.
+
+    ==================     =====================================================
+    **Argument**           **Description**
+    ------------------     -----------------------------------------------------
+    layer                  Required arcgis.features.FeatureLayer. The layer
+                           that was published from the previous CSV.
+    ------------------     -----------------------------------------------------
+    csv_path               Required string. Path to the new CSV file.
+    ------------------     -----------------------------------------------------
+    previous_csv_path      Required string. Path to the CSV file the layer
+                           currently reflects.
+    ------------------     -----------------------------------------------------
+    key_field              Optional string. Field that uniquely identifies a
+                           row in both files and the layer.
+    ------------------     -----------------------------------------------------
+    batch_size             Optional int. Maximum number of features sent in a
+                           single edit_features call.
+    ------------------     -----------------------------------------------------
+    x_field                Optional string. Field holding the longitude of
+                           point features. Set to None for tables.
+    ------------------     -----------------------------------------------------
+    y_field                Optional string. Field holding the latitude of
+                           point features. Set to None for tables.
+    ------------------     -----------------------------------------------------
+    encoding               Optional string. Text encoding of the CSV files.
+    ==================     =====================================================
+    :return:
+       DeltaResult with the number of features added, updated and deleted
+    """
+    # Snapshot of the previous file as a digest of each row, by key
+    previous = {}
+    with open(previous_csv_path, newline='', encoding=encoding) as f:
+        for row in csv.DictReader(f):
+            previous[row[key_field]] = _row_digest(row)
+
+    # Field types of the layer, so CSV strings can be converted to match
+    oid_field = layer.properties.objectIdField
+    field_types = {x['name'].lower(): (x['name'], x['type'])
+                   for x in _plain(layer.properties.fields)}
+    key_name, key_type = field_types[key_field.lower()]
+    # Object IDs of the existing features, by key
+    existing = layer.query(where='1=1', out_fields=key_name + ',' + oid_field,
+                           return_geometry=False)
+    oids = {_key_string(x.attributes[key_name]): x.attributes[oid_field]
+            for x in existing.features}
+
+    result = {'adds': 0, 'updates': 0, 'deletes': 0, 'failures': []}
+    adds = []
+    updates = []
+
+    def flush(adds, updates, deletes):
+        # Push one batch of edits and tally the results
+        if not (adds or updates or deletes):
+            return
+        resp = layer.edit_features(adds=adds or None, updates=updates or None,
+                                   deletes=deletes or None)
+        for kind, results in (('adds', resp.get('addResults', [])),
+                              ('updates', resp.get('updateResults', [])),
+                              ('deletes', resp.get('deleteResults', []))):
+            for x in results:
+                if x.get('success'):
+                    result[kind] += 1
+                else:
+                    result['failures'].append(x)
+
+    with open(csv_path, newline='', encoding=encoding) as f:
+        for row in csv.DictReader(f):
+            key = row[key_field]
+            digest = previous.pop(key, None)
+            if digest == _row_digest(row):
+                continue
+            feature = _csv_feature(row, field_types, x_field, y_field)
+            oid = oids.get(_key_string(_csv_value(key, key_type)))
+            if digest is None or oid is None:
+                adds.append(feature)
+            else:
+                feature['attributes'][oid_field] = oid
+                updates.append(feature)
+            if len(adds) + len(updates) >= batch_size:
+                flush(adds, updates, [])
+                adds, updates = [], []
+    flush(adds, updates, [])
+
+    # Anything left in the previous snapshot is gone from the new file
+    deletes = [oids[x] for x in
+               (_key_string(_csv_value(k, key_type)) for k in previous)
+               if x in oids]
+    for i in range(0, len(deletes), batch_size):
+        flush([], [], ','.join(str(x) for x in deletes[i:i + batch_size]))
+    return DeltaResult(result['adds'], result['updates'], result['deletes'],
+                       result['failures'])
+
+
+def _row_digest(row):
+    """ Digest of a CSV row's values, for detecting changed rows """
+    return hashlib.sha1('\x1f'.join(
+        '%s=%s' % (k, row[k]) for k in sorted(row, key=str)).encode(
+            'utf-8')).digest()
+
+
+def _key_string(value):
+    """ Normalizes a key value from either a CSV file or a layer """
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def _csv_value(value, field_type):
+    """ Converts a CSV string to the type of the layer field it goes in """
+    if value is None or value == '':
+        return None
+    try:
+        if field_type in ('esriFieldTypeInteger', 'esriFieldTypeSmallInteger',
+                          'esriFieldTypeOID'):
+            return int(float(value))
+        if field_type in ('esriFieldTypeDouble', 'esriFieldTypeSingle'):
+            return float(value)
+    except ValueError:
+        return None
+    return value
+
+
+def _csv_feature(row, field_types, x_field, y_field):
+    """
+    Builds a feature for edit_features from a CSV row, keeping only the
+    fields that exist in the layer.
+    """
+    attributes = {}
+    for name, value in row.items():
+        if name is None or name.lower() not in field_types:
+            continue
+        field_name, field_type = field_types[name.lower()]
+        if field_type in ('esriFieldTypeOID', 'esriFieldTypeGeometry'):
+            continue
+        attributes[field_name] = _csv_value(value, field_type)
+    feature = {'attributes': attributes}
+    if x_field and y_field:
+        x = _csv_value(row.get(x_field), 'esriFieldTypeDouble')
+        y = _csv_value(row.get(y_field), 'esriFieldTypeDouble')
+        if x is not None and y is not None:
+            feature['geometry'] = {'x': x, 'y': y,
+                                   'spatialReference': {'wkid': 4326}}
+    return feature
+
+
+class AsyncTransport(abc.ABC):
+    """
+    Base class for the transports AsyncInsightsWorkbook sends its REST calls
+    through. Limits the number of requests in flight to each host; subclasses
+    implement _request() to actually send them, e.g. with an asyncio HTTP
+    client. The limits are kept per event loop, so a transport can be used
+    from any number of event loops, one after another (e.g. successive
+    asyncio.run() calls) or at once in different threads.
+
+    Requests are paced by a RateLimiter and retried according to a
+    RetryPolicy, the same way as Transport.
+
+    ================    ========================================================
+    **Argument**        **Description**
+    ----------------    --------------------------------------------------------
+    max_per_host        Optional int. Maximum number of concurrent requests to
+                        a single host.
+    ----------------    --------------------------------------------------------
+    limiter             Optional RateLimiter. Defaults to default_limiter,
+                        which is shared by the whole process.
+    ----------------    --------------------------------------------------------
+    retry               Optional RetryPolicy.
+    ================    ========================================================
+    """
+
+    def __init__(self, max_per_host=ASYNC_MAX_PER_HOST, limiter=None,
+                 retry=None):
+        self.max_per_host = max_per_host
+        self.limiter = limiter or default_limiter
+        self.retry = retry or RetryPolicy()
+        self._lock = threading.Lock()
+        # Event loop to a dict of host to the semaphore limiting requests to
+        # it, since a semaphore can only be used from a single loop
+        self._limits = weakref.WeakKeyDictionary()
+
+    async def post(self, url, data, operation=None, workbook=None,
+                   idempotent=True, gis=None):
+        """
+        POSTs form data to a URL and returns the decoded JSON response. The
+        operation name and workbook item ID are reported to request hooks,
+        and gis is the arcgis.gis.GIS the request is made for.
+        """
+        return await self._send('POST', url, data, operation, workbook,
+                                idempotent, gis)
+
+    async def get(self, url, params, operation=None, workbook=None,
+                  gis=None):
+        """ GETs a URL with query parameters and returns the decoded JSON """
+        return await self._send('GET', url, params, operation, workbook, True,
+                                gis)
+
+    async def _send(self, method, url, data, operation, workbook, idempotent,
+                    gis):
+        """ Paces, sends and retries a request """
+        attempt = 0
+        while True:
+            wait = self.limiter.reserve(url)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                async with self._limit(url):
+                    resp = await self._traced(method, url, data, operation,
+                                              workbook, gis)
+            except Exception as e:
+                retry_after = _retry_after(e)
+                if _error_status(e) in _THROTTLE_STATUSES:
+                    self.limiter.throttled(retry_after, url)
+                if not self.retry.should_retry(e, attempt, idempotent):
+                    raise
+                await asyncio.sleep(self.retry.delay(attempt, retry_after))
+                attempt += 1
+                continue
+            self.limiter.succeeded(url)
+            return resp
+
+    async def _traced(self, method, url, data, operation, workbook, gis):
+        """ Sends a request, reporting it to the request hooks if any """
+        if not _request_hooks:
+            return await self._request(method, url, data, gis)
+        start = time.perf_counter()
+        payload = data if method == 'POST' else None
+        try:
+            resp = await self._request(method, url, data, gis)
+        except Exception as e:
+            _emit_span(operation, url, payload, None, start, workbook, e)
+            raise
+        _emit_span(operation, url, payload, resp, start, workbook)
+        return resp
+
+    @abc.abstractmethod
+    async def _request(self, method, url, data, gis):
+        """
+        Sends a single GET or POST request made for gis (which may be None)
+        and returns the decoded JSON response
+        """
+
+    def _limit(self, url):
+        """
+        Semaphore limiting the concurrent requests to a URL's host from the
+        running event loop
+        """
+        host = urlsplit(url).netloc.lower()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            limits = self._limits.get(loop)
+            if limits is None:
+                limits = self._limits[loop] = {}
+            if host not in limits:
+                limits[host] = asyncio.Semaphore(self.max_per_host)
+            return limits[host]
+
+
+class GISAsyncTransport(AsyncTransport):
+    """
+    AsyncTransport that sends requests through the connection of an
+    arcgis.gis.GIS, running the blocking calls on a thread pool so they don't
+    block the event loop. The module-level default_async_transport is one
+    without a gis of its own, shared by every AsyncInsightsWorkbook that
+    isn't given a transport.
+
+    ================    ========================================================
+    **Argument**        **Description**
+    ----------------    --------------------------------------------------------
+    gis                 Optional arcgis.gis.GIS. Connection should be set up
+                        before working with this class. Defaults to the GIS
+                        of the workbook making each request.
+    ----------------    --------------------------------------------------------
+    max_per_host        Optional int. Maximum number of concurrent requests to
+                        a single host.
+    ----------------    --------------------------------------------------------
+    executor            Optional concurrent.futures.Executor to run the
+                        blocking calls on. Defaults to the event loop's.
+    ----------------    --------------------------------------------------------
+    limiter             Optional RateLimiter.
+    ----------------    --------------------------------------------------------
+    retry               Optional RetryPolicy.
+    ================    ========================================================
+    """
+
+    def __init__(self, gis=None, max_per_host=ASYNC_MAX_PER_HOST,
+                 executor=None, limiter=None, retry=None):
+        super().__init__(max_per_host, limiter, retry)
+        self._gis = gis
+        self._executor = executor
+
+    async def _request(self, method, url, data, gis):
+        gis = self._gis or gis
+        if gis is None:
+            raise InsightsWorkbookError('No GIS to send the request through')
+        if method == 'POST':
+            call = functools.partial(gis._portal.con.post, url, data)
+        else:
+            call = functools.partial(gis._portal.con.get, url, data)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, call)
+
+
+# Async transport shared by every AsyncInsightsWorkbook that isn't given its
+# own, so they share its per-host limits
+default_async_transport = GISAsyncTransport()
+
+
+class AsyncInsightsWorkbook(InsightsWorkbook):
+    """
+    asyncio version of InsightsWorkbook. Methods that talk to ArcGIS (new,
+    open, add_feature_layer(s), update_dataset(s) and save) are coroutines
+    and send their requests through a pluggable AsyncTransport, so a single
+    process can work on many workbooks concurrently. The remaining methods
+    (add_map, aggregate, add_chart, compact) only change props and work the
+    same as in InsightsWorkbook.
+
+    Takes the same arguments as InsightsWorkbook, plus:
+
+    ================    ========================================================
+    **Argument**        **Description**
+    ----------------    --------------------------------------------------------
+    transport           Optional AsyncTransport. Defaults to
+                        default_async_transport, so workbooks share its
+                        per-host limits.
+    ================    ========================================================
+    """
+
+    def __init__(self, gis, title=None, workbook_id=None, workspace_id=None,
+                 workspace_url=None, props=None, transport=None,
+                 session=None):
+        super().__init__(gis, title, workbook_id, workspace_id,
+                         workspace_url, props, session=session)
+        self._transport = transport or default_async_transport
+
+    @classmethod
+    async def new(cls, gis, title, transport=None, session=None):
+        """
+        Creates a new Insights Workbook in ArcGIS using the provided title.
+        See InsightsWorkbook.new().
+        """
+        session = session or WorkbookSession.of(gis)
+        transport = transport or default_async_transport
+        # Random 8-digit hex number for ID
+        workbook_id = '%08x' % random.randrange(16**8)
+        workspace_url = session.workspace_url(workbook_id)
+        path, post_data = session.create_service_request(workbook_id)
+        try:
+            resp = await transport.post(path, post_data, 'createService',
+                                        idempotent=False, gis=gis)
+            workspace_id = session.created_item_id(resp)
+            props = _default_props(title)
+            # Same item update that GIS._portal.update_item() sends
+            item_props = session.new_item_props(workspace_id, title,
+                                                workspace_url)
+            item_props['text'] = _dumps_props(props)
+            await transport.post(session.item_update_url(workspace_id),
+                                 item_props, 'updateItem', workspace_id,
+                                 gis=gis)
+            return cls(gis, title, workbook_id, workspace_id, workspace_url,
+                       props, transport, session)
+        except Exception as e:
+            raise InsightsWorkbookError('Error creating workbook: ' +
+                                        str(e)) from e
+
+    @classmethod
+    async def open(cls, existing_workbook, cache=None, transport=None,
+                   session=None):
+        """
+        Opens an existing Insights Workbook item. See InsightsWorkbook.open().
+        """
+        gis = existing_workbook._gis
+        session = session or WorkbookSession.of(gis)
+        transport = transport or default_async_transport
+        workspace_id = existing_workbook.id
+        modified = getattr(existing_workbook, 'modified', None)
+        try:
+            props = None
+            if cache is not None:
+                props = cache.get(workspace_id, modified)
+            if props is None:
+                props = await transport.get(
+                    session.item_data_url(workspace_id), {'f': 'json'},
+                    'getData', workspace_id, gis)
+                if cache is not None:
+                    cache.put(workspace_id, modified, props)
+            workbook = cls(gis, existing_workbook.title,
+                           existing_workbook.name, workspace_id,
+                           session.workspace_url(existing_workbook.name),
+                           props, transport, session)
+            _check_structure(props)
+            workbook._opened(modified)
+            return workbook
+        except Exception as e:
+            raise InsightsWorkbookError('Error retrieving workbook data: ' +
+                                        str(e)) from e
+
+    async def add_feature_layer(self, lyr, sublayer=0, page=None):
+        """ See InsightsWorkbook.add_feature_layer() """
+        return (await self.add_feature_layers([(lyr, sublayer)],
+                                              page=page))[0]
+
+    async def add_feature_layers(self, layers, sublayer=0,
+                                 chunk_size=EXECUTE_CHUNK_SIZE, page=None):
+        """
+        See InsightsWorkbook.add_feature_layers(). The execute calls for each
+        chunk are sent concurrently.
+        """
+        self._check_page(page)
+        entries = self._new_layer_entries(layers, sublayer)
         try:
-            self._gis._portal.con.post(update_url, post_data)
-        except:
-            print("Error saving workspace: " + sys.exc_info()[0])
-            raise Exception()
+            resp = await self._execute_add_data(
+                [(lyr.url + '/' + str(lyr_sublayer), dataset_name)
+                 for lyr, lyr_sublayer, dataset_name in entries],
+                chunk_size)
+            return self._add_layer_entries(entries, resp, page)
+        except InsightsWorkbookValidationError:
+            raise
+        except Exception as e:
+            raise InsightsWorkbookError('Error adding feature layers: ' +
+                                        str(e)) from e
+
+    async def update_dataset(self, lyr, sublayer=0):
+        """ See InsightsWorkbook.update_dataset() """
+        dataset_name = (await self.update_datasets([(lyr, sublayer)]))[0]
+        if dataset_name is None:
+            raise InsightsWorkbookError(
+                'Layer does not exist within this Workbook')
+        return dataset_name
+
+    async def update_datasets(self, layers, sublayer=0,
+                              chunk_size=EXECUTE_CHUNK_SIZE):
+        """
+        See InsightsWorkbook.update_datasets(). The execute calls for each
+        chunk are sent concurrently.
+        """
+        entries = self._existing_layer_entries(layers, sublayer)
+        found = [x for x in entries if x[2] is not None]
+        if found:
+            try:
+                resp = await self._execute_add_data(
+                    [(self._index.sources[dataset_name], dataset_name)
+                     for _, _, dataset_name in found],
+                    chunk_size)
+            except InsightsWorkbookValidationError:
+                raise
+            except Exception as e:
+                raise InsightsWorkbookError('Error updating feature layers: ' +
+                                            str(e)) from e
+            self._refresh_layer_entries(found, resp)
+        return [dataset_name for _, _, dataset_name in entries]
+
+    async def save(self, force=False, merge=True):
+        """ See InsightsWorkbook.save() """
+        request = self._save_request(force)
+        if request is None:
+            return False
+        info_url = self._session.item_info_url(self._workspaceID)
+        try:
+            if merge and self._modified is not None:
+                info = await self._transport.get(
+                    info_url, {'f': 'json'}, 'getItem', self._workspaceID,
+                    self._gis)
+                if info.get('modified') != self._modified:
+                    remote = await self._transport.get(
+                        self._session.item_data_url(self._workspaceID),
+                        {'f': 'json'}, 'getData', self._workspaceID,
+                        self._gis)
+                    self._merge(remote, info.get('modified'))
+                    request = self._save_request(True)
+            update_url, post_data, content_hash = request
+            # The transport sends plain forms
+            form = dict(post_data, text=''.join(post_data['text']))
+            await self._transport.post(update_url, form, 'updateItem',
+                                       self._workspaceID, gis=self._gis)
+        except InsightsWorkbookConflict:
+            raise
+        except Exception as e:
+            raise InsightsWorkbookError('Error saving workspace: ' +
+                                        str(e)) from e
+        self._saved(content_hash, post_data['text'])
+        return True
+
+    async def _execute_add_data(self, sources, chunk_size=EXECUTE_CHUNK_SIZE):
+        """ See InsightsWorkbook._execute_add_data() """
+        results = {}
+        responses = await asyncio.gather(*[
+            self._transport.post(self._workspaceURL + '/execute', post_data,
+                                 'execute', self._workspaceID, gis=self._gis)
+            for post_data in _execute_requests(sources, chunk_size)])
+        for resp in responses:
+            results.update(resp)
+        return results
@@ -0,0 +1,1647 @@
+""" Tests for InsightsWorkbook against a local fake portal
+
+Usage:
+
+    python -m unittest discover tests
+
+The fake portal from benchmarks/fake_portal.py runs in the same process, so
+the tests need nothing but the arcgis package that insightsworkbook imports.
+"""
+
+import asyncio
+import csv
+import gc
+import gzip
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+import unittest
+import unittest.mock
+import urllib.parse
+import weakref
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import insightsworkbook  # noqa: E402
+from fake_portal import (  # noqa: E402
+    FakeGIS, FakeItem, FakeLayer, FakePortal)
+from insightsworkbook import (  # noqa: E402
+    AsyncInsightsWorkbook, ExtentIndex, GISAsyncTransport, InsightsWorkbook,
+    InsightsWorkbookError, LayerMetadataCache, RateLimiter, RequestStats,
+    RetryPolicy, Span, Transport, WorkbookCache, WorkbookSession,
+    WorkbookTemplate, add_request_hook, extent_union, refresh_workbooks,
+    remove_request_hook)
+
+
+class PortalTestCase(unittest.TestCase):
+    """ Runs a FakePortal for the tests of a class """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.portal = FakePortal().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.portal.stop()
+
+    def setUp(self):
+        self.gis = FakeGIS(self.portal)
+        self.layers = [FakeLayer(self.portal, i) for i in range(4)]
+
+
+class WorkbookTemplateTest(PortalTestCase):
+
+    def test_sharded_sources(self):
+        # A map on a second page copies the add-data item of its layer
+        workbook = InsightsWorkbook.new(self.gis, 'Template')
+        workbook.page_card_limit = 1
+        name, other = workbook.add_feature_layers(self.layers[:2])
+        workbook.add_map(name)
+        workbook.add_map(name)
+        self.assertEqual(len(workbook.props['pages']), 2)
+        template = WorkbookTemplate(workbook)
+        self.assertEqual([x for x, _ in template.sources], [name, other])
+        props = json.loads(template.render(
+            'Copy', [(self.layers[2], 0), (self.layers[3], 0)],
+            {name: 'data-a', other: 'data-b'}))
+        self.assertEqual(props['workspace']['datasets'][name]['data'],
+                         'data-a')
+        urls = [item['params']['data']['url']
+                for page in props['pages']
+                for item in page['model']['items']
+                if item.get('outDataset') == name]
+        self.assertEqual(urls, [self.layers[2].url + '/0'] * 2)
+
+    def test_renamed_dataset(self):
+        workbook = InsightsWorkbook.new(self.gis, 'Template')
+        name = workbook.add_feature_layer(self.layers[0])
+        dataset = workbook.props['workspace']['datasets'][name]
+        dataset['name'] = 'Air Monitors'
+        dataset['fields']['PM25'] = {'alias': 'PM 2.5'}
+        template = WorkbookTemplate(workbook)
+        props = json.loads(template.render(
+            'Copy', [(self.layers[1], 0)], {name: 'data-a'}))
+        dataset = props['workspace']['datasets'][name]
+        self.assertEqual(dataset['name'], 'Air Monitors')
+        self.assertEqual(dataset['fields']['PM25'], {'alias': 'PM 2.5'})
+        self.assertEqual(dataset['data'], 'data-a')
+        self.assertEqual(dataset['owner'], self.layers[1].id)
+        self.assertEqual(dataset['extent'],
+                         self.layers[1].layers[0].properties.extent)
+
+    def test_map_extents_follow_the_copy(self):
+        workbook = InsightsWorkbook.new(self.gis, 'Template')
+        names = workbook.add_feature_layers(self.layers[:2])
+        workbook.add_map(names)
+        workbook.add_map(region=(-125.0, 25.0, -119.5, 30.5))
+        workbook.add_map(names[1])
+        template = WorkbookTemplate(workbook)
+        copy = self.layers[2:]
+        props = json.loads(template.render(
+            'Copy', [(x, 0) for x in copy],
+            {name: 'data-%d' % i for i, name in enumerate(names)}))
+        extents = [x.layers[0].properties.extent for x in copy]
+        self.assertEqual([x['content']['extent']
+                          for x in props['pages'][0]['cards']],
+                         [extent_union(extents)] * 2 + [extents[1]])
+
+
+class MergeTest(PortalTestCase):
+
+    def open_twice(self, aggregate=False):
+        workbook = InsightsWorkbook.new(self.gis, 'Merge')
+        self.names = workbook.add_feature_layers(self.layers[:2])
+        if aggregate:
+            self.derived = self.aggregate(workbook)
+        workbook.save()
+        item = FakeItem(self.gis, workbook)
+        return InsightsWorkbook.open(item), InsightsWorkbook.open(item)
+
+    def stored(self, workbook):
+        return json.loads(FakeItem(self.gis, workbook).get_data(False))
+
+    def aggregate(self, workbook):
+        return workbook.aggregate(self.names[0], 'NAME', 'esriFieldTypeString',
+                                  'count', 'NAME', 'esriFieldTypeString')
+
+    def assertRefreshed(self, workbook, data, derived):
+        datasets = self.stored(workbook)['workspace']['datasets']
+        self.assertEqual(datasets[self.names[0]]['data'], data)
+        tool = datasets[derived]['data']['tools'][0]
+        self.assertEqual(tool['params']['dataset'], data)
+
+    def test_cards_added_on_both_sides_dont_overlap(self):
+        mine, theirs = self.open_twice()
+        theirs.add_map(self.names[0])
+        theirs.save()
+        mine.add_chart('bar', self.names[1], 'NAME', 'esriFieldTypeString',
+                       'count', 'NAME', 'esriFieldTypeString')
+        mine.save()
+        page = self.stored(mine)['pages'][0]
+        self.assertEqual(len(page['cards']), 2)
+        (a, b) = page['layout']
+        self.assertTrue(a['x'] + a['w'] <= b['x'] or
+                        b['x'] + b['w'] <= a['x'] or
+                        a['y'] + a['h'] <= b['y'] or
+                        b['y'] + b['h'] <= a['y'])
+
+    def test_save_right_after_another_save_is_merged(self):
+        mine, theirs = self.open_twice()
+        theirs.add_map(self.names[1])
+        pending = [theirs]
+
+        def hook(span):
+            # Someone else saves just after this workbook's upload
+            if span.operation == 'updateItem' and pending:
+                pending.pop().save()
+
+        mine.add_map(self.names[0])
+        add_request_hook(hook)
+        try:
+            mine.save()
+        finally:
+            remove_request_hook(hook)
+        mine.add_page('Second')
+        mine.save()
+        stored = self.stored(mine)
+        self.assertEqual([x['title'] for x in stored['pages']],
+                         ['Page 1', 'Second'])
+        self.assertEqual(len(stored['pages'][0]['cards']), 2)
+
+    def test_refresh_reaches_datasets_derived_by_others(self):
+        mine, theirs = self.open_twice()
+        derived = self.aggregate(theirs)
+        theirs.save()
+        mine.update_dataset(self.layers[0])
+        mine.save()
+        data = mine.props['workspace']['datasets'][self.names[0]]['data']
+        self.assertRefreshed(mine, data, derived)
+
+    def test_concurrent_refreshes_keep_the_newer(self):
+        for mine_first in (True, False):
+            with self.subTest(mine_first=mine_first):
+                mine, theirs = self.open_twice(aggregate=True)
+                first, second = (mine, theirs) if mine_first \
+                    else (theirs, mine)
+                first.update_dataset(self.layers[0])
+                if not mine_first:
+                    theirs.save()
+                # Modified times are in ms
+                time.sleep(0.02)
+                second.update_dataset(self.layers[0])
+                if mine_first:
+                    theirs.save()
+                mine.save()
+                data = second.props['workspace']['datasets'][
+                    self.names[0]]['data']
+                self.assertRefreshed(mine, data, self.derived)
+
+
+class ShardingTest(PortalTestCase):
+
+    def test_cards_sharded_across_pages(self):
+        workbook = InsightsWorkbook.new(self.gis, 'Sharding')
+        workbook.page_card_limit = 2
+        names = workbook.add_feature_layers(self.layers)
+        for name in names:
+            workbook.add_map(name)
+        workbook.add_chart('bar', names[0], 'NAME', 'esriFieldTypeString',
+                           'count', 'NAME', 'esriFieldTypeString')
+        pages = workbook.props['pages']
+        self.assertEqual([len(x['cards']) for x in pages], [2, 2, 1])
+        # Every page loads the datasets its cards show
+        for page in pages:
+            produced = {x.get('outDataset') for x in page['model']['items']}
+            for card in page['cards']:
+                for layer in card['content']['layers']:
+                    self.assertIn(layer['datasetId'], produced)
+        workbook.save()
+        opened = InsightsWorkbook.open(FakeItem(self.gis, workbook))
+        self.assertEqual(opened.props['pages'], pages)
+        # Refreshing a layer reaches the copy of its item on another page
+        opened.update_dataset(self.layers[0])
+        data = opened.props['workspace']['datasets'][names[0]]['data']
+        chart = pages[2]['cards'][0]['content']['layers'][0]['datasetId']
+        tool = opened.props['workspace']['datasets'][chart]['data']['tools'][0]
+        self.assertEqual(tool['params']['dataset'], data)
+
+
+class AsyncWorkbookTest(PortalTestCase):
+
+    def run_async(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def test_new_add_save_open(self):
+        async def scenario():
+            workbook = await AsyncInsightsWorkbook.new(self.gis, 'Async')
+            names = await workbook.add_feature_layers(self.layers,
+                                                      chunk_size=1)
+            workbook.add_map(names[0])
+            derived = workbook.aggregate(
+                names[1], 'NAME', 'esriFieldTypeString', 'count', 'NAME',
+                'esriFieldTypeString')
+            self.assertTrue(await workbook.save())
+            self.assertFalse(await workbook.save())
+            opened = await AsyncInsightsWorkbook.open(
+                FakeItem(self.gis, workbook))
+            await opened.update_dataset(self.layers[1])
+            await opened.save()
+            return workbook, opened, names, derived
+
+        workbook, opened, names, derived = self.run_async(scenario())
+        datasets = opened.props['workspace']['datasets']
+        self.assertEqual(sorted(datasets), sorted(names + [derived]))
+        self.assertNotEqual(
+            datasets[names[1]]['data'],
+            workbook.props['workspace']['datasets'][names[1]]['data'])
+        tool = datasets[derived]['data']['tools'][0]
+        self.assertEqual(tool['params']['dataset'],
+                         datasets[names[1]]['data'])
+        stored = json.loads(FakeItem(self.gis, opened).get_data(False))
+        self.assertEqual(stored['workspace']['datasets'], datasets)
+
+    def test_concurrent_workbooks_share_transport(self):
+        transport = GISAsyncTransport(self.gis, max_per_host=2)
+
+        async def build(title):
+            workbook = await AsyncInsightsWorkbook.new(self.gis, title,
+                                                       transport)
+            names = await workbook.add_feature_layers(self.layers,
+                                                      chunk_size=1)
+            workbook.add_map(names[0])
+            await workbook.save()
+            return workbook
+
+        async def scenario():
+            return await asyncio.gather(*[build('Async %d' % i)
+                                          for i in range(4)])
+
+        workbooks = self.run_async(scenario())
+        self.assertEqual(len({x._workspaceID for x in workbooks}), 4)
+        for workbook in workbooks:
+            stored = json.loads(FakeItem(self.gis, workbook).get_data(False))
+            self.assertEqual(stored['title'], workbook._title)
+            self.assertEqual(len(stored['workspace']['datasets']), 4)
+
+    def test_transport_reused_across_event_loops(self):
+        transport = GISAsyncTransport(self.gis, max_per_host=2)
+        workbook = self.run_async(
+            AsyncInsightsWorkbook.new(self.gis, 'Async', transport))
+        for _ in range(2):
+            self.run_async(workbook.add_feature_layers(self.layers,
+                                                       chunk_size=1))
+        self.assertEqual(len(workbook.props['workspace']['datasets']), 8)
+
+    def test_workbooks_share_default_transport(self):
+        async def scenario():
+            return await asyncio.gather(*[
+                AsyncInsightsWorkbook.new(self.gis, 'Async %d' % i)
+                for i in range(2)])
+
+        workbooks = self.run_async(scenario())
+        self.assertIs(workbooks[0]._transport,
+                      insightsworkbook.default_async_transport)
+        self.assertIs(workbooks[1]._transport, workbooks[0]._transport)
+
+    def test_save_merges_concurrent_changes(self):
+        async def scenario():
+            workbook = await AsyncInsightsWorkbook.new(self.gis, 'Async')
+            names = await workbook.add_feature_layers(self.layers[:2])
+            await workbook.save()
+            item = FakeItem(self.gis, workbook)
+            mine = await AsyncInsightsWorkbook.open(item)
+            theirs = await AsyncInsightsWorkbook.open(item)
+            theirs.add_map(names[0])
+            await theirs.save()
+            mine.add_map(names[1])
+            await mine.save()
+            return mine
+
+        mine = self.run_async(scenario())
+        stored = json.loads(FakeItem(self.gis, mine).get_data(False))
+        self.assertEqual(len(stored['pages'][0]['cards']), 2)
+
+
+class ExtentTest(unittest.TestCase):
+
+    def extent(self, xmin, ymin, xmax, ymax, wkid=4326):
+        return {'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax,
+                'spatialReference': {'wkid': wkid}}
+
+    def test_union_leaves_out_missing_extents(self):
+        nan = float('nan')
+        for numpy in (insightsworkbook.np, None):
+            with self.subTest(numpy=numpy is not None), \
+                    unittest.mock.patch.object(insightsworkbook, 'np', numpy):
+                self.assertIsNone(extent_union([]))
+                self.assertIsNone(extent_union([None, self.extent(
+                    nan, nan, nan, nan)]))
+                union = extent_union([
+                    None, self.extent(nan, nan, nan, nan),
+                    self.extent(0, 0, 10, 10), {'xmin': None},
+                    self.extent(-5, 2, 3, 20)])
+                self.assertEqual(union, self.extent(-5, 0, 10, 20))
+
+    def test_union_across_spatial_references(self):
+        # Web Mercator x of 180 degrees, the y axis crossing the equator
+        half = 20037508.342789244
+        for numpy in (insightsworkbook.np, None):
+            with self.subTest(numpy=numpy is not None), \
+                    unittest.mock.patch.object(insightsworkbook, 'np', numpy):
+                union = extent_union([self.extent(-10, -5, 10, 5),
+                                      self.extent(0, 0, half, 0, 3857)])
+                self.assertEqual(union['spatialReference'], {'wkid': 4326})
+                for key, value in zip(('xmin', 'ymin', 'xmax', 'ymax'),
+                                      (-10, -5, 180, 5)):
+                    self.assertAlmostEqual(union[key], value, places=6)
+                union = extent_union([self.extent(-180, 0, 0, 0)],
+                                     {'wkid': 102100})
+                self.assertAlmostEqual(union['xmin'], -half, places=2)
+                self.assertEqual(union['spatialReference'], {'wkid': 102100})
+
+    def test_index_matches_brute_force(self):
+        rng = random.Random(7)
+        extents = {}
+        for i in range(500):
+            x, y = rng.uniform(-180, 170), rng.uniform(-80, 70)
+            extents['d%d' % i] = self.extent(
+                x, y, x + rng.uniform(0, 10), y + rng.uniform(0, 10))
+        extents['empty'] = self.extent(*[float('nan')] * 4)
+        extents['none'] = None
+        extents['state plane'] = self.extent(0, 0, 1, 1, 2229)
+        for node_size in (2, 4, 16):
+            index = ExtentIndex(extents, node_size=node_size)
+            self.assertEqual(len(index), 500)
+            self.assertEqual(sorted(index.skipped),
+                             ['empty', 'none', 'state plane'])
+            for _ in range(50):
+                x, y = rng.uniform(-180, 170), rng.uniform(-80, 70)
+                region = (x, y, x + rng.uniform(0, 40), y + rng.uniform(0, 40))
+                expected = sorted(
+                    name for name, e in extents.items()
+                    if name.startswith('d') and
+                    e['xmin'] <= region[2] and e['xmax'] >= region[0] and
+                    e['ymin'] <= region[3] and e['ymax'] >= region[1])
+                with self.subTest(node_size=node_size, region=region):
+                    self.assertEqual(sorted(index.intersecting(region)),
+                                     expected)
+
+
+class LazyOpenTest(PortalTestCase):
+
+    # Value written with escapes, brackets inside strings and spacing that
+    # a serializer wouldn't reproduce
+    TRICKY = ('{"s":"a]}\\"[{" , "u": "\\u00e9\\/\\\\", "n": 1.50E+2,'
+              ' "z": [ ], "nan": NaN}')
+
+    def stored(self, workbook):
+        return self.portal.items[workbook._workspaceID]
+
+    def open_tricky(self):
+        workbook = InsightsWorkbook.new(self.gis, 'Lazy')
+        name = workbook.add_feature_layer(self.layers[0])
+        workbook.add_map(name)
+        workbook.save()
+        props = json.loads(self.stored(workbook))
+        props['workspace']['datasets'][name]['extra'] = 'TRICKY'
+        props['pages'][0]['cards'][0]['extra'] = 'TRICKY'
+        text = json.dumps(props, indent=1).replace('"TRICKY"', self.TRICKY)
+        self.portal.items[workbook._workspaceID] = text
+        lazy = InsightsWorkbook.open(FakeItem(self.gis, workbook), lazy=True)
+        return lazy, name, text
+
+    def spans(self, props):
+        """ Source text of the unparsed values of pages and datasets """
+        containers = dict(enumerate(props['pages']._items))
+        containers['datasets'] = props['workspace']['datasets']
+        spans = {}
+        for at, container in containers.items():
+            for key, value in container._values.items():
+                if isinstance(value, insightsworkbook._Raw):
+                    spans[at, key] = props._text[value.start:value.end]
+        return spans
+
+    def test_skip_finds_end_of_value(self):
+        decoder = json.JSONDecoder()
+        values = [self.TRICKY, r'"\\"', r'"a\\\"b"', '-1.5E+10', 'NaN',
+                  '-Infinity', 'null', '[[], {}, [{"]": "["}]]']
+        for value in values:
+            text = ' ' + value + ' ,'
+            with self.subTest(value=value):
+                self.assertEqual(insightsworkbook._skip_json(text, 1),
+                                 decoder.raw_decode(text, 1)[1])
+        for value in ['"abc', '[1, "x]', '{"a": [1}', '']:
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    insightsworkbook._skip_json(value, 0)
+
+    def test_untouched_save_keeps_source_text(self):
+        lazy, name, text = self.open_tricky()
+        untouched = self.spans(lazy.props)
+        self.assertIn(('datasets', name), untouched)
+        self.assertTrue(lazy.save(force=True))
+        saved = self.stored(lazy)
+        self.assertEqual(saved.count(self.TRICKY), 2)
+        spans = self.spans(insightsworkbook.LazyObject(saved))
+        self.assertEqual({k: spans[k] for k in untouched}, untouched)
+
+    def test_edits_inside_lazy_values_are_saved(self):
+        lazy, name, text = self.open_tricky()
+        lazy.props['pages'][0]['cards'][0]['title'] = 'Edited'
+        lazy.props['workspace']['datasets'][name]['extra']['s'] = 'b'
+        self.assertTrue(lazy.save())
+        saved = json.loads(self.stored(lazy), parse_constant=str)
+        card = saved['pages'][0]['cards'][0]
+        self.assertEqual(card['title'], 'Edited')
+        self.assertEqual(card['extra']['u'], '\u00e9/\\')
+        extra = saved['workspace']['datasets'][name]['extra']
+        self.assertEqual(extra, {'s': 'b', 'u': '\u00e9/\\', 'n': 150.0,
+                                 'z': [], 'nan': 'NaN'})
+
+
+class Throttled(Exception):
+    """ Error of a request the portal turned away with 429 """
+    status_code = 429
+
+    def __init__(self, retry_after):
+        super().__init__('Too many requests')
+        self.headers = {'Retry-After': str(retry_after)}
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    A = 'https://a.example.com/sharing/rest/content/items/1'
+    B = 'https://b.example.com/sharing/rest/content/items/1'
+
+    def test_rate_recovers_per_host(self):
+        limiter = RateLimiter(rate=10, max_rate=12, rate_increase=1)
+        limiter.throttled(url=self.A)
+        self.assertEqual(limiter.current_rate(self.A), 5)
+        self.assertEqual(limiter.current_rate(self.B), 10)
+        for _ in range(3):
+            limiter.succeeded(self.A)
+        self.assertEqual(limiter.current_rate(self.A), 8)
+        for _ in range(10):
+            limiter.succeeded(self.A)
+        self.assertEqual(limiter.current_rate(self.A), 12)
+        for _ in range(10):
+            limiter.throttled(url=self.A)
+        self.assertEqual(limiter.current_rate(self.A), limiter.min_rate)
+
+    def test_unpaced_rate_estimated_over_window(self):
+        limiter = RateLimiter()
+        for _ in range(20):
+            self.assertEqual(limiter.reserve(self.A), 0)
+        limiter.reserve(self.B)
+        limiter.throttled(url=self.A)
+        # 20 requests within the first second, halved
+        self.assertEqual(limiter.current_rate(self.A), 10)
+        self.assertIsNone(limiter.current_rate(self.B))
+
+    def test_retry_after_is_honoured(self):
+        transport = Transport(RateLimiter(), RetryPolicy())
+        calls = []
+
+        def call():
+            calls.append(time.monotonic())
+            if len(calls) < 3:
+                raise Throttled(0.05)
+            return {'success': True}
+
+        start = time.monotonic()
+        self.assertEqual(transport.call('getItem', self.A, None, call),
+                         {'success': True})
+        self.assertEqual(len(calls), 3)
+        for before, after in zip(calls, calls[1:]):
+            self.assertGreaterEqual(after - before, 0.05)
+        self.assertLess(time.monotonic() - start, 0.5)
+        # Waiting for Retry-After is the backoff; the rate isn't halved
+        self.assertGreaterEqual(transport.limiter.current_rate(self.A),
+                                transport.limiter.min_rate)
+
+
+class StructureTest(PortalTestCase):
+
+    def test_malformed_workbook_fails_to_open(self):
+        workbook = InsightsWorkbook.new(self.gis, 'Structure')
+        workbook.add_map(workbook.add_feature_layer(self.layers[0]))
+        workbook.save()
+        props = json.loads(self.portal.items[workbook._workspaceID])
+        self.assertEqual(props['format'], insightsworkbook.WORKBOOK_FORMAT)
+        del props['pages'][0]['layout'][0]['h']
+        self.portal.items[workbook._workspaceID] = json.dumps(props)
+        with self.assertRaisesRegex(InsightsWorkbookError,
+                                    r'pages\[0\]\.layout\[0\] is missing "h"'):
+            InsightsWorkbook.open(FakeItem(self.gis, workbook))
+
+
+class RequestHookTest(PortalTestCase):
+
+    def record(self):
+        spans = []
+        add_request_hook(spans.append)
+        self.addCleanup(remove_request_hook, spans.append)
+        return spans
+
+    def test_spans_cover_workbook_calls(self):
+        insightsworkbook.layer_metadata.invalidate()
+        stats = RequestStats()
+        add_request_hook(stats)
+        self.addCleanup(remove_request_hook, stats)
+        spans = self.record()
+        workbook = InsightsWorkbook.new(self.gis, 'Hooks')
+        workbook.add_feature_layer(self.layers[0])
+        workbook.update_dataset(self.layers[0])
+        workbook.save()
+        self.assertEqual([x.operation for x in spans],
+                         ['createService', 'updateItem', 'execute',
+                          'getLayer', 'execute', 'updateItem'])
+        self.assertEqual({x.status for x in spans}, {200})
+        self.assertEqual({x.workbook for x in spans[2:]},
+                         {workbook._workspaceID})
+        self.assertEqual(spans[3].url, self.layers[0].url + '/0')
+        summary = stats.summary()
+        self.assertEqual(summary['execute']['count'], 2)
+        self.assertEqual(summary['getLayer']['request_bytes'], 0)
+        self.assertGreater(summary['getLayer']['response_bytes'], 0)
+        self.assertEqual(sum(x['count'] for x in
+                             stats.summary(by='host').values()), len(spans))
+
+    def test_spans_carry_the_real_status(self):
+        spans = self.record()
+        responses = [Throttled(0), {'error': {'code': 400,
+                                              'message': 'Bad tool'}}]
+
+        def call():
+            resp = responses.pop(0)
+            if isinstance(resp, Exception):
+                raise resp
+            return resp
+
+        Transport(RateLimiter(), RetryPolicy()).call(
+            'execute', RateLimiterTest.A, {'f': 'json'}, call, 'item1')
+        self.assertEqual([x.status for x in spans], [429, 400])
+        self.assertIsInstance(spans[0].error, Throttled)
+        self.assertIsNone(spans[1].error)
+
+    def test_stats_percentiles_and_reset(self):
+        stats = RequestStats()
+        for i in range(1, 101):
+            stats(Span('getItem', RateLimiterTest.A, 'a.example.com', 10,
+                       i, i / 100.0, 200 if i % 10 else 500, 'item1',
+                       None if i % 10 else Exception('failed')))
+        summary = stats.summary()['getItem']
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['errors'], 10)
+        self.assertEqual((summary['p50'], summary['p95'], summary['p99']),
+                         (0.5, 0.95, 0.99))
+        self.assertEqual(summary['request_bytes'], 1000)
+        self.assertEqual(summary['response_bytes'], 5050)
+        self.assertEqual(list(stats.summary(by='workbook')), ['item1'])
+        stats.reset()
+        self.assertEqual(stats.summary(), {})
+
+
+class IndexTest(PortalTestCase):
+
+    def aggregate(self, workbook, name):
+        return workbook.aggregate(name, 'NAME', 'esriFieldTypeString',
+                                  'count', 'NAME', 'esriFieldTypeString')
+
+    def test_find_layer_matches_the_sublayer(self):
+        lyr = self.layers[0]
+        lyr.layers.append(lyr.layers[0])
+        workbook = InsightsWorkbook.new(self.gis, 'Index')
+        name = workbook.add_feature_layer(lyr, sublayer=1)
+        index = workbook._index
+        self.assertEqual(index.find_layer(lyr.url, 1), name)
+        self.assertEqual(index.find_layer(lyr.url + '/', 1), name)
+        self.assertEqual(index.find_layer(lyr.url), name)
+        self.assertIsNone(index.find_layer(lyr.url, 0))
+        self.assertIsNone(index.find_layer(self.layers[1].url))
+        self.assertEqual(workbook.update_datasets([(lyr, 0), (lyr, 1)]),
+                         [None, name])
+        with self.assertRaises(InsightsWorkbookError):
+            workbook.update_dataset(lyr, 0)
+
+    def test_lookups_match_props(self):
+        workbook = InsightsWorkbook.new(self.gis, 'Index')
+        names = workbook.add_feature_layers(self.layers[:2])
+        workbook.add_page('Second')
+        derived = self.aggregate(workbook, names[0])
+        workbook.save()
+        lazy = InsightsWorkbook.open(FakeItem(self.gis, workbook), lazy=True)
+        for opened in (workbook, lazy):
+            with self.subTest(lazy=opened is lazy):
+                index = opened._index
+                datasets = opened.props['workspace']['datasets']
+                self.assertEqual(index.sources, {
+                    name: x.url + '/0' for x, name in zip(self.layers, names)})
+                # The aggregation's input is added to its page, too
+                self.assertEqual(index.pages, {
+                    names[0]: {0, 1}, names[1]: {0}, derived: {1}})
+                # Lazily opened datasets are indexed as they're looked up
+                for name in names + [derived]:
+                    self.assertIs(index.dataset(name), datasets[name])
+                self.assertIsNone(index.dataset('missing'))
+                data = datasets[names[0]]['data']
+                self.assertEqual(index.data[data], names[0])
+                self.assertEqual(index.refs[data], {derived})
+                self.assertEqual(index.inputs[derived], {names[0]})
+                self.assertEqual(index.derived[names[0]], {derived})
+                self.assertEqual(
+                    [x['outDataset'] for x in index.supporting_items(derived)],
+                    [names[0], derived])
+                # Same aggregation again is reused
+                self.assertEqual(self.aggregate(opened, names[0]), derived)
+
+
+class SlowSublayer(object):
+    """ Sublayer whose properties take a while to fetch, counting fetches """
+
+    def __init__(self, sublayer, delay=0.05):
+        self._sublayer = sublayer
+        self._delay = delay
+        self.fetches = 0
+
+    @property
+    def properties(self):
+        self.fetches += 1
+        time.sleep(self._delay)
+        return self._sublayer.properties
+
+
+class LayerMetadataCacheTest(PortalTestCase):
+
+    def test_entries_expire_and_are_invalidated(self):
+        cache = LayerMetadataCache(ttl=0.2)
+        a, b = self.layers[:2]
+        extent = a.layers[0].properties.extent
+        slow = []
+        for lyr in (a, b):
+            lyr.layers[0] = SlowSublayer(lyr.layers[0], delay=0)
+            slow.append(lyr.layers[0])
+
+        def fetches():
+            return [x.fetches for x in slow]
+
+        self.assertEqual(cache.extent(a), extent)
+        cache.extent(b)
+        # Past the TTL by the wall clock, which can jump
+        clock = unittest.mock.Mock(wraps=time)
+        clock.time.return_value = time.time() + 3600
+        with unittest.mock.patch.object(insightsworkbook, 'time', clock):
+            self.assertEqual(cache.extent(a), extent)
+        self.assertEqual(fetches(), [1, 1])
+        time.sleep(0.25)
+        cache.extent(a)
+        cache.extent(b)
+        self.assertEqual(fetches(), [2, 2])
+        # Only the given layer is dropped
+        cache.invalidate(a)
+        cache.extent(a)
+        cache.extent(b)
+        self.assertEqual(fetches(), [3, 2])
+        cache.invalidate()
+        cache.extent(a)
+        cache.extent(b)
+        self.assertEqual(fetches(), [4, 3])
+
+
+class RefreshWorkbooksTest(PortalTestCase):
+
+    def saved(self, title, layers):
+        workbook = InsightsWorkbook.new(self.gis, title)
+        names = workbook.add_feature_layers(layers) if layers else []
+        workbook.save()
+        return FakeItem(self.gis, workbook), names
+
+    def data(self, item):
+        datasets = json.loads(self.portal.items[item.id])['workspace'][
+            'datasets']
+        return {k: v['data'] for k, v in datasets.items()}
+
+    def test_workbooks_refreshed_independently(self):
+        a, b = self.layers[:2]
+        workbooks = [self.saved('A%d' % i, [a]) for i in range(4)]
+        workbooks.append(self.saved('B', [b]))
+        workbooks.append(self.saved('Neither', []))
+        broken = FakeItem(self.gis, InsightsWorkbook.new(self.gis, 'Broken'))
+        broken.id = 'missing'
+        items = [item for item, _ in workbooks] + [broken]
+        before = {item.id: self.data(item) for item in items[:-1]}
+        modified = dict(self.portal.modified)
+        for lyr in (a, b):
+            lyr.layers[0] = SlowSublayer(lyr.layers[0])
+        spans = []
+        add_request_hook(spans.append)
+        self.addCleanup(remove_request_hook, spans.append)
+        # A tuple of layers, not an (Item, sublayer) pair
+        results = refresh_workbooks((a, b), items, max_workers=8)
+        self.assertEqual([x.item for x in results], items)
+        for (item, names), result in zip(workbooks, results):
+            with self.subTest(title=item.title):
+                self.assertIsNone(result.error)
+                self.assertEqual(result.datasets, names)
+                data = self.data(item)
+                for name in names:
+                    self.assertNotEqual(data[name], before[item.id][name])
+        self.assertEqual(self.portal.modified[workbooks[-1][0].id],
+                         modified[workbooks[-1][0].id])
+        self.assertIsNotNone(results[-1].error)
+        self.assertEqual(results[-1].datasets, [])
+        # Data IDs are each workbook's own
+        refreshed = [self.data(item) for item, _ in workbooks[:4]]
+        self.assertEqual(len({list(x.values())[0] for x in refreshed}), 4)
+        # Each layer's properties were fetched once, for all the workbooks
+        self.assertEqual(sorted(x.url for x in spans
+                                if x.operation == 'getLayer'),
+                         [a.url + '/0', b.url + '/0'])
+
+
+class BatchTest(PortalTestCase):
+
+    def executed(self, post):
+        """ Number of add-data tools in each execute call made through post """
+        return [len(json.loads(data['tools']))
+                for (url, data), _ in post.call_args_list
+                if url.endswith('/execute')]
+
+    def test_layers_added_in_chunks(self):
+        layers = [FakeLayer(self.portal, i) for i in range(7)]
+        con = self.gis._portal.con
+        for chunk_size, added, updated in ((3, [3, 3, 1], [3, 1]),
+                                           (7, [7], [4]), (50, [7], [4])):
+            workbook = InsightsWorkbook.new(self.gis, 'Batch')
+            with self.subTest(chunk_size=chunk_size), \
+                    unittest.mock.patch.object(con, 'post',
+                                               wraps=con.post) as post:
+                names = workbook.add_feature_layers(layers,
+                                                    chunk_size=chunk_size)
+                self.assertEqual(self.executed(post), added)
+                post.reset_mock()
+                self.assertEqual(workbook.update_datasets(
+                    layers[:4], chunk_size=chunk_size), names[:4])
+                self.assertEqual(self.executed(post), updated)
+                datasets = workbook.props['workspace']['datasets']
+                self.assertEqual(len({datasets[x]['data'] for x in names}), 7)
+                self.assertEqual(
+                    [workbook._index.sources[x] for x in names],
+                    [x.url + '/0' for x in layers])
+
+    def test_async_layers_added_in_chunks(self):
+        layers = [FakeLayer(self.portal, i) for i in range(5)]
+        spans = []
+
+        async def run():
+            workbook = await AsyncInsightsWorkbook.new(self.gis, 'Batch')
+            add_request_hook(spans.append)
+            try:
+                return await workbook.add_feature_layers(layers, chunk_size=2)
+            finally:
+                remove_request_hook(spans.append)
+
+        names = asyncio.run(run())
+        self.assertEqual(len(names), 5)
+        self.assertEqual(
+            [x.operation for x in spans if x.operation == 'execute'],
+            ['execute'] * 3)
+
+
+class UnchangedSaveTest(PortalTestCase):
+
+    def requests(self):
+        return self.gis._portal.con.counters()[0]
+
+    def test_unchanged_save_makes_no_request(self):
+        workbook = InsightsWorkbook.new(self.gis, 'Unchanged')
+        name = workbook.add_feature_layer(self.layers[0])
+        workbook.add_map(name)
+        self.assertEqual(workbook.dirty,
+                         {'model', 'contents', 'cards', 'layout', 'datasets'})
+        self.assertTrue(workbook.save())
+        self.assertEqual(workbook.dirty, frozenset())
+        before = self.requests()
+        self.assertFalse(workbook.save())
+        self.assertEqual(self.requests(), before)
+
+        for lazy in (False, True):
+            with self.subTest(lazy=lazy):
+                opened = InsightsWorkbook.open(FakeItem(self.gis, workbook),
+                                               lazy=lazy)
+                before = self.requests()
+                self.assertFalse(opened.save())
+                self.assertFalse(opened.save(merge=False))
+                self.assertEqual(self.requests(), before)
+                # Changes made directly to props are still uploaded
+                opened.props['workspace']['datasets'][name]['title'] = str(lazy)
+                self.assertTrue(opened.save())
+                self.assertGreater(self.requests(), before)
+                before = self.requests()
+                self.assertFalse(opened.save())
+                self.assertEqual(self.requests(), before)
+
+        # Unless forced
+        self.assertTrue(workbook.save(force=True))
+        self.assertGreater(self.requests(), before)
+
+
+class WorkbookCacheTest(PortalTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = WorkbookCache(os.path.join(directory.name, 'cache.db'))
+        self.addCleanup(self.cache.close)
+
+    def test_least_recently_used_evicted(self):
+        # A clock that always moves on, so access times never tie
+        clock = unittest.mock.Mock(wraps=time)
+        clock.time.side_effect = itertools.count(1.0).__next__
+        props = [{'id': x, 'data': x * 100} for x in 'abcd']
+        with unittest.mock.patch.object(insightsworkbook, 'time', clock):
+            self.cache.put('a', 1, props[0])
+            self.cache.put('b', 1, props[1])
+            self.cache.max_bytes = self.cache.stats()['size']
+            self.assertEqual(self.cache.get('a', 1), props[0])
+            self.cache.put('c', 1, props[2])
+            self.assertIsNone(self.cache.get('b', 1))
+            self.assertEqual(self.cache.get('c', 1), props[2])
+            self.assertEqual(self.cache.get('a', 1), props[0])
+            self.cache.put('d', 1, props[3])
+            self.assertIsNone(self.cache.get('c', 1))
+            self.assertEqual(self.cache.get('a', 1), props[0])
+            self.assertEqual(self.cache.get('d', 1), props[3])
+        stats = self.cache.stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertLessEqual(stats['size'], self.cache.max_bytes)
+        self.assertEqual((stats['hits'], stats['misses']), (5, 2))
+
+    def test_open_counts_hits(self):
+        workbook = InsightsWorkbook.new(self.gis, 'Cached')
+        name = workbook.add_feature_layer(self.layers[0])
+        workbook.save()
+        item = FakeItem(self.gis, workbook)
+        text = item.get_data(False)
+        con = self.gis._portal.con
+        InsightsWorkbook.open(item, self.cache)
+        before = con.counters()[0]
+        for lazy in (False, True):
+            opened = InsightsWorkbook.open(item, self.cache, lazy=lazy)
+            self.assertEqual(opened.props['workspace']['datasets'],
+                             workbook.props['workspace']['datasets'])
+        self.assertEqual(con.counters()[0], before)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        self.assertEqual(stats['bytes_saved'], 2 * len(text.encode('utf-8')))
+        self.assertEqual(stats['entries'], 1)
+
+        # Once the item is saved again, the cached version is stale
+        workbook.add_map(name)
+        workbook.save()
+        item = FakeItem(self.gis, workbook)
+        opened = InsightsWorkbook.open(item, self.cache)
+        self.assertEqual(len(opened.props['pages'][0]['cards']), 1)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+        self.assertEqual(stats['entries'], 1)
+
+
+class AggregateDedupeTest(PortalTestCase):
+
+    def aggregate(self, workbook, dataset, stat_type='count', **kwargs):
+        return workbook.aggregate(dataset, 'NAME', 'esriFieldTypeString',
+                                  stat_type, 'NAME', 'esriFieldTypeString',
+                                  **kwargs)
+
+    def card_datasets(self, props):
+        return [[layer['datasetId'] for card in page['cards']
+                 for layer in card['content'].get('layers', [])]
+                for page in props['pages']]
+
+    def test_same_aggregation_reused(self):
+        workbook = InsightsWorkbook.new(self.gis, 'Dedupe')
+        name = workbook.add_feature_layer(self.layers[0])
+        derived = self.aggregate(workbook, name)
+        for _ in range(2):
+            workbook.add_chart('bar', name, 'NAME', 'esriFieldTypeString',
+                               'count', 'NAME', 'esriFieldTypeString')
+        workbook.add_page('Second')
+        workbook.add_chart('column', name, 'NAME', 'esriFieldTypeString',
+                           'count', 'NAME', 'esriFieldTypeString')
+        self.assertEqual(self.card_datasets(workbook.props),
+                         [[derived] * 2, [derived]])
+        # The second page produces the aggregation its card shows
+        self.assertEqual(
+            [x['outDataset'] for x in workbook.props['pages'][1]['model']
+             ['items']], [name, derived])
+        other = self.aggregate(workbook, name, 'min')
+        self.assertNotIn(other, (name, derived))
+        self.assertEqual(len(workbook.props['workspace']['datasets']), 3)
+        workbook.save()
+
+        # Reused after opening, too
+        opened = InsightsWorkbook.open(FakeItem(self.gis, workbook))
+        self.assertEqual(self.aggregate(opened, name), derived)
+        self.assertEqual(self.aggregate(opened, name, 'min'), other)
+        self.assertNotIn(self.aggregate(opened, name, reuse=False),
+                         (name, derived, other))
+
+    def test_compact_merges_duplicates(self):
+        workbook = InsightsWorkbook.new(self.gis, 'Compact')
+        name = workbook.add_feature_layer(self.layers[0])
+        first = self.aggregate(workbook, name)
+        workbook.add_chart('bar', first, 'NAME', 'esriFieldTypeString',
+                           'count', 'NAME', 'esriFieldTypeString')
+        workbook.add_page('Second')
+        duplicate = self.aggregate(workbook, name, reuse=False)
+        # Identical to the first chart's aggregation once duplicate is
+        # merged into first
+        workbook.add_chart('bar', duplicate, 'NAME', 'esriFieldTypeString',
+                           'count', 'NAME', 'esriFieldTypeString')
+        (on_first,), (on_duplicate,) = self.card_datasets(workbook.props)
+        self.assertNotEqual(on_first, on_duplicate)
+        workbook.save()
+
+        merged = workbook.compact()
+        self.assertEqual(merged, {duplicate: first, on_duplicate: on_first})
+        self.assertEqual(sorted(workbook.props['workspace']['datasets']),
+                         sorted([name, first, on_first]))
+        self.assertEqual(self.card_datasets(workbook.props),
+                         [[on_first], [on_first]])
+        # The second page now produces what its card shows
+        self.assertEqual(
+            [x['outDataset'] for x in workbook.props['pages'][1]['model']
+             ['items']], [name, first, on_first])
+        self.assertEqual(workbook.compact(), {})
+        self.assertTrue(workbook.save())
+        stored = json.loads(FakeItem(self.gis, workbook).get_data(False))
+        self.assertEqual(self.card_datasets(stored), [[on_first], [on_first]])
+        self.assertEqual(self.aggregate(workbook, name), first)
+
+
+@unittest.skipIf(insightsworkbook.np is None, 'requires numpy')
+class LocalAggregatorTest(PortalTestCase):
+
+    path = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'Air Quality Monitors.csv')
+
+    def expected(self, group_field, stat_type, stat_field):
+        """
+        Aggregates the CSV row by row the way the server does: empty and
+        non-numeric values are left out of every statistic
+        """
+        groups = {}
+        with open(self.path, newline='', encoding='utf-8-sig') as f:
+            for row in csv.DictReader(f):
+                values = groups.setdefault(row[group_field], [])
+                if stat_field not in row:
+                    values.append(0.0)
+                    continue
+                try:
+                    values.append(float(row[stat_field]))
+                except ValueError:
+                    pass
+        reduce = {'count': len, 'sum': sum, 'min': min, 'max': max,
+                  'avg': lambda x: sum(x) / len(x)}[stat_type]
+        return {k: reduce(v) if v or stat_type == 'count'
+                else float('nan') for k, v in groups.items()}
+
+    def test_matches_server_aggregates(self):
+        workbook = InsightsWorkbook.new(self.gis, 'Local')
+        name = workbook.add_feature_layer(self.layers[0])
+        datasets = workbook.props['workspace']['datasets']
+        for chunk_size in (1, 7, 1000):
+            aggregator = insightsworkbook.LocalAggregator(chunk_size)
+            for stat_type, stat_field in (
+                    ('count', 'PM25_AQI'), ('count', 'ObjectId'),
+                    ('sum', 'PM25_AQI'), ('avg', 'OZONE_AQI'),
+                    ('min', 'PM10_AQI'), ('max', 'Elevation')):
+                with self.subTest(chunk_size=chunk_size, stat=stat_type,
+                                  field=stat_field):
+                    result = aggregator.aggregate(
+                        self.path, 'StateName', 'esriFieldTypeString',
+                        stat_type, stat_field, 'esriFieldTypeDouble')
+                    actual = dict(zip(*[x.tolist() for x in
+                                        result.columns.values()]))
+                    expected = self.expected('StateName', stat_type,
+                                             stat_field)
+                    self.assertEqual(set(actual), set(expected))
+                    for key, value in expected.items():
+                        if math.isnan(value):
+                            self.assertTrue(math.isnan(actual[key]), key)
+                        else:
+                            self.assertAlmostEqual(actual[key], value,
+                                                   msg=key)
+                    # The schema is the one the workbook records
+                    out = workbook.aggregate(
+                        name, 'StateName', 'esriFieldTypeString', stat_type,
+                        stat_field, 'esriFieldTypeDouble')
+                    self.assertEqual(
+                        result.fields, datasets[out]['data']['metadata']
+                        ['fields'])
+
+    def test_group_limit_and_changed_files(self):
+        aggregator = insightsworkbook.LocalAggregator(max_groups=5)
+        with self.assertRaises(ValueError):
+            aggregator.aggregate(self.path, 'StateName',
+                                 'esriFieldTypeString', 'count', 'ObjectId',
+                                 'esriFieldTypeInteger')
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'monitors.csv')
+        with open(path, 'w') as f:
+            f.write('Status,PM25\nActive,1\nActive,2\nInactive,\n'
+                    'Inactive,4\n')
+        result = aggregator.aggregate(path, 'Status', 'esriFieldTypeString',
+                                      'sum', 'PM25', 'esriFieldTypeInteger')
+        self.assertEqual(dict(zip(*[x.tolist() for x in
+                                    result.columns.values()])),
+                         {'Active': 3, 'Inactive': 4})
+        # Rewritten files are read again rather than taken from the cache
+        with open(path, 'w') as f:
+            f.write('Status,PM25\nActive,10\nInactive,5\nInactive,7\n')
+        os.utime(path, (0, 0))
+        result = aggregator.aggregate(path, 'Status', 'esriFieldTypeString',
+                                      'sum', 'PM25', 'esriFieldTypeInteger')
+        self.assertEqual(dict(zip(*[x.tolist() for x in
+                                    result.columns.values()])),
+                         {'Active': 10, 'Inactive': 12})
+
+
+class FakeFeatureLayer(object):
+    """
+    In-memory stand-in for the arcgis.features.FeatureLayer published from
+    the monitors CSV, recording the size of each edit_features call
+    """
+
+    def __init__(self):
+        self.properties = types.SimpleNamespace(
+            objectIdField='OBJECTID',
+            fields=[{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'},
+                    {'name': 'AQSID', 'type': 'esriFieldTypeString'},
+                    {'name': 'SiteName', 'type': 'esriFieldTypeString'},
+                    {'name': 'PM25_AQI', 'type': 'esriFieldTypeDouble'}])
+        self.features = {}
+        self.edits = []
+        self._oids = itertools.count(1)
+
+    def query(self, where, out_fields, return_geometry):
+        return types.SimpleNamespace(features=[
+            types.SimpleNamespace(attributes=dict(x['attributes']))
+            for x in self.features.values()])
+
+    def edit_features(self, adds=None, updates=None, deletes=None):
+        deletes = [int(x) for x in deletes.split(',')] if deletes else []
+        self.edits.append(len(adds or ()) + len(updates or ()) +
+                          len(deletes))
+        resp = {'addResults': [], 'updateResults': [], 'deleteResults': []}
+        for feature in adds or ():
+            oid = next(self._oids)
+            feature['attributes']['OBJECTID'] = oid
+            self.features[oid] = feature
+            resp['addResults'].append({'objectId': oid, 'success': True})
+        for feature in updates or ():
+            oid = feature['attributes']['OBJECTID']
+            self.features[oid] = feature
+            resp['updateResults'].append({'objectId': oid, 'success': True})
+        for oid in deletes:
+            del self.features[oid]
+            resp['deleteResults'].append({'objectId': oid, 'success': True})
+        return resp
+
+    def rows(self):
+        """ Features by AQSID, without their object IDs """
+        return {x['attributes']['AQSID']:
+                ({k: v for k, v in x['attributes'].items()
+                  if k != 'OBJECTID'}, x.get('geometry'))
+                for x in self.features.values()}
+
+
+class IngestCsvDeltaTest(unittest.TestCase):
+
+    path = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'Air Quality Monitors.csv')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        with open(self.path, newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            self.header = reader.fieldnames
+            self.monitors = list(reader)
+
+    def write(self, name, rows):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, self.header)
+            writer.writeheader()
+            writer.writerows(rows)
+        return path
+
+    def expected(self, rows):
+        """ What the layer holds when published straight from rows """
+        return {x['AQSID']: (
+            {'AQSID': x['AQSID'], 'SiteName': x['SiteName'],
+             'PM25_AQI': float(x['PM25_AQI']) if x['PM25_AQI'] else None},
+            {'x': float(x['Longitude']), 'y': float(x['Latitude']),
+             'spatialReference': {'wkid': 4326}}) for x in rows}
+
+    def test_adds_updates_and_deletes(self):
+        layer = FakeFeatureLayer()
+        empty = self.write('empty.csv', [])
+        previous = self.write('previous.csv', self.monitors[:40])
+        result = insightsworkbook.ingest_csv_delta(layer, previous, empty,
+                                                   batch_size=7)
+        self.assertEqual(result, (40, 0, 0, []))
+        self.assertEqual(layer.rows(), self.expected(self.monitors[:40]))
+        self.assertEqual(layer.edits, [7] * 5 + [5])
+
+        # Drop the first 5 rows, change 4 and add the last 10
+        rows = [dict(x) for x in self.monitors[5:]]
+        rows[1]['PM25_AQI'] = '998.5'
+        rows[2]['SiteName'] += ' (moved)'
+        rows[3]['PM25_AQI'] = ''
+        rows[10]['Latitude'] = '45.5'
+        current = self.write('current.csv', rows)
+        layer.edits = []
+        result = insightsworkbook.ingest_csv_delta(layer, current, previous,
+                                                   batch_size=7)
+        self.assertEqual(result, (10, 4, 5, []))
+        self.assertEqual(layer.rows(), self.expected(rows))
+        self.assertEqual(layer.edits, [7, 7, 5])
+
+        # Nothing changed since
+        layer.edits = []
+        result = insightsworkbook.ingest_csv_delta(layer, current, current)
+        self.assertEqual(result, (0, 0, 0, []))
+        self.assertEqual(layer.edits, [])
+
+    def test_failures_reported(self):
+        layer = FakeFeatureLayer()
+        previous = self.write('previous.csv', self.monitors[:3])
+        insightsworkbook.ingest_csv_delta(layer, previous,
+                                          self.write('empty.csv', []))
+        edit_features = layer.edit_features
+
+        def reject_updates(adds=None, updates=None, deletes=None):
+            resp = edit_features(adds, None, deletes)
+            resp['updateResults'] = [
+                {'objectId': x['attributes']['OBJECTID'], 'success': False,
+                 'error': {'code': 1000}} for x in updates or ()]
+            return resp
+
+        layer.edit_features = reject_updates
+        rows = [dict(x) for x in self.monitors[1:4]]
+        rows[0]['SiteName'] = 'Renamed'
+        result = insightsworkbook.ingest_csv_delta(
+            layer, self.write('current.csv', rows), previous)
+        self.assertEqual(result[:3], (1, 0, 1))
+        self.assertEqual([x['error'] for x in result.failures],
+                         [{'code': 1000}])
+
+
+class LayoutPackerTest(PortalTestCase):
+
+    def assertApart(self, cells, others=(), gap=0):
+        """ Checks no two cells, or a cell and another, come within gap """
+        cells = list(cells)
+        pairs = [(a, b) for i, a in enumerate(cells) for b in cells[i + 1:]]
+        pairs += [(a, b) for a in cells for b in others]
+        for a, b in pairs:
+            self.assertTrue(a['x'] + a['w'] + gap <= b['x'] or
+                            b['x'] + b['w'] + gap <= a['x'] or
+                            a['y'] + a['h'] + gap <= b['y'] or
+                            b['y'] + b['h'] + gap <= a['y'], (a, b))
+
+    def test_random_cards_dont_overlap(self):
+        rng = random.Random(7)
+        for columns, gap in ((83, 1), (24, 0), (10, 2)):
+            with self.subTest(columns=columns, gap=gap):
+                # Cards already on the page, some of them touching
+                existing = []
+                while len(existing) < 8:
+                    w, h = rng.randint(1, columns), rng.randint(1, 15)
+                    cell = {'x': rng.randint(0, columns - w),
+                            'y': rng.randint(0, 60), 'w': w, 'h': h}
+                    if all(cell['x'] + w <= x['x'] or
+                           x['x'] + x['w'] <= cell['x'] or
+                           cell['y'] + h <= x['y'] or
+                           x['y'] + x['h'] <= cell['y'] for x in existing):
+                        existing.append(cell)
+                packer = insightsworkbook.LayoutPacker(columns, gap,
+                                                       existing)
+                placed = []
+                for _ in range(80):
+                    w = rng.choice((1, 2, columns // 3, columns // 2,
+                                    rng.randint(1, columns), columns))
+                    h = rng.randint(1, 25)
+                    x, y = packer.place(w, h)
+                    self.assertGreaterEqual(min(x, y), 0)
+                    self.assertLessEqual(x + w, columns)
+                    placed.append({'x': x, 'y': y, 'w': w, 'h': h})
+                self.assertApart(placed, existing, gap)
+
+    def test_workbook_cards_dont_overlap(self):
+        workbook = InsightsWorkbook.new(self.gis, 'Layout')
+        workbook.page_card_limit = 100
+        names = workbook.add_feature_layers(self.layers)
+        for name in names * 3:
+            workbook.add_map(name)
+        layout = workbook.props['pages'][0]['layout']
+        self.assertApart(layout, gap=insightsworkbook.LAYOUT_GAP)
+        # Cards laid out in a single wide row, as older workbooks have them
+        for i, cell in enumerate(layout):
+            cell['x'], cell['y'] = i * 21, 0
+        workbook.save()
+        opened = InsightsWorkbook.open(FakeItem(self.gis, workbook))
+        for name in names:
+            opened.add_chart('bar', name, 'NAME', 'esriFieldTypeString',
+                             'count', 'NAME', 'esriFieldTypeString')
+        layout = opened.props['pages'][0]['layout']
+        self.assertApart(layout[12:], layout[:12],
+                         insightsworkbook.LAYOUT_GAP)
+        opened.pack_layout()
+        self.assertApart(layout, gap=insightsworkbook.LAYOUT_GAP)
+        self.assertTrue(all(x['x'] + x['w'] <= insightsworkbook.LAYOUT_COLUMNS
+                            for x in layout))
+        # Still in the order they appeared in
+        order = sorted(range(16), key=lambda i: (layout[i]['y'],
+                                                 layout[i]['x']))
+        self.assertEqual(order, list(range(16)))
+
+
+class PropagateTest(PortalTestCase):
+
+    def chain(self, workbook, name, length):
+        """ Aggregates name, then each aggregation in turn """
+        chain = [name]
+        for i in range(length):
+            chain.append(workbook.aggregate(
+                chain[-1], 'NAME', 'esriFieldTypeString',
+                ('count', 'sum', 'max')[i % 3], 'NAME',
+                'esriFieldTypeString'))
+        return chain
+
+    def assertUpToDate(self, props, chain):
+        """ Checks each dataset of a chain embeds the data of the one before """
+        datasets = props['workspace']['datasets']
+        for parent, child in zip(chain, chain[1:]):
+            tool = datasets[child]['data']['tools'][0]
+            self.assertEqual(json.dumps(tool['params']['dataset'],
+                                        sort_keys=True),
+                             json.dumps(datasets[parent]['data'],
+                                        sort_keys=True), child)
+
+    def test_chains_brought_up_to_date(self):
+        workbook = InsightsWorkbook.new(self.gis, 'Chains')
+        a, b = workbook.add_feature_layers(self.layers[:2])
+        long = self.chain(workbook, a, 4)
+        # A branch off the middle of the long chain, and a chain of its own
+        branch = long[:3] + self.chain(workbook, long[2], 2)[1:]
+        other = self.chain(workbook, b, 2)
+        workbook.save()
+        datasets = workbook.props['workspace']['datasets']
+        before = {x: json.dumps(datasets[x]['data'], sort_keys=True)
+                  for x in datasets}
+
+        for lazy in (False, True):
+            with self.subTest(lazy=lazy):
+                opened = InsightsWorkbook.open(FakeItem(self.gis, workbook),
+                                               lazy=lazy)
+                opened.update_dataset(self.layers[0])
+                for chain in (long, branch, other):
+                    self.assertUpToDate(opened.props, chain)
+                changed = {x for x in datasets
+                           if json.dumps(opened.props['workspace']['datasets']
+                                         [x]['data'], sort_keys=True)
+                           != before[x]}
+                self.assertEqual(changed, set(long + branch))
+                opened.save()
+                stored = json.loads(
+                    FakeItem(self.gis, workbook).get_data(False))
+                for chain in (long, branch, other):
+                    self.assertUpToDate(stored, chain)
+
+        # Both bases at once, with the order of the rewrites parents first
+        workbook.update_datasets(self.layers[:2])
+        for chain in (long, branch, other):
+            self.assertUpToDate(workbook.props, chain)
+        datasets = workbook.props['workspace']['datasets']
+        order = workbook._index.propagate(
+            {a: datasets[a]['data'], b: datasets[b]['data']})
+        self.assertEqual(set(order), set(long + branch + other) - {a, b})
+        for chain in (long, branch, other):
+            positions = [order.index(x) for x in chain[1:]]
+            self.assertEqual(positions, sorted(positions))
+
+
+class WorkbookValidatorTest(PortalTestCase):
+
+    def workbook(self):
+        workbook = InsightsWorkbook.new(self.gis, 'Validated')
+        self.name = workbook.add_feature_layer(self.layers[0])
+        workbook.add_map(self.name)
+        workbook.add_chart('bar', self.name, 'NAME', 'esriFieldTypeString',
+                           'count', 'NAME', 'esriFieldTypeString')
+        self.derived = workbook.props['pages'][0]['model']['items'][1][
+            'outDataset']
+        return workbook
+
+    def test_every_problem_reported(self):
+        workbook = self.workbook()
+        validator = insightsworkbook.WorkbookValidator()
+        self.assertEqual(validator.problems(workbook.props), [])
+        props = workbook.props
+        page = props['pages'][0]
+        datasets = props['workspace']['datasets']
+        props['format'] = 1
+        page['model']['items'][1]['params']['statistics'][0]['type'] = 'mode'
+        page['model']['items'].append({'operation': 'aggregate',
+                                       'params': {'dataset': 'gone'},
+                                       'outDataset': 'missing'})
+        page['contents'].append({'dataset': 'missing'})
+        page['contents'].append({'dataset': 'gone'})
+        page['cards'][0]['content']['layers'][0]['datasetId'] = 'gone'
+        page['layout'][0]['w'] = 0
+        page['layout'][1]['w'] = -1
+        page['layout'][1]['h'] = -2
+        datasets[self.derived]['data']['tools'][0]['params']['statistics'][
+            0]['type'] = 'mode'
+        expected = [
+            'format is 1, expected %d' % insightsworkbook.WORKBOOK_FORMAT,
+            "pages[0].model.items[1] has the unknown statistic 'mode'",
+            "pages[0].model.items[2] outputs the unknown dataset 'missing'",
+            "pages[0].model.items[2] aggregates the unknown dataset 'gone'",
+            "pages[0].contents[1] lists the unknown dataset 'missing'",
+            "pages[0].contents[2] lists the unknown dataset 'gone'",
+            "pages[0].cards[0] shows the unknown dataset 'gone'",
+            "pages[0].layout[0] has a w that isn't positive",
+            "pages[0].layout[1] has a w that isn't positive",
+            "pages[0].layout[1] has a h that isn't positive",
+            'datasets[%r] has the unknown statistic %r' % (self.derived,
+                                                           'mode')]
+        self.assertEqual(validator.problems(props), expected)
+        self.assertEqual(validator.problems(props, ['cards', 'layout'],
+                                            known={}), expected[6:10])
+        # Malformed elements are reported too, though opening or saving
+        # stops at them first
+        card = page['cards'][1]
+        page['cards'][1] = {'content': 'chart'}
+        self.assertEqual(validator.problems(props, ['cards']),
+                         [expected[0], expected[6],
+                          'pages[0].cards[1] is malformed'])
+        page['cards'][1] = card
+
+        # The error lists the first 10 problems
+        with self.assertRaises(
+                insightsworkbook.InsightsWorkbookValidationError) as caught:
+            workbook.validate()
+        self.assertEqual(caught.exception.problems, expected)
+        self.assertEqual(str(caught.exception),
+                         'Invalid workbook: ' + '; '.join(expected[:10]) +
+                         ' (and 1 more)')
+        # Saving leaves the format to Insights, and uploads nothing
+        con = self.gis._portal.con
+        before = con.counters()[0]
+        with self.assertRaises(
+                insightsworkbook.InsightsWorkbookValidationError) as caught:
+            workbook.save()
+        self.assertEqual(con.counters()[0], before)
+        self.assertEqual(caught.exception.problems, expected[1:])
+
+    def test_save_checks_only_new_elements(self):
+        workbook = self.workbook()
+        default = insightsworkbook.workbook_validator
+        # A validator that allows a statistic the default one doesn't
+        insightsworkbook.workbook_validator = \
+            insightsworkbook.WorkbookValidator(
+                insightsworkbook.STAT_TYPES + ('median',))
+        try:
+            median = workbook.aggregate(self.name, 'NAME',
+                                        'esriFieldTypeString', 'median',
+                                        'PM25', 'esriFieldTypeDouble')
+            workbook.save()
+        finally:
+            insightsworkbook.workbook_validator = default
+        # Saved elements aren't checked again, only the ones added since
+        workbook.add_map(self.name)
+        self.assertTrue(workbook.save())
+        with self.assertRaises(
+                insightsworkbook.InsightsWorkbookValidationError) as caught:
+            workbook.validate()
+        self.assertEqual(caught.exception.problems, [
+            "pages[0].model.items[2] has the unknown statistic 'median'",
+            "datasets[%r] has the unknown statistic 'median'" % median])
+        # Nor are elements changed in place, but replaced ones are
+        cards = workbook.props['pages'][0]['cards']
+        cards[0]['content']['layers'][0]['datasetId'] = 'gone'
+        self.assertTrue(workbook.save())
+        cards[-1] = dict(cards[-1], content={'layers': [{'datasetId': 'gone'}]})
+        with self.assertRaises(
+                insightsworkbook.InsightsWorkbookValidationError) as caught:
+            workbook.save()
+        self.assertEqual(caught.exception.problems,
+                         ["pages[0].cards[2] shows the unknown dataset "
+                          "'gone'"])
+
+    def test_bad_tools_rejected_before_execute(self):
+        workbook = InsightsWorkbook.new(self.gis, 'Validated')
+        layer = FakeLayer(self.portal, 9)
+        layer.url = 'ftp://example.com/FeatureServer'
+        con = self.gis._portal.con
+        before = con.counters()[0]
+        with self.assertRaises(
+                insightsworkbook.InsightsWorkbookValidationError) as caught:
+            workbook.add_feature_layers([self.layers[0], layer])
+        self.assertEqual(con.counters()[0], before)
+        self.assertEqual(caught.exception.problems, [
+            "tools[1] has an invalid layer URL "
+            "'ftp://example.com/FeatureServer/0'"])
+
+
+class BrokenItem(object):
+    """ Workbook item whose data can't be downloaded """
+
+    def __init__(self, gis):
+        self._gis = gis
+        self.id = 'broken'
+
+    def get_data(self, try_json=True):
+        raise RuntimeError('Item not found')
+
+
+def replaced(value, replacements):
+    """ Copy of JSON props with the strings in replacements replaced """
+    if isinstance(value, dict):
+        return {k: replaced(v, replacements) for k, v in value.items()}
+    if isinstance(value, list):
+        return [replaced(x, replacements) for x in value]
+    if isinstance(value, str):
+        return replacements.get(value, value)
+    return value
+
+
+class ArchiveTest(PortalTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'workbooks.gz')
+        # The portal the workbooks are moved to, and its copies of the first
+        # two layers
+        self.target = FakePortal().start()
+        self.addCleanup(self.target.stop)
+        self.target_gis = FakeGIS(self.target)
+        self.moved = [FakeLayer(self.target, i) for i in range(2)]
+        for layer in self.moved:
+            layer.id = 'moved-' + layer.id
+
+    def workbooks(self):
+        first = InsightsWorkbook.new(self.gis, 'First')
+        a, b = first.add_feature_layers(self.layers[:2])
+        first.add_map([a, b])
+        first.add_chart('bar', a, 'NAME', 'esriFieldTypeString', 'count',
+                        'NAME', 'esriFieldTypeString')
+        derived = first.props['pages'][0]['cards'][1]['content']['layers'][
+            0]['datasetId']
+        first.aggregate(derived, 'NAME', 'esriFieldTypeString', 'max',
+                        'name_count', 'esriFieldTypeInteger')
+        first.save()
+        second = InsightsWorkbook.new(self.gis, 'Second')
+        second.add_feature_layer(self.layers[2])
+        second.add_page('Other')
+        second.add_map(second.add_feature_layer(self.layers[3]))
+        second.save()
+        return [FakeItem(self.gis, x) for x in (first, second)]
+
+    def test_round_trip_with_layer_map(self):
+        items = self.workbooks()
+        broken = BrokenItem(self.gis)
+        results = insightsworkbook.export_workbooks(
+            [items[0], broken, items[1]], self.path)
+        self.assertEqual([x.item for x in results],
+                         [items[0], broken, items[1]])
+        self.assertEqual([x.error is None for x in results],
+                         [True, False, True])
+        archived = list(insightsworkbook.read_archive(self.path))
+        self.assertEqual([x['item']['id'] for x, _ in archived],
+                         [x.id for x in items])
+        # The props are kept exactly as they're stored
+        self.assertEqual([x for _, x in archived],
+                         [self.portal.items[x.id] for x in items])
+
+        # A whole service moved to another item, and a single sublayer moved
+        # to another URL. The other layers stay where they are.
+        layer_map = {self.layers[0].url: self.moved[0],
+                     self.layers[1].url + '/0': self.moved[1].url + '/0'}
+        progress = {}
+        results = insightsworkbook.import_workbooks(
+            self.target_gis, self.path, layer_map, chunk_size=1,
+            progress=progress)
+        self.assertEqual([(x.title, x.item_id, x.error) for x in results],
+                         [('First', items[0].id, None),
+                          ('Second', items[1].id, None)])
+        moves = {self.layers[0].url + '/0': self.moved[0].url + '/0',
+                 self.layers[0].id: self.moved[0].id,
+                 self.layers[1].url + '/0': self.moved[1].url + '/0'}
+        for (_, text), result in zip(archived, results):
+            old = json.loads(text)
+            new = json.loads(self.target.items[result.workspace_id])
+            sources = insightsworkbook.WorkbookIndex(old).sources
+            # Each added layer gets new data, used everywhere the old was,
+            # including in the tools of derived datasets
+            datasets = new['workspace']['datasets']
+            data = {old['workspace']['datasets'][x]['data']:
+                    datasets[x]['data'] for x in sources}
+            self.assertEqual(len(set(data.values())), len(sources))
+            expected = replaced(old, dict(moves, **data))
+            self.assertEqual(new['pages'], expected['pages'])
+            self.assertEqual(new['workspace'], expected['workspace'])
+            self.assertEqual(insightsworkbook.WorkbookIndex(new).sources,
+                             {x: moves.get(y, y) for x, y in sources.items()})
+
+        # Resuming a finished import makes no requests
+        before = self.target_gis._portal.con.counters()[0]
+        again = insightsworkbook.import_workbooks(
+            self.target_gis, self.path, layer_map, progress=progress)
+        self.assertEqual(again, results)
+        self.assertEqual(self.target_gis._portal.con.counters()[0], before)
+
+
+class SerializerTest(unittest.TestCase):
+
+    @unittest.skipIf(insightsworkbook.orjson is None, 'orjson not installed')
+    def test_backends_agree(self):
+        values = [{'extent': {'xmin': float('nan'), 'ymin': 1.5}},
+                  [None, float('inf'), {'a': [float('-inf')]}],
+                  {'title': None, 'n': 2 ** 70, 'x': [1, 'b']}]
+        for value in values:
+            # NaN and Infinity compared as the names they're written as
+            self.assertEqual(
+                json.loads(insightsworkbook.OrjsonSerializer().dumps(value),
+                           parse_constant=str),
+                json.loads(insightsworkbook.JSONSerializer().dumps(value),
+                           parse_constant=str))
+
+
+class WorkbookSessionTest(PortalTestCase):
+
+    def test_shared_session_doesnt_keep_gis_alive(self):
+        InsightsWorkbook.new(self.gis, 'Session')
+        gis = weakref.ref(self.gis)
+        del self.gis
+        gc.collect()
+        self.assertIsNone(gis())
+
+    def test_adapters_left_alone_by_default(self):
+        adapters = dict(self.gis._portal.con._session.adapters)
+        WorkbookSession(self.gis)
+        self.assertEqual(self.gis._portal.con._session.adapters, adapters)
+
+    def test_compressed_form_isnt_joined(self):
+        form = {'f': 'json', 'text': ['{"a": ', '"b&c"', '}' * 70000]}
+        body = insightsworkbook._gzip_form(form, slice_size=1000)
+        self.assertEqual(gzip.decompress(body).decode('ascii'),
+                         urllib.parse.urlencode(
+                             {'f': 'json', 'text': ''.join(form['text'])}))
+
+    def test_rejected_compression_falls_back(self):
+        # Rejected by the server or a proxy, or an expired token, which
+        # doesn't mean compression won't work
+        for status, compress in ((400, False), (413, False), (415, False),
+                                 (502, False), (498, True)):
+            with self.subTest(status=status):
+                session = WorkbookSession(self.gis, compress=True)
+                workbook = InsightsWorkbook.new(self.gis, 'Gzip',
+                                                session=session)
+                name = workbook.add_feature_layer(self.layers[0])
+                rejected = self.portal.gzip_rejected
+                self.portal.gzip_status = status
+                try:
+                    self.assertTrue(workbook.save())
+                finally:
+                    self.portal.gzip_status = None
+                self.assertEqual(self.portal.gzip_rejected, rejected + 1)
+                self.assertEqual(session.compress, compress)
+                stored = json.loads(self.portal.items[workbook._workspaceID])
+                self.assertIn(name, stored['workspace']['datasets'])
+                workbook.add_map(name)
+                self.assertTrue(workbook.save())
+                stored = json.loads(self.portal.items[workbook._workspaceID])
+                self.assertEqual(len(stored['pages'][0]['cards']), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()